@@ -301,16 +301,18 @@ DO NOT add any other parts like ```json which may cause parse error of json."""
                                 _messages.append(messages[-1])
                             messages = _messages
 
-                        # if tool.function.name == 'notebook---store_intermediate_results':
-                        #     args['data'] = messages[-2]['content']
-                        #     tool.function.arguments = 'Arguments removed to brief context.'
+                        cache_tool_result = (tool.function.name == 'notebook---store_intermediate_results'
+                                             and messages[-2]['role'] == 'tool')
+                        if cache_tool_result:
+                            args['data'] = messages[-2]['content']
+                            tool.function.arguments = 'Arguments removed to brief context.'
                         if tool.function.name == 'web-search---tavily-search':
                             args['include_domains'] = []
                             args['include_raw_content'] = False
                         result = await self.sessions[key].call_tool(tool_name, args)
-                        # if len(result.content[0].text) > 20000:
-                        #     result.content[0].text += ('\n\nContent too long, '
-                        #                                'Call notebook---store_intermediate_results to summarize.')
+                        if key != 'notebook' and result.content and len(result.content[0].text or '') > 20000:
+                            result.content[0].text += ('\n\nContent too long, '
+                                                       'Call notebook---store_intermediate_results to summarize.')
                         tool_result = (result.content[0].text or '').strip()
                         if key in ('web-search'):
                             _args: dict = self.summary(query, tool_result, **kwargs)
@@ -319,8 +321,8 @@ DO NOT add any other parts like ```json which may cause parse error of json."""
                                 _print_origin_result = _print_origin_result[:512] + '...'
                             print(tool_name, args, _print_origin_result)
                             tool_result = str(_args)
-                        # if tool.function.name == 'notebook---store_intermediate_results':
-                        #     messages[-2]['content'] = f'Tool result cached to notebook with title: {args["title"]}'
+                        if cache_tool_result and tool_result.startswith('Stored'):
+                            messages[-2]['content'] = f'Tool result cached to notebook with title: {args["title"]}'
                         if 'advance_to_next_step' in tool.function.name:
                             content_and_system = json.loads(tool_result)
                             tool_result = content_and_system[0]
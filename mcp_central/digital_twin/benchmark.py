@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+数字分身服务器的性能测试，数据库建在临时目录中，不影响 digital_twin.db。
+
+    python benchmark.py --rows 500000 --batch-size 5000
+
+生成合成的聊天记录，分别用改进前的逐条 execute 导入和 `import_wechat_data` 的分批 executemany 导入，
+报告每秒导入的条数。
+
+    python benchmark.py --file-rows 500000 --formats jsonl,csv,json
+
+把合成的聊天记录写成导出文件，用 `import_wechat_file` 流式导入，报告每秒导入的条数和导入时的内存峰值，
+并与把整个文件作为 JSON 字符串交给 `import_wechat_messages` 对比。
+
+    python benchmark.py --query-rows 2000000 --users 100
+
+按迁移前的表结构（没有索引，用户画像可重复）建库，写入分属 `--users` 个用户的聊天记录和重复的用户画像，
+报告分析用户画像和聊天统计的查询计划与耗时；然后执行迁移，报告迁移耗时，再报告一次查询计划与耗时。
+
+    python benchmark.py --profile-rows 1000000
+
+对合成的聊天记录（几乎全是关键词的，大部分字不在词典中的，和由关键词及其后半截拼成、关键词互相重叠的）
+分别用改进前的逐个关键词 `in` / `str.count` 扫描和 `KeywordMatcher` 的一次扫描分析用户画像，报告耗时、
+两者的画像是否相同，以及每个关键词的次数是否都与 `str.count` 相同。`--extra-keywords 1000` 在词典中加入更多关键词。
+
+    python benchmark.py --analyze-rows 1000000
+
+为一个用户导入聊天记录，比较累加汇总和不累加时的导入速度，以及从汇总分析用户画像、重新统计汇总和改进前
+读取全部聊天记录分析的耗时。
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+WORDS = ['今天', '跑步', '健身', '音乐', '电影', '餐厅', '旅行', '小说', '游戏', '编程', '工作', '加班', '学习',
+         '考试', '父母', '孩子', '医院', '哈哈', '开心', '谢谢', '不错', '好的', '郁闷', '累', '😄', '😊', '👍',
+         '我们', '一起', '明天', '晚上', '吃饭', '周末', '看看', '觉得', '还是', '已经', '可以']
+CONTACTS = [f'联系人{idx}' for idx in range(200)]
+
+
+def synthetic_messages(count, seed=42):
+    """生成 `count` 条合成消息（ChatMessage），约一半是发送的"""
+    from server import ChatMessage
+
+    rng = random.Random(seed)
+    for idx in range(count):
+        content = ''.join(rng.choice(WORDS) for _ in range(rng.randint(2, 12)))
+        yield ChatMessage(message_type=rng.choice(('sent', 'received')), content=content,
+                          timestamp=f'2024-{idx % 12 + 1:02d}-{idx % 28 + 1:02d} {idx % 24:02d}:{idx % 60:02d}:00',
+                          contact_name=rng.choice(CONTACTS))
+
+
+def legacy_import(db_path, user_id, messages):
+    """改进前的导入方式：默认日志模式的连接上逐条 execute，最后统一提交"""
+    from server import INSERT_CHAT_RECORD
+
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=DELETE')
+    cursor = conn.cursor()
+    imported_count = 0
+    for msg in messages:
+        try:
+            cursor.execute(INSERT_CHAT_RECORD, (user_id, msg.message_type, msg.content, msg.timestamp,
+                                                msg.contact_name))
+            imported_count += 1
+        except sqlite3.Error as e:
+            print(f'导入消息失败: {e}')
+    conn.commit()
+    conn.close()
+    return imported_count
+
+
+def import_rows(args):
+    import server
+
+    messages = list(synthetic_messages(args.rows))
+
+    legacy_db = os.path.join(os.path.dirname(server.DB_PATH), 'legacy.db')
+    server.DB_PATH, db_path = legacy_db, server.DB_PATH
+    server.init_database()
+    server.DB_PATH = db_path
+    start = time.perf_counter()
+    imported = legacy_import(legacy_db, 1, messages)
+    legacy_seconds = time.perf_counter() - start
+    print(f"legacy    rows={imported:<8} seconds={legacy_seconds:<7.2f} rows/sec={imported / legacy_seconds:.0f}")
+
+    start = time.perf_counter()
+    result = server.DigitalTwin(1).import_wechat_data(messages, batch_size=args.batch_size)
+    seconds = time.perf_counter() - start
+    print(f"batched   rows={result['imported_count']:<8} seconds={seconds:<7.2f} "
+          f"rows/sec={result['imported_count'] / seconds:.0f} speedup={legacy_seconds / seconds:.1f}x")
+
+    # 混入无法写入的消息（content 为 NULL）时，失败的批次逐条重试
+    broken = [msg if idx % 1000 else server.ChatMessage(msg.message_type, None, msg.timestamp, msg.contact_name)
+              for idx, msg in enumerate(messages)]
+    start = time.perf_counter()
+    result = server.DigitalTwin(2).import_wechat_data(broken, batch_size=args.batch_size)
+    seconds = time.perf_counter() - start
+    print(f"with_errors rows={result['imported_count']:<8} failed={result['failed_count']:<5} "
+          f"seconds={seconds:<7.2f} rows/sec={result['imported_count'] / seconds:.0f}")
+
+
+def write_export(path, format, messages):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        if format == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(['message_type', 'content', 'timestamp', 'contact_name'])
+            writer.writerows((msg.message_type, msg.content, msg.timestamp, msg.contact_name) for msg in messages)
+            return
+        if format == 'json':
+            f.write('[\n')
+        for idx, msg in enumerate(messages):
+            if format == 'json' and idx:
+                f.write(',\n')
+            f.write(json.dumps(msg.__dict__, ensure_ascii=False))
+            if format == 'jsonl':
+                f.write('\n')
+        if format == 'json':
+            f.write('\n]\n')
+
+
+def traced(coroutine):
+    """运行协程，返回其结果、耗时和 Python 内存分配的峰值（MB）"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = asyncio.run(coroutine)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return json.loads(result), seconds, peak / 1024 / 1024
+
+
+def import_files(args):
+    import server
+
+    tmp_dir = os.path.dirname(server.DB_PATH)
+    for user_id, format in enumerate(args.formats.split(','), 1):
+        path = os.path.join(tmp_dir, f'export.{format}')
+        write_export(path, format, synthetic_messages(args.file_rows))
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        result, seconds, peak_mb = traced(server.import_wechat_file(user_id, path, format))
+        print(f"file      format={format:<6} rows={result['imported_count']:<8} file_mb={size_mb:<7.1f} "
+              f"seconds={seconds:<7.2f} rows/sec={result['imported_count'] / seconds:<8.0f} peak_mb={peak_mb:.1f}")
+        if format == 'json':
+            with open(path, encoding='utf-8') as f:
+                messages_json = f.read()
+            result, seconds, peak_mb = traced(server.import_wechat_messages(user_id, messages_json))
+            print(f"string    format=json   rows={result['imported_count']:<8} file_mb={size_mb:<7.1f} "
+                  f"seconds={seconds:<7.2f} rows/sec={result['imported_count'] / seconds:<8.0f} peak_mb={peak_mb:.1f}")
+        os.remove(path)
+
+
+QUERIES = {
+    'analyze': "SELECT message_type, content, contact_name FROM chat_records WHERE user_id = ?",
+    'total': "SELECT COUNT(*) FROM chat_records WHERE user_id = ?",
+    'by_type': "SELECT message_type, COUNT(*) FROM chat_records WHERE user_id = ? GROUP BY message_type",
+    'contacts': "SELECT COUNT(DISTINCT contact_name) FROM chat_records WHERE user_id = ? AND contact_name != ''",
+}
+
+
+def time_queries(conn, users, label):
+    """对若干用户执行每条查询，报告查询计划和每次查询的平均耗时（毫秒）"""
+    sample = list(range(1, users + 1, max(1, users // 10)))
+    for name, sql in QUERIES.items():
+        plan = '; '.join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", (1,)))
+        start = time.perf_counter()
+        for user_id in sample:
+            conn.execute(sql, (user_id,)).fetchall()
+        ms = (time.perf_counter() - start) * 1000 / len(sample)
+        print(f"{label:<7} query={name:<9} ms={ms:<9.2f} plan={plan}")
+
+
+def query_plans(args):
+    import server
+
+    # 导入 server 时已经迁移了默认的数据库，另建一个不执行迁移的，得到迁移前的表结构
+    server.DB_PATH = os.path.join(os.path.dirname(server.DB_PATH), 'unmigrated.db')
+    migrations, server.MIGRATIONS = server.MIGRATIONS, []
+    server.init_database()
+    server.MIGRATIONS = migrations
+
+    conn = server.connect()
+    start = time.perf_counter()
+    with conn:
+        conn.executemany(server.INSERT_CHAT_RECORD, (
+            (idx % args.users + 1, msg.message_type, msg.content, msg.timestamp, msg.contact_name)
+            for idx, msg in enumerate(synthetic_messages(args.query_rows))))
+        # 迁移前的 INSERT OR REPLACE 每次分析都追加一行画像
+        conn.executemany("""
+            INSERT INTO user_profile (user_id, interests, personality, communication_style, frequent_topics, updated_at)
+            VALUES (?, '[]', '{}', '{}', '[]', ?)
+        """, ((user_id, f'2024-01-01 00:00:{run:02d}') for run in range(args.profile_runs)
+              for user_id in range(1, args.users + 1)))
+    print(f"setup   rows={args.query_rows} users={args.users} seconds={time.perf_counter() - start:.2f}")
+
+    time_queries(conn, args.users, 'before')
+    start = time.perf_counter()
+    server.migrate_database(conn)
+    profiles = conn.execute("SELECT COUNT(*) FROM user_profile").fetchone()[0]
+    print(f"migrate seconds={time.perf_counter() - start:.2f} profiles={args.users * args.profile_runs}->{profiles}")
+    time_queries(conn, args.users, 'after')
+
+    # 迁移后重复保存画像，仍然每个用户一行
+    start = time.perf_counter()
+    twin = server.DigitalTwin(1)
+    for _ in range(1000):
+        twin._save_user_profile(server.UserProfile([], {}, {}, []))
+    rows = conn.execute("SELECT COUNT(*) FROM user_profile WHERE user_id = 1").fetchone()[0]
+    print(f"upsert  saves=1000 ms_per_save={(time.perf_counter() - start):.3f} rows_for_user={rows}")
+    conn.close()
+
+
+def legacy_profile(lexicons, sent_messages, received_messages):
+    """改进前的用户画像分析：每个关键词和表情各扫描一遍拼接后的消息"""
+    sent_text = " ".join(sent_messages)
+    all_text = " ".join(sent_messages + received_messages)
+    interests = [interest for interest, keywords in lexicons["interests"].items()
+                 if any(keyword in sent_text for keyword in keywords)]
+    positive_count = sum(sent_text.count(word) for word in lexicons["positive"])
+    negative_count = sum(sent_text.count(word) for word in lexicons["negative"])
+    emoji_count = sum(msg.count("😄") + msg.count("😊") + msg.count("😢") +
+                      msg.count("👍") + msg.count("❤️") for msg in sent_messages)
+    topics = [topic for topic, keywords in lexicons["topics"].items()
+              if any(keyword in all_text for keyword in keywords)]
+    return interests, positive_count, negative_count, emoji_count, topics
+
+
+def matcher_profile(lexicons, matcher, sent_messages, received_messages):
+    sent_counts = matcher.count(sent_messages)
+    received_counts = matcher.count(received_messages)
+    interests = [interest for interest, keywords in lexicons["interests"].items()
+                 if any(sent_counts[keyword] for keyword in keywords)]
+    topics = [topic for topic, keywords in lexicons["topics"].items()
+              if any(sent_counts[keyword] + received_counts[keyword] for keyword in keywords)]
+    return (interests, sum(sent_counts[word] for word in lexicons["positive"]),
+            sum(sent_counts[word] for word in lexicons["negative"]),
+            sum(sent_counts[emoji] for emoji in lexicons["emoji"]), topics)
+
+
+def sparse_messages(count, keywords, seed=43):
+    """生成 `count` 条多数字不在词典中的消息，约三成带一个关键词，更接近真实的聊天记录"""
+    from server import ChatMessage
+
+    rng = random.Random(seed)
+    filler = '我们一起明天晚上周末看看觉得还是已经可以的了是在不有这个那么'
+    for idx in range(count):
+        content = ''.join(rng.choice(filler) for _ in range(rng.randint(4, 30)))
+        if rng.random() < 0.3:
+            content += rng.choice(keywords)
+        yield ChatMessage(message_type=rng.choice(('sent', 'received')), content=content,
+                          timestamp='2024-01-01 00:00:00')
+
+
+def overlapping_messages(count, keywords, seed=44):
+    """生成 `count` 条由关键词和关键词的后半截拼成的消息，如“工作”+“作者”的后半截，关键词的出现互相重叠"""
+    from server import ChatMessage
+
+    rng = random.Random(seed)
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(2, 6)):
+            keyword = rng.choice(keywords)
+            parts.append(keyword[rng.randrange(len(keyword)):] if rng.random() < 0.5 else keyword)
+        yield ChatMessage(message_type=rng.choice(('sent', 'received')), content=''.join(parts),
+                          timestamp='2024-01-01 00:00:00')
+
+
+def profile_analysis(args):
+    import server
+
+    lexicons = dict(server.DEFAULT_LEXICONS)
+    if args.extra_keywords:
+        # 加入不会出现在消息中的关键词，模拟配置了更大的词典
+        rng = random.Random(5)
+        extra = [chr(0x4e00 + rng.randrange(20000)) + chr(0x4e00 + rng.randrange(20000))
+                 for _ in range(args.extra_keywords)]
+        lexicons["interests"] = {**lexicons["interests"], "其他": extra}
+    matcher = server.KeywordMatcher(server.lexicon_keywords(lexicons))
+    default_keywords = server.lexicon_keywords(server.DEFAULT_LEXICONS)
+
+    for corpus, records in (('dense', synthetic_messages(args.profile_rows)),
+                            ('sparse', sparse_messages(args.profile_rows, default_keywords)),
+                            ('overlap', overlapping_messages(args.profile_rows, default_keywords))):
+        records = list(records)
+        sent = [msg.content for msg in records if msg.message_type == 'sent']
+        received = [msg.content for msg in records if msg.message_type == 'received']
+        chars = sum(map(len, sent)) + sum(map(len, received))
+        start = time.perf_counter()
+        legacy = legacy_profile(lexicons, sent, received)
+        legacy_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        result = matcher_profile(lexicons, matcher, sent, received)
+        seconds = time.perf_counter() - start
+        sent_text = " ".join(sent)
+        same_counts = matcher.count(sent) == {keyword: sent_text.count(keyword) for keyword in matcher.keywords}
+        print(f"profile corpus={corpus:<7} rows={len(records):<8} chars={chars:<10} keywords={len(matcher.keywords):<6} "
+              f"legacy_seconds={legacy_seconds:<7.2f} matcher_seconds={seconds:<7.2f} "
+              f"speedup={legacy_seconds / seconds:.2f}x same_profile={result == legacy} same_counts={same_counts}")
+
+
+def analyze_from_aggregates(args):
+    import server
+
+    messages = list(synthetic_messages(args.analyze_rows))
+    # 用户 2 在导入前已有一条没有汇总的聊天记录，导入时不累加汇总
+    conn = server.connect()
+    with conn:
+        conn.execute(server.INSERT_CHAT_RECORD, (2, 'sent', '你好', '2024-01-01 00:00:00', ''))
+    for user_id, label in ((2, 'import_without_aggregates'), (1, 'import_with_aggregates')):
+        start = time.perf_counter()
+        result = server.DigitalTwin(user_id).import_wechat_data(messages, batch_size=args.batch_size)
+        seconds = time.perf_counter() - start
+        print(f"{label:<26} rows={result['imported_count']:<8} seconds={seconds:<7.2f} "
+              f"rows/sec={result['imported_count'] / seconds:.0f}")
+
+    twin = server.DigitalTwin(1)
+    start = time.perf_counter()
+    profile = twin.analyze_user_profile()
+    print(f"{'analyze_from_aggregates':<26} ms={(time.perf_counter() - start) * 1000:.1f}")
+    start = time.perf_counter()
+    twin.rebuild_aggregates()
+    print(f"{'rebuild_aggregates':<26} seconds={time.perf_counter() - start:.2f}")
+
+    # 改进前每次分析都读取全部聊天记录并逐个关键词扫描
+    start = time.perf_counter()
+    records = conn.execute("SELECT message_type, content, contact_name FROM chat_records WHERE user_id = ?",
+                           (1,)).fetchall()
+    sent = [r[1] for r in records if r[0] == 'sent']
+    received = [r[1] for r in records if r[0] == 'received']
+    interests, _, _, _, topics = legacy_profile(server.LEXICONS, sent, received)
+    print(f"{'analyze_legacy':<26} seconds={time.perf_counter() - start:.2f} "
+          f"same_profile={(interests, topics) == (profile.interests, profile.frequent_topics)}")
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--file-rows', type=int, default=0, help='Import export files of this many rows instead')
+    parser.add_argument('--formats', type=str, default='jsonl,csv,json', help='Comma-separated export formats')
+    parser.add_argument('--query-rows', type=int, default=0, help='Time the queries before and after the migrations')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--profile-runs', type=int, default=20, help='Duplicate profile rows per user before migrating')
+    parser.add_argument('--profile-rows', type=int, default=0, help='Time the profile analysis of this many messages')
+    parser.add_argument('--extra-keywords', type=int, default=0, help='Keywords added to the lexicons for --profile-rows')
+    parser.add_argument('--analyze-rows', type=int, default=0, help='Time the profile analysis from aggregates')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # 服务器在导入时初始化数据库，所以先设置数据库路径
+        os.environ['DIGITAL_TWIN_DB'] = os.path.join(tmp_dir, 'digital_twin.db')
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        if args.analyze_rows:
+            analyze_from_aggregates(args)
+        elif args.profile_rows:
+            profile_analysis(args)
+        elif args.query_rows:
+            query_plans(args)
+        elif args.file_rows:
+            import_files(args)
+        else:
+            import_rows(args)
+
+
+if __name__ == "__main__":
+    main()
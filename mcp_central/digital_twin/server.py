@@ -1,20 +1,50 @@
+import asyncio
+import csv
+import hashlib
 import json
+import os
+import re
 import sqlite3
+import time
+from collections import Counter
 from datetime import datetime
-from typing import Dict, List, Any
+from itertools import islice
+from typing import Dict, List, Any, Iterable, Union, Optional, Callable
 from dataclasses import dataclass, asdict
 
-from fastmcp import FastMCP
+from fastmcp import Context, FastMCP
 
 mcp = FastMCP("digital_twin")
 
 # 数据库初始化
-DB_PATH = "digital_twin.db"
+DB_PATH = os.environ.get("DIGITAL_TWIN_DB", "digital_twin.db")
+# 批量导入时每个事务写入的消息条数
+IMPORT_BATCH_SIZE = int(os.environ.get("DIGITAL_TWIN_IMPORT_BATCH_SIZE", 5000))
+# SQLite页缓存大小（KB）
+CACHE_SIZE_KB = int(os.environ.get("DIGITAL_TWIN_CACHE_SIZE_KB", 64 * 1024))
+# 导入结果中最多返回的失败消息数
+MAX_IMPORT_ERRORS = 20
+# 流式导入时每次从文件读取的字符数，以及单条消息的最大字符数
+IMPORT_READ_CHARS = 256 * 1024
+MAX_RECORD_CHARS = 16 * 1024 * 1024
+EXPORT_FORMATS = ("jsonl", "csv", "json")
+# 用户画像分析使用的词典文件（JSON），其中的词典替换同名的默认词典
+LEXICONS_PATH = os.environ.get("DIGITAL_TWIN_LEXICONS", "")
+
+
+def connect() -> sqlite3.Connection:
+    """打开数据库连接：WAL日志模式下读写互不阻塞，synchronous=NORMAL时每个事务提交不再等待磁盘同步"""
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
 
 
 def init_database():
     """初始化数据库"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect()
     cursor = conn.cursor()
     
     # 创建用户表
@@ -55,9 +85,80 @@ def init_database():
     """)
     
     conn.commit()
+    migrate_database(conn)
     conn.close()
 
 
+# 数据库结构迁移，按顺序执行，PRAGMA user_version 记录已执行的迁移数
+MIGRATIONS = [
+    # 1: 按用户查询聊天记录的索引；用户画像每个用户只保留最新的一行，并加唯一索引
+    """
+    CREATE INDEX IF NOT EXISTS chat_records_user_type ON chat_records (user_id, message_type);
+    CREATE INDEX IF NOT EXISTS chat_records_user_contact ON chat_records (user_id, contact_name);
+    DELETE FROM user_profile WHERE EXISTS (
+        SELECT 1 FROM user_profile AS newer
+        WHERE newer.user_id IS user_profile.user_id
+          AND (newer.updated_at > user_profile.updated_at
+               OR (newer.updated_at = user_profile.updated_at AND newer.id > user_profile.id))
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS user_profile_user ON user_profile (user_id);
+    """,
+    # 2: 分析用户画像使用的汇总，导入时累加；keywords 为统计时词典关键词和计数规则的指纹，与当前的不同时重新统计
+    """
+    CREATE TABLE IF NOT EXISTS user_aggregates (
+        user_id INTEGER PRIMARY KEY,
+        keywords TEXT NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS user_message_stats (
+        user_id INTEGER,
+        message_type TEXT,
+        message_count INTEGER NOT NULL,
+        total_length INTEGER NOT NULL,
+        PRIMARY KEY (user_id, message_type)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS user_keyword_counts (
+        user_id INTEGER,
+        message_type TEXT,
+        keyword TEXT,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (user_id, message_type, keyword)
+    ) WITHOUT ROWID;
+    """,
+]
+
+
+def migrate_database(conn: sqlite3.Connection):
+    """执行数据库尚未执行的迁移，每个迁移在一个事务中完成"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, script in enumerate(MIGRATIONS[version:], version + 1):
+        try:
+            conn.executescript(f"BEGIN IMMEDIATE;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+
+INSERT_CHAT_RECORD = """
+    INSERT INTO chat_records (user_id, message_type, content, timestamp, contact_name)
+    VALUES (?, ?, ?, ?, ?)
+"""
+# 导入的消息按（用户，消息类型）累加到汇总中
+ADD_MESSAGE_STATS = """
+    INSERT INTO user_message_stats (user_id, message_type, message_count, total_length)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id, message_type) DO UPDATE SET
+        message_count = message_count + excluded.message_count,
+        total_length = total_length + excluded.total_length
+"""
+ADD_KEYWORD_COUNT = """
+    INSERT INTO user_keyword_counts (user_id, message_type, keyword, count)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id, message_type, keyword) DO UPDATE SET count = count + excluded.count
+"""
+
+
 @dataclass
 class ChatMessage:
     """聊天消息数据结构"""
@@ -67,6 +168,246 @@ class ChatMessage:
     contact_name: str = ""
 
 
+def message_fields(record: Union[ChatMessage, Dict[str, Any]]) -> tuple:
+    """导入的一条记录的 (message_type, content, timestamp, contact_name)，字典中多余的字段被忽略"""
+    if isinstance(record, ChatMessage):
+        return record.message_type, record.content, record.timestamp, record.contact_name
+    if not isinstance(record, dict):
+        raise TypeError(f"消息应为JSON对象，而不是 {type(record).__name__}")
+    try:
+        return record["message_type"], record["content"], record["timestamp"], record.get("contact_name", "")
+    except KeyError as e:
+        raise ValueError(f"消息缺少字段 {e}")
+
+
+class ExportReader:
+    """逐条读取微信聊天记录导出文件，内存占用与文件大小无关
+
+    支持三种格式：
+    - jsonl: 每行一个JSON对象，无法解析的行作为失败的消息报告
+    - csv: 表头包含 message_type、content、timestamp、contact_name 列
+    - json: 消息对象组成的JSON数组，按块读取并逐个解析数组元素
+
+    文件结构损坏（如JSON数组不完整）时停止读取，原因记录在 `error` 中。
+    """
+
+    def __init__(self, f, format: str):
+        self.f = f
+        self.format = format
+        self.error: Optional[str] = None
+
+    @staticmethod
+    def detect_format(path: str, format: str = "auto") -> str:
+        if format != "auto":
+            if format not in EXPORT_FORMATS:
+                raise ValueError(f"不支持的格式: {format}，可选 auto、{'、'.join(EXPORT_FORMATS)}")
+            return format
+        extension = os.path.splitext(path)[1].lower()
+        if extension in (".jsonl", ".ndjson"):
+            return "jsonl"
+        if extension == ".csv":
+            return "csv"
+        # .json 文件可能是数组，也可能每行一个对象
+        with open(path, encoding="utf-8-sig") as f:
+            head = f.read(IMPORT_READ_CHARS).lstrip()
+        return "json" if head.startswith("[") else "jsonl"
+
+    @property
+    def position(self) -> int:
+        """已读取的字节数（按缓冲区计算，略大于已解析的部分）"""
+        return self.f.buffer.tell()
+
+    def __iter__(self):
+        try:
+            if self.format == "jsonl":
+                yield from self._read_jsonl()
+            elif self.format == "csv":
+                yield from csv.DictReader(self.f)
+            else:
+                yield from self._read_json_array()
+        except (ValueError, csv.Error) as e:
+            self.error = str(e)
+
+    def _read_jsonl(self):
+        for line_number, line in enumerate(self.f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                yield ValueError(f"第{line_number}行不是有效的JSON: {e}")
+
+    def _read_json_array(self):
+        decoder = json.JSONDecoder()
+        buffer = self.f.read(IMPORT_READ_CHARS).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError("JSON文件应为消息数组")
+        pos = 1
+        eof = False
+        count = 0
+        while True:
+            # 跳过元素之间的空白和逗号，缓冲区读完时继续读取
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError("JSON数组不完整")
+                buffer = self.f.read(IMPORT_READ_CHARS)
+                pos = 0
+                eof = not buffer
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                record, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                # 元素可能被缓冲区截断，读取更多内容后重试
+                if eof or len(buffer) - pos > MAX_RECORD_CHARS:
+                    raise ValueError(f"第{count + 1}条消息不是有效的JSON: {e}")
+                more = self.f.read(IMPORT_READ_CHARS)
+                eof = not more
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+            count += 1
+            yield record
+            if pos > IMPORT_READ_CHARS:
+                buffer = buffer[pos:]
+                pos = 0
+
+
+# 用户画像分析使用的默认词典：兴趣和话题按类别列出关键词，情绪词和表情用于判断情绪倾向和表情使用
+DEFAULT_LEXICONS: Dict[str, Any] = {
+    "interests": {
+        "运动": ["跑步", "健身", "篮球", "足球", "游泳", "瑜伽", "爬山"],
+        "音乐": ["音乐", "歌曲", "演唱会", "乐器", "唱歌"],
+        "电影": ["电影", "影院", "导演", "演员", "剧情"],
+        "美食": ["美食", "餐厅", "做饭", "菜谱", "好吃"],
+        "旅游": ["旅游", "旅行", "景点", "酒店", "机票"],
+        "读书": ["读书", "书籍", "小说", "作者", "阅读"],
+        "游戏": ["游戏", "手游", "电竞", "主机"],
+        "科技": ["科技", "手机", "电脑", "AI", "编程"]
+    },
+    "topics": {
+        "工作": ["工作", "上班", "加班", "同事", "老板", "项目"],
+        "生活": ["吃饭", "睡觉", "家里", "购物", "日常"],
+        "学习": ["学习", "考试", "课程", "培训", "技能"],
+        "感情": ["男朋友", "女朋友", "恋爱", "结婚", "分手"],
+        "家庭": ["父母", "家人", "孩子", "亲戚"],
+        "健康": ["身体", "医院", "生病", "锻炼", "健康"]
+    },
+    "positive": ["哈哈", "😄", "开心", "棒", "好的", "谢谢", "不错"],
+    "negative": ["郁闷", "烦", "累", "难受", "😢"],
+    "emoji": ["😄", "😊", "😢", "👍", "❤️"],
+}
+
+
+def load_lexicons(path: str = LEXICONS_PATH) -> Dict[str, Any]:
+    """读取词典，`path` 中的词典替换同名的默认词典"""
+    lexicons = dict(DEFAULT_LEXICONS)
+    if not path:
+        return lexicons
+    with open(path, encoding="utf-8") as f:
+        overrides = json.load(f)
+    for name, lexicon in overrides.items():
+        if name not in DEFAULT_LEXICONS:
+            raise ValueError(f"未知的词典: {name}，可选 {'、'.join(DEFAULT_LEXICONS)}")
+        if not isinstance(lexicon, type(DEFAULT_LEXICONS[name])):
+            raise ValueError(f"词典 {name} 应为{'类别到关键词列表的对象' if name in ('interests', 'topics') else '关键词列表'}")
+        lexicons[name] = lexicon
+    return lexicons
+
+
+def lexicon_keywords(lexicons: Dict[str, Any]) -> List[str]:
+    """词典中出现的所有关键词，去重并保持顺序"""
+    keywords = []
+    for lexicon in lexicons.values():
+        groups = lexicon.values() if isinstance(lexicon, dict) else [lexicon]
+        for group in groups:
+            keywords.extend(group)
+    return list(dict.fromkeys(keyword for keyword in keywords if keyword))
+
+
+class KeywordMatcher:
+    """多关键词匹配器，一次扫描得到每个关键词的出现次数，与对每个关键词调用 `str.count` 的结果相同
+
+    所有关键词构成一棵字典树，编译为一个正则表达式：正则引擎按关键词首字的字符集跳过不可能开始关键词的字，
+    在其余每个位置取从该位置开始的最长关键词，每次只前进一个字，所以关键词的出现互相重叠时
+    （如“工作者”中的“工作”和“作者”）都能找到。同一位置开始的更短关键词都是最长关键词的前缀，一并计数。
+    `str.count` 不计同一关键词互相重叠的出现，只有首尾相同的关键词（如“哈哈”）才会这样重叠，它们直接用 `str.count`。
+    匹配不跨越消息。
+    """
+
+    # 连接消息的分隔符，不会出现在关键词中，所以匹配不会跨越消息
+    SEPARATOR = "\x00"
+    # 计数规则的版本：版本1从左到右取互不重叠的最长关键词，少计了重叠的关键词
+    COUNT_VERSION = 2
+
+    def __init__(self, keywords: Iterable[str]):
+        self.keywords = list(dict.fromkeys(keyword for keyword in keywords if keyword))
+        if any(self.SEPARATOR in keyword for keyword in self.keywords):
+            raise ValueError("关键词不能包含NUL字符")
+        trie: Dict[str, Any] = {}
+        for keyword in self.keywords:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[""] = {}
+        self._pattern = None
+        if self.keywords:
+            first_chars = re.escape("".join(sorted(trie)))
+            # 匹配首字，再回到首字之前在前瞻中取最长的关键词：匹配的宽度总是一个字
+            self._pattern = re.compile(f"[{first_chars}](?<=(?=({self._trie_pattern(trie)})).)")
+        keyword_set = set(self.keywords)
+        # 最长关键词 -> 从同一位置开始的关键词（含自身）
+        self._prefixes = {keyword: [keyword[:idx] for idx in range(1, len(keyword) + 1) if keyword[:idx] in keyword_set]
+                          for keyword in self.keywords}
+        # 首尾相同、自身的出现可能互相重叠的关键词
+        self._overlapping = [keyword for keyword in self.keywords
+                             if any(keyword[:idx] == keyword[-idx:] for idx in range(1, len(keyword)))]
+        # 关键词集合和计数规则的指纹，任何一个改变时按旧指纹累加的汇总都要重新统计
+        self.fingerprint = hashlib.sha256("\n".join([f"count-v{self.COUNT_VERSION}", *sorted(self.keywords)])
+                                          .encode("utf-8")).hexdigest()[:16]
+
+    @classmethod
+    def _trie_pattern(cls, node: Dict[str, Any]) -> str:
+        """字典树节点的正则表达式，先尝试更长的关键词"""
+        branches = [re.escape(char) + cls._trie_pattern(child) for char, child in node.items() if char]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        # 在此结束的关键词：更长的关键词都不匹配时才取它
+        return f"(?:{pattern})?" if "" in node else pattern
+
+    def count(self, texts: Iterable[str]) -> Dict[str, int]:
+        """统计各关键词在 `texts` 中的出现次数"""
+        counts = dict.fromkeys(self.keywords, 0)
+        if self._pattern is None:
+            return counts
+        text = self.SEPARATOR.join(texts)
+        for longest, occurrences in Counter(self._pattern.findall(text)).items():
+            for keyword in self._prefixes[longest]:
+                counts[keyword] += occurrences
+        for keyword in self._overlapping:
+            counts[keyword] = text.count(keyword)
+        return counts
+
+
+LEXICONS = load_lexicons()
+MATCHER = KeywordMatcher(lexicon_keywords(LEXICONS))
+
+
+def message_aggregates(rows: Iterable[tuple]) -> Dict[str, tuple]:
+    """按消息类型汇总 (message_type, content) 行，得到（消息数，总长度，各关键词的次数）"""
+    contents: Dict[str, List[str]] = {}
+    for message_type, content in rows:
+        contents.setdefault(message_type, []).append(str(content))
+    return {
+        message_type: (len(texts), sum(map(len, texts)), MATCHER.count(texts))
+        for message_type, texts in contents.items()
+    }
+
+
 @dataclass
 class UserProfile:
     """用户画像数据结构"""
@@ -81,62 +422,169 @@ class DigitalTwin:
     
     def __init__(self, user_id: int):
         self.user_id = user_id
-        self.conn = sqlite3.connect(DB_PATH)
+        self.conn = connect()
         
     def __del__(self):
         if hasattr(self, 'conn'):
             self.conn.close()
     
-    def import_wechat_data(self, messages: List[ChatMessage]) -> Dict[str, Any]:
-        """导入微信聊天记录"""
-        cursor = self.conn.cursor()
+    def import_wechat_data(self, messages: Iterable[Union[ChatMessage, Dict[str, Any], Exception]],
+                           batch_size: int = IMPORT_BATCH_SIZE,
+                           progress: Optional[Callable[[int, int], None]] = None) -> Dict[str, Any]:
+        """导入微信聊天记录
+
+        消息可以是ChatMessage、字典或读取该消息时的异常，按批读取，内存占用只与批大小有关。每批消息用一次executemany写入，
+        一批一个事务。某批写入失败时回滚该批，再在一个事务中逐条重试，这样失败的消息仍能逐条报告，
+        其余消息照常导入。导入的消息在同一事务中累加到用户画像的汇总。每批写入后以（已处理条数，已导入条数）调用 `progress`。
+        """
+        # 还没有聊天记录的用户先以当前词典开始汇总
+        self._aggregates_current()
         imported_count = 0
-        
-        for msg in messages:
+        total_messages = 0
+        failed_count = 0
+        errors = []
+        messages = iter(messages)
+        
+        while True:
+            batch = list(islice(messages, batch_size))
+            if not batch:
+                break
+            batch_errors = []
+            rows = []
+            indexes = []
+            for index, record in enumerate(batch, total_messages):
+                # 读取失败的记录以其异常表示
+                if isinstance(record, Exception):
+                    batch_errors.append({"index": index, "error": str(record)})
+                    continue
+                try:
+                    rows.append((self.user_id, *message_fields(record)))
+                except (TypeError, ValueError) as e:
+                    batch_errors.append({"index": index, "error": str(e)})
+                    continue
+                indexes.append(index)
             try:
-                cursor.execute("""
-                    INSERT INTO chat_records (user_id, message_type, content, timestamp, contact_name)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (self.user_id, msg.message_type, msg.content, msg.timestamp, msg.contact_name))
-                imported_count += 1
-            except sqlite3.Error as e:
-                print(f"导入消息失败: {e}")
-                
-        self.conn.commit()
+                with self.conn:
+                    self.conn.executemany(INSERT_CHAT_RECORD, rows)
+                    if self._aggregates_writable():
+                        self._add_aggregates(rows)
+                imported_count += len(rows)
+            except sqlite3.Error:
+                # 约束错误只回滚出错的那条语句，事务本身继续
+                with self.conn:
+                    inserted = []
+                    for index, row in zip(indexes, rows):
+                        try:
+                            self.conn.execute(INSERT_CHAT_RECORD, row)
+                            inserted.append(row)
+                        except sqlite3.Error as e:
+                            batch_errors.append({"index": index, "error": str(e)})
+                    if inserted and self._aggregates_writable():
+                        self._add_aggregates(inserted)
+                imported_count += len(inserted)
+            total_messages += len(batch)
+            failed_count += len(batch_errors)
+            batch_errors.sort(key=lambda error: error["index"])
+            errors.extend(batch_errors[:MAX_IMPORT_ERRORS - len(errors)])
+            if progress is not None:
+                progress(total_messages, imported_count)
+        
         return {
             "imported_count": imported_count,
-            "total_messages": len(messages),
+            "total_messages": total_messages,
+            "failed_count": failed_count,
+            "errors": errors,
             "success": True
         }
     
+    def _aggregates_current(self) -> bool:
+        """用户画像的汇总是否按当前词典统计；没有聊天记录的用户直接以当前词典开始汇总"""
+        row = self.conn.execute("SELECT keywords FROM user_aggregates WHERE user_id = ?", (self.user_id,)).fetchone()
+        if row is not None:
+            return row[0] == MATCHER.fingerprint
+        if self.conn.execute("SELECT 1 FROM chat_records WHERE user_id = ? LIMIT 1", (self.user_id,)).fetchone():
+            return False
+        with self.conn:
+            self.conn.execute("""
+                INSERT INTO user_aggregates (user_id, keywords, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO NOTHING
+            """, (self.user_id, MATCHER.fingerprint, datetime.now().isoformat()))
+        return True
+    
+    def _aggregates_writable(self) -> bool:
+        """写入聊天记录后、在同一事务中调用：汇总是否按当前词典统计，是则把这些行累加进去
+
+        写入已取得写锁，检查到提交之间 rebuild_aggregates 无法提交，导入中途重新统计后的批次照常累加。
+        汇总需要重新统计时不累加，分析用户画像时从全部聊天记录重新统计。
+        """
+        row = self.conn.execute("SELECT keywords FROM user_aggregates WHERE user_id = ?", (self.user_id,)).fetchone()
+        return row is not None and row[0] == MATCHER.fingerprint
+    
+    def _add_aggregates(self, rows: List[tuple]):
+        """把写入的 chat_records 行累加到汇总中，在写入这些行的事务中调用"""
+        for message_type, (message_count, total_length, counts) in message_aggregates(
+                (row[1], row[2]) for row in rows).items():
+            self.conn.execute(ADD_MESSAGE_STATS, (self.user_id, message_type, message_count, total_length))
+            self.conn.executemany(ADD_KEYWORD_COUNT, (
+                (self.user_id, message_type, keyword, count) for keyword, count in counts.items() if count))
+    
+    def rebuild_aggregates(self) -> int:
+        """按当前词典从全部聊天记录重新统计汇总，返回统计的消息数"""
+        total = 0
+        with self.conn:
+            self.conn.execute("DELETE FROM user_message_stats WHERE user_id = ?", (self.user_id,))
+            self.conn.execute("DELETE FROM user_keyword_counts WHERE user_id = ?", (self.user_id,))
+            # 删除后事务已持有写锁，统计期间导入的消息在事务提交后才写入
+            cursor = self.conn.execute("SELECT user_id, message_type, content FROM chat_records WHERE user_id = ?",
+                                       (self.user_id,))
+            while True:
+                rows = cursor.fetchmany(IMPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                self._add_aggregates(rows)
+                total += len(rows)
+            self.conn.execute("""
+                INSERT INTO user_aggregates (user_id, keywords, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET keywords = excluded.keywords, updated_at = excluded.updated_at
+            """, (self.user_id, MATCHER.fingerprint, datetime.now().isoformat()))
+        return total
+    
     def analyze_user_profile(self) -> UserProfile:
-        """分析用户画像"""
+        """分析用户画像
+
+        基于导入时累加的汇总（各类消息的条数、总长度和关键词次数），耗时只与词典大小有关。
+        汇总不是按当前词典统计的（如修改了词典，或导入于汇总之前的聊天记录）时先重新统计。
+        """
+        if not self._aggregates_current():
+            self.rebuild_aggregates()
         cursor = self.conn.cursor()
         
-        # 获取所有聊天记录
-        cursor.execute("""
-            SELECT message_type, content, contact_name 
-            FROM chat_records 
-            WHERE user_id = ?
-        """, (self.user_id,))
-        
-        records = cursor.fetchall()
-        
-        # 简单的文本分析来构建用户画像
-        sent_messages = [r[1] for r in records if r[0] == 'sent']
-        received_messages = [r[1] for r in records if r[0] == 'received']
+        cursor.execute("SELECT message_type, message_count, total_length FROM user_message_stats WHERE user_id = ?",
+                       (self.user_id,))
+        stats = {message_type: (message_count, total_length) for message_type, message_count, total_length in cursor}
+        counts: Dict[str, Dict[str, int]] = {'sent': {}, 'received': {}}
+        cursor.execute("SELECT message_type, keyword, count FROM user_keyword_counts WHERE user_id = ?",
+                       (self.user_id,))
+        for message_type, keyword, count in cursor:
+            counts.setdefault(message_type, {})[keyword] = count
+        
+        # 简单的文本分析来构建用户画像：发送的消息决定兴趣、性格和沟通风格，全部消息决定常聊话题
+        sent_counts = counts['sent']
+        all_counts = dict(sent_counts)
+        for keyword, count in counts['received'].items():
+            all_counts[keyword] = all_counts.get(keyword, 0) + count
         
         # 分析兴趣爱好（基于关键词）
-        interests = self._extract_interests(sent_messages)
+        interests = self._extract_interests(sent_counts)
         
         # 分析性格特征
-        personality = self._analyze_personality(sent_messages)
+        personality = self._analyze_personality(sent_counts)
         
         # 分析沟通风格
-        communication_style = self._analyze_communication_style(sent_messages)
+        communication_style = self._analyze_communication_style(sent_counts, *stats.get('sent', (0, 0)))
         
         # 分析常聊话题
-        frequent_topics = self._extract_topics(sent_messages + received_messages)
+        frequent_topics = self._extract_topics(all_counts)
         
         profile = UserProfile(
             interests=interests,
@@ -150,32 +598,18 @@ class DigitalTwin:
         
         return profile
     
-    def _extract_interests(self, messages: List[str]) -> List[str]:
-        """提取兴趣爱好"""
-        interest_keywords = {
-            "运动": ["跑步", "健身", "篮球", "足球", "游泳", "瑜伽", "爬山"],
-            "音乐": ["音乐", "歌曲", "演唱会", "乐器", "唱歌"],
-            "电影": ["电影", "影院", "导演", "演员", "剧情"],
-            "美食": ["美食", "餐厅", "做饭", "菜谱", "好吃"],
-            "旅游": ["旅游", "旅行", "景点", "酒店", "机票"],
-            "读书": ["读书", "书籍", "小说", "作者", "阅读"],
-            "游戏": ["游戏", "手游", "电竞", "主机"],
-            "科技": ["科技", "手机", "电脑", "AI", "编程"]
-        }
-        
+    def _extract_interests(self, counts: Dict[str, int]) -> List[str]:
+        """提取兴趣爱好，`counts` 为关键词的出现次数"""
         interests = []
-        text = " ".join(messages)
         
-        for interest, keywords in interest_keywords.items():
-            if any(keyword in text for keyword in keywords):
+        for interest, keywords in LEXICONS["interests"].items():
+            if any(counts.get(keyword) for keyword in keywords):
                 interests.append(interest)
                 
         return interests
     
-    def _analyze_personality(self, messages: List[str]) -> Dict[str, Any]:
-        """分析性格特征"""
-        text = " ".join(messages)
-        
+    def _analyze_personality(self, counts: Dict[str, int]) -> Dict[str, Any]:
+        """分析性格特征，`counts` 为关键词的出现次数"""
         personality = {
             "活跃度": "中等",
             "幽默感": "一般",
@@ -183,11 +617,8 @@ class DigitalTwin:
         }
         
         # 简单的情感分析
-        positive_words = ["哈哈", "😄", "开心", "棒", "好的", "谢谢", "不错"]
-        negative_words = ["郁闷", "烦", "累", "难受", "😢"]
-        
-        positive_count = sum(text.count(word) for word in positive_words)
-        negative_count = sum(text.count(word) for word in negative_words)
+        positive_count = sum(counts.get(word, 0) for word in LEXICONS["positive"])
+        negative_count = sum(counts.get(word, 0) for word in LEXICONS["negative"])
         
         if positive_count > negative_count * 2:
             personality["情绪倾向"] = "积极乐观"
@@ -198,41 +629,30 @@ class DigitalTwin:
             
         return personality
     
-    def _analyze_communication_style(self, messages: List[str]) -> Dict[str, Any]:
-        """分析沟通风格"""
-        if not messages:
+    def _analyze_communication_style(self, counts: Dict[str, int], message_count: int,
+                                     total_length: int) -> Dict[str, Any]:
+        """分析沟通风格，`counts` 为关键词的出现次数"""
+        if not message_count:
             return {"风格": "数据不足"}
             
-        total_length = sum(len(msg) for msg in messages)
-        avg_length = total_length / len(messages)
+        avg_length = total_length / message_count
         
-        emoji_count = sum(msg.count("😄") + msg.count("😊") + msg.count("😢") + 
-                         msg.count("👍") + msg.count("❤️") for msg in messages)
+        emoji_count = sum(counts.get(emoji, 0) for emoji in LEXICONS["emoji"])
         
         style = {
             "消息长度": "简洁" if avg_length < 20 else "详细",
-            "表情使用": "频繁" if emoji_count > len(messages) * 0.3 else "适中",
+            "表情使用": "频繁" if emoji_count > message_count * 0.3 else "适中",
             "回复速度": "及时"  # 这里可以基于时间戳分析
         }
         
         return style
     
-    def _extract_topics(self, messages: List[str]) -> List[str]:
-        """提取常聊话题"""
+    def _extract_topics(self, counts: Dict[str, int]) -> List[str]:
+        """提取常聊话题，`counts` 为关键词的出现次数"""
         topics = []
-        text = " ".join(messages)
-        
-        topic_keywords = {
-            "工作": ["工作", "上班", "加班", "同事", "老板", "项目"],
-            "生活": ["吃饭", "睡觉", "家里", "购物", "日常"],
-            "学习": ["学习", "考试", "课程", "培训", "技能"],
-            "感情": ["男朋友", "女朋友", "恋爱", "结婚", "分手"],
-            "家庭": ["父母", "家人", "孩子", "亲戚"],
-            "健康": ["身体", "医院", "生病", "锻炼", "健康"]
-        }
         
-        for topic, keywords in topic_keywords.items():
-            if any(keyword in text for keyword in keywords):
+        for topic, keywords in LEXICONS["topics"].items():
+            if any(counts.get(keyword) for keyword in keywords):
                 topics.append(topic)
                 
         return topics
@@ -242,9 +662,15 @@ class DigitalTwin:
         cursor = self.conn.cursor()
         
         cursor.execute("""
-            INSERT OR REPLACE INTO user_profile 
+            INSERT INTO user_profile 
             (user_id, interests, personality, communication_style, frequent_topics, updated_at)
             VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                interests = excluded.interests,
+                personality = excluded.personality,
+                communication_style = excluded.communication_style,
+                frequent_topics = excluded.frequent_topics,
+                updated_at = excluded.updated_at
         """, (
             self.user_id,
             json.dumps(profile.interests, ensure_ascii=False),
@@ -330,7 +756,7 @@ init_database()
 @mcp.tool(description="创建新用户并返回用户ID")
 async def create_user(name: str, phone: str = "") -> str:
     """创建新用户"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect()
     cursor = conn.cursor()
     
     try:
@@ -376,6 +802,52 @@ async def import_wechat_messages(user_id: int, messages_json: str) -> str:
         }, ensure_ascii=False)
 
 
+@mcp.tool(description="从微信聊天记录导出文件流式导入消息，适合几百MB的大文件。path为服务器上的文件路径，"
+                      "format可选auto（按扩展名判断）、jsonl（每行一个消息对象）、csv（表头含message_type、content、"
+                      "timestamp、contact_name）或json（消息对象数组）。导入过程中按批报告进度")
+async def import_wechat_file(user_id: int, path: str, format: str = "auto", ctx: Optional[Context] = None) -> str:
+    """从导出文件流式导入微信聊天记录"""
+    try:
+        format = ExportReader.detect_format(path, format)
+        size = os.path.getsize(path)
+    except (OSError, ValueError) as e:
+        return json.dumps({
+            "success": False,
+            "error": f"导入失败: {str(e)}"
+        }, ensure_ascii=False)
+    
+    loop = asyncio.get_running_loop()
+    
+    def import_file():
+        # 导入在工作线程中进行，连接也在该线程中创建和使用
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            reader = ExportReader(f, format)
+            
+            def progress(processed, imported):
+                if ctx is not None:
+                    asyncio.run_coroutine_threadsafe(
+                        ctx.report_progress(reader.position, size, f"已处理 {processed} 条，导入 {imported} 条"), loop)
+            
+            result = DigitalTwin(user_id).import_wechat_data(reader, progress=progress)
+        if reader.error:
+            result["success"] = False
+            result["error"] = f"文件读取中断，之前的消息已导入: {reader.error}"
+        return result
+    
+    start = time.perf_counter()
+    try:
+        result = await asyncio.to_thread(import_file)
+    except (OSError, sqlite3.Error) as e:
+        return json.dumps({
+            "success": False,
+            "error": f"导入失败: {str(e)}"
+        }, ensure_ascii=False)
+    result["format"] = format
+    result["file_bytes"] = size
+    result["seconds"] = round(time.perf_counter() - start, 2)
+    return json.dumps(result, ensure_ascii=False)
+
+
 @mcp.tool(description="分析用户画像，基于已导入的聊天记录")
 async def analyze_user(user_id: int) -> str:
     """分析用户画像"""
@@ -395,6 +867,38 @@ async def analyze_user(user_id: int) -> str:
         }, ensure_ascii=False)
 
 
+@mcp.tool(description="按当前词典从聊天记录重新统计分析用户画像使用的汇总，修改词典后使用。user_id为0时统计所有用户")
+async def rebuild_profile_aggregates(user_id: int = 0) -> str:
+    """重新统计用户画像的汇总"""
+    
+    def rebuild():
+        # 统计在工作线程中进行，连接也在该线程中创建和使用
+        if user_id:
+            user_ids = [user_id]
+        else:
+            conn = connect()
+            user_ids = [row[0] for row in conn.execute(
+                "SELECT DISTINCT user_id FROM chat_records UNION SELECT user_id FROM user_aggregates")]
+            conn.close()
+        messages = sum(DigitalTwin(uid).rebuild_aggregates() for uid in user_ids)
+        return len(user_ids), messages
+    
+    start = time.perf_counter()
+    try:
+        users, messages = await asyncio.to_thread(rebuild)
+    except sqlite3.Error as e:
+        return json.dumps({
+            "success": False,
+            "error": f"统计失败: {str(e)}"
+        }, ensure_ascii=False)
+    return json.dumps({
+        "success": True,
+        "users": users,
+        "messages": messages,
+        "seconds": round(time.perf_counter() - start, 2)
+    }, ensure_ascii=False)
+
+
 @mcp.tool(description="基于用户画像提供个性化问答")
 async def personalized_qa(user_id: int, question: str) -> str:
     """个性化问答"""
@@ -418,7 +922,7 @@ async def personalized_qa(user_id: int, question: str) -> str:
 async def get_chat_stats(user_id: int) -> str:
     """获取聊天统计信息"""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = connect()
         cursor = conn.cursor()
         
         # 统计总消息数
@@ -6,7 +6,7 @@
 
 import json
 import asyncio
-from server import create_user, import_wechat_messages, analyze_user, personalized_qa, get_chat_stats
+from server import MATCHER, create_user, import_wechat_messages, analyze_user, personalized_qa, get_chat_stats
 
 
 async def test_digital_twin():
@@ -141,6 +141,18 @@ async def test_digital_twin():
         else:
             print(f"❌ 回答失败: {qa_data['error']}")
     
+    # 6. 关键词计数应与逐个关键词调用 str.count 相同，包括互相重叠的关键词
+    print("\n6. 检查关键词计数...")
+    texts = ["我是一个文字工作者", "每天健身体力好", "哈哈哈哈哈"]
+    counts = MATCHER.count(texts)
+    expected = {keyword: sum(text.count(keyword) for text in texts) for keyword in MATCHER.keywords}
+    if counts != expected:
+        mismatched = {keyword: (counts[keyword], expected[keyword])
+                      for keyword in expected if counts[keyword] != expected[keyword]}
+        print(f"❌ 关键词计数与 str.count 不同: {mismatched}")
+        return
+    print("✅ 关键词计数与 str.count 相同")
+    
     print("\n" + "=" * 50)
     print("🎉 测试完成！数字分身已经可以根据你的聊天记录提供个性化建议了。")
 
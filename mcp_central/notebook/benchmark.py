@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Benchmark the notebook server with many concurrent sessions.
+
+    python benchmark.py --sessions 200 --workers 32 --steps 4 --substeps 3
+
+The notebooks are persisted to a temporary state db (see --state-db), whose sessions are then all resumed by a
+fresh registry as after a restart.
+
+    python benchmark.py --tokens --plan-sizes 5,20,50,100 --substeps 3 --result-chars 400
+
+Counts the tokens of the `advance_to_next_step` output over a whole run, in full and compact rendering. The count
+uses tiktoken if it is installed, else assumes 4 characters per token.
+
+    python benchmark.py --claim-workers 8 --steps 20 --substeps 10 --step-ms 2
+
+Drains one plan of parallel main steps with several workers calling `claim_next_steps` and `complete_step`, and
+checks that every step is completed once and that no step is claimed before the previous main steps are done.
+
+    python benchmark.py --plan-nodes 10000,100000 --branching 10
+
+Builds, advances, re-plans, renders and snapshots very large plans, and reports the memory per node, the latency
+of each operation, and the nodes the plan version of the re-plan adds to the earlier ones. With --deep the plans are chains of nested steps instead of wide trees, and the compact rendering
+is timed instead of the full one.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from server import (Notebook, NotebookRegistry, NotebookStore, Task, advance_to_next_step, claim_next_steps,
+                    complete_step, create_execution_plan, initialize_task, notebooks, verify_task_completion)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, round(pct / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def count_tokens(text):
+    try:
+        import tiktoken
+    except ImportError:
+        return len(text) // 4
+    return len(tiktoken.get_encoding('cl100k_base').encode(text))
+
+
+def run_tokens(steps, substeps, result_chars, compact):
+    """Total and largest output tokens of `advance_to_next_step` when running a whole plan."""
+    session_id = f'tokens-{steps}-{compact}'
+    initialize_task('Write a detailed report about the topic, citing every source. ' * 4,
+                    '1. Cover every aspect of the topic\n2. Cite the sources\n3. Keep it under 2000 words\n',
+                    session_id=session_id)
+    create_execution_plan(make_plan(session_id, steps, substeps), session_id=session_id)
+    result = ('finding ' * result_chars)[:result_chars]
+    counts = []
+    content, _ = json.loads(advance_to_next_step(session_id=session_id, compact=compact))
+    counts.append(count_tokens(content))
+    for _ in range(steps * substeps):
+        content, _ = json.loads(advance_to_next_step(result, session_id=session_id, compact=compact))
+        counts.append(count_tokens(content))
+    return sum(counts), max(counts)
+
+
+def tokens(args):
+    for steps in map(int, args.plan_sizes.split(',')):
+        full_total, full_max = run_tokens(steps, args.substeps, args.result_chars, compact=False)
+        compact_total, compact_max = run_tokens(steps, args.substeps, args.result_chars, compact=True)
+        print(f"steps={steps * args.substeps:<5} full_total={full_total:<10} compact_total={compact_total:<8} "
+              f"saved={1 - compact_total / full_total:.1%} full_max={full_max:<7} compact_max={compact_max}")
+
+
+def make_plan(session_id, steps, substeps, parallel=False):
+    return [{'step': f'{session_id} step {i}', 'substeps': [f'{session_id} step {i}.{j}' for j in range(substeps)],
+             'parallel': parallel}
+            for i in range(steps)]
+
+
+def large_plan(nodes, branching, deep):
+    """A plan of about `nodes` steps: main steps of `branching` steps of `branching` sub steps each, or chains of
+    `branching` main steps nested in each other."""
+    plans = []
+    if deep:
+        depth = max(1, nodes // branching)
+        for i in range(branching):
+            plan = f'step {i} leaf'
+            for level in range(depth - 1):
+                plan = {'step': f'step {i} level {level}', 'substeps': [plan, f'step {i} level {level} sibling']}
+            plans.append(plan)
+        return plans
+    per_main = 1 + branching + branching * branching
+    for i in range(max(1, nodes // per_main)):
+        plans.append({'step': f'step {i}', 'substeps': [
+            {'step': f'step {i}.{j}', 'substeps': [f'step {i}.{j}.{k}' for k in range(branching)]}
+            for j in range(branching)]})
+    return plans
+
+
+def timed_ms(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def plan_sizes(args):
+    for nodes in map(int, args.plan_nodes.split(',')):
+        plans = large_plan(nodes, args.branching, args.deep)
+        session_id = f'large-{nodes}'
+
+        tracemalloc.start()
+        tasks = Task.parse_tasks(plans)
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        count = sum(1 for _ in Task.iter_tasks(tasks))
+        del tasks
+
+        initialize_task('query', 'conditions', session_id=session_id)
+        _, build_ms = timed_ms(create_execution_plan, plans, session_id=session_id)
+        advance_ms = []
+        for idx in range(args.advances):
+            _, ms = timed_ms(advance_to_next_step, f'result {idx}' if idx else '', session_id=session_id, compact=True)
+            advance_ms.append(ms)
+        _, claim_ms = timed_ms(claim_next_steps, 4, 'worker', session_id=session_id)
+        notebook = notebooks.get(session_id)
+        # The full rendering of a deep chain is quadratic in its depth because of the indentation
+        render = Task.format_tasks_compact if args.deep else Task.format_tasks
+        _, render_ms = timed_ms(render, notebook.get_first_task(), notebook.sub_tasks)
+        state, snapshot_ms = timed_ms(lambda: json.dumps(notebook.to_dict()))
+        _, restore_ms = timed_ms(lambda: Notebook.from_dict(json.loads(state)))
+        version_nodes = len(notebook.versions.nodes)
+        _, replan_ms = timed_ms(create_execution_plan, plans, session_id=session_id)
+        print(f"nodes={count:<7} bytes/node={memory / count:<6.0f} build_ms={build_ms:<8.1f} "
+              f"advance_p50_ms={percentile(advance_ms, 50):<6.3f} claim_ms={claim_ms:<6.3f} "
+              f"render_{'compact' if args.deep else 'full'}_ms={render_ms:<8.1f} snapshot_ms={snapshot_ms:<8.1f} restore_ms={restore_ms:<8.1f} "
+              f"replan_ms={replan_ms:<8.1f} replan_new_version_nodes={len(notebook.versions.nodes) - version_nodes}")
+
+
+def claim_workers(args):
+    session_id = 'claim'
+    initialize_task('query', 'conditions', session_id=session_id)
+    create_execution_plan(make_plan(session_id, args.steps, args.substeps, parallel=True), session_id=session_id)
+    completed = []
+    completed_lock = threading.Lock()
+
+    def main_step(name):
+        return int(name.split(' step ')[1].split('.')[0])
+
+    def worker(worker_id):
+        idle = 0
+        while True:
+            claimed = json.loads(claim_next_steps(1, worker_id, session_id=session_id))
+            if not claimed['steps']:
+                if 'finished' in claimed['message']:
+                    return
+                idle += 1
+                time.sleep(0.0005)
+                continue
+            for step in claimed['steps']:
+                with completed_lock:
+                    done_mains = sum(1 for name in completed if main_step(name) < main_step(step['step']))
+                assert done_mains == main_step(step['step']) * args.substeps, step
+                time.sleep(args.step_ms / 1000)
+                reply = complete_step(step['step_id'], f"result of {step['step']}", worker_id, session_id=session_id)
+                assert 'completed' in reply, reply
+                with completed_lock:
+                    completed.append(step['step'])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.claim_workers) as pool:
+        for future in [pool.submit(worker, f'worker-{idx}') for idx in range(args.claim_workers)]:
+            future.result()
+    seconds = time.perf_counter() - start
+    assert sorted(completed) == sorted(step for plan in make_plan(session_id, args.steps, args.substeps)
+                                       for step in plan['substeps']), 'steps missing or completed twice'
+    sequential = args.steps * args.substeps * args.step_ms / 1000
+    print(f"workers={args.claim_workers} steps={len(completed)} seconds={seconds:.2f} "
+          f"steps/sec={len(completed) / seconds:.0f} speedup_vs_sequential={sequential / seconds:.1f}x")
+
+
+def run_session(session_id, steps, substeps):
+    """Drive one agent run through its whole plan and check it never sees another session's plan."""
+    latencies = []
+
+    def timed(fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    timed(initialize_task, f'query of {session_id}', f'conditions of {session_id}', session_id=session_id)
+    timed(create_execution_plan, make_plan(session_id, steps, substeps), session_id=session_id)
+    content, _ = json.loads(timed(advance_to_next_step, session_id=session_id))
+    for idx in range(steps * substeps):
+        content, _ = json.loads(timed(advance_to_next_step, f'result {idx} of {session_id}', session_id=session_id))
+        assert f'query of {session_id}' in content, content
+    final = timed(verify_task_completion, session_id=session_id)
+    assert 'unfinished task' not in final and f'query of {session_id}' in final, final
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--substeps', type=int, default=3)
+    parser.add_argument('--state-db', type=str, default=None, help='A temporary file by default')
+    parser.add_argument('--compact-every', type=int, default=64)
+    parser.add_argument('--memory-only', action='store_true', help='Do not persist the notebooks')
+    parser.add_argument('--tokens', action='store_true', help='Count output tokens instead of measuring speed')
+    parser.add_argument('--plan-sizes', type=str, default='5,20,50,100', help='Comma-separated numbers of main steps')
+    parser.add_argument('--result-chars', type=int, default=400)
+    parser.add_argument('--claim-workers', type=int, default=0, help='Drain one parallel plan with this many workers')
+    parser.add_argument('--step-ms', type=float, default=2, help='Time a claimed step takes to execute')
+    parser.add_argument('--plan-nodes', type=str, default=None, help='Comma-separated sizes of very large plans')
+    parser.add_argument('--branching', type=int, default=10)
+    parser.add_argument('--deep', action='store_true', help='Build the large plans as deeply nested chains')
+    parser.add_argument('--advances', type=int, default=100, help='Steps advanced in each large plan')
+    args = parser.parse_args()
+
+    if args.tokens:
+        notebooks.store = None
+        tokens(args)
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        state_db = args.state_db or os.path.join(tmp_dir, 'state.db')
+        notebooks.store = None if args.memory_only else NotebookStore(state_db, args.compact_every)
+        if args.plan_nodes:
+            plan_sizes(args)
+        elif args.claim_workers:
+            claim_workers(args)
+        else:
+            run(args)
+
+
+def run(args):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.workers) as pool:
+        futures = [pool.submit(run_session, f'session-{idx}', args.steps, args.substeps)
+                   for idx in range(args.sessions)]
+        latencies = [latency for future in futures for latency in future.result()]
+    seconds = time.perf_counter() - start
+
+    print(f"sessions={args.sessions} workers={args.workers} calls={len(latencies)} seconds={seconds:.2f} "
+          f"calls/sec={len(latencies) / seconds:.0f} p50_ms={percentile(latencies, 50) * 1000:.3f} "
+          f"p99_ms={percentile(latencies, 99) * 1000:.3f} live_notebooks={len(notebooks)}")
+
+    if notebooks.store is None:
+        return
+    restarted = NotebookRegistry(args.sessions, notebooks.idle_ttl,
+                                 NotebookStore(notebooks.store.path, notebooks.store.compact_every))
+    start = time.perf_counter()
+    for idx in range(args.sessions):
+        session_id = f'session-{idx}'
+        assert restarted.get(session_id).to_dict() == notebooks.get(session_id).to_dict(), session_id
+    seconds = time.perf_counter() - start
+    print(f"resumed={args.sessions} seconds={seconds:.2f} resume_ms={seconds / args.sessions * 1000:.3f} "
+          f"state_db_kb={os.path.getsize(notebooks.store.path) / 1024:.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,73 +1,602 @@
+import asyncio
+import base64
+import difflib
+import hashlib
 import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from dataclasses import dataclass, field
-from typing import List, Dict, Union, Any
+from typing import List, Dict, Union, Any, Optional, Tuple, Callable, Iterable
 
-from fastmcp import FastMCP
+from fastmcp import Context, FastMCP
 
 mcp = FastMCP("notebook")
 
+# `advance_to_next_step` renders the plan in full by default, set to `compact` to fold it
+RENDER_MODE = os.environ.get('NOTEBOOK_RENDER', 'full')
+RESULT_PREVIEW_CHARS = int(os.environ.get('NOTEBOOK_RESULT_PREVIEW_CHARS', 200))
+COMPACT_MAX_INDENT = 16
+# Results longer than this (in UTF-8 bytes) are kept compressed
+RESULT_COMPRESS_BYTES = int(os.environ.get('NOTEBOOK_RESULT_COMPRESS_BYTES', 1024))
+# Stored bytes of intermediate results kept per notebook, the oldest ones are evicted past it
+SCRATCHPAD_BYTES = int(os.environ.get('NOTEBOOK_SCRATCHPAD_BYTES', 16 * 1024 * 1024))
+SNIPPET_CHARS = 200
+# Longest wait of a `watch_plan` call
+WATCH_MAX_SECONDS = 300
+# Default lease of a step claimed with `claim_next_steps`
+LEASE_SECONDS = float(os.environ.get('NOTEBOOK_LEASE_SECONDS', 600))
 
-@dataclass
+
+class StoredResult:
+    """A step result in a `ResultStore`, zlib-compressed when large, with its preview for compact rendering."""
+
+    __slots__ = ('key', 'data', 'compressed', 'preview', 'length')
+
+    def __init__(self, key: str, text: str):
+        data = text.encode('utf-8')
+        self.compressed = False
+        if len(data) > RESULT_COMPRESS_BYTES:
+            packed = zlib.compress(data)
+            if len(packed) < len(data):
+                data = packed
+                self.compressed = True
+        self.key = key
+        self.data = data
+        self.preview = preview(text)
+        self.length = len(text)
+
+    @property
+    def text(self) -> str:
+        return (zlib.decompress(self.data) if self.compressed else self.data).decode('utf-8')
+
+    def pack(self) -> Dict[str, Any]:
+        """JSON form of the stored bytes for the state db, so a compressed result is not written out as text."""
+        return {'data': base64.b64encode(self.data).decode('ascii'), 'compressed': self.compressed,
+                'preview': self.preview, 'length': self.length}
+
+    @classmethod
+    def unpack(cls, key: str, packed: Dict[str, Any]) -> 'StoredResult':
+        stored = cls.__new__(cls)
+        stored.key = key
+        stored.data = base64.b64decode(packed['data'])
+        stored.compressed = packed['compressed']
+        stored.preview = packed['preview']
+        stored.length = packed['length']
+        return stored
+
+
+class ResultStore:
+    """The step results of a notebook keyed by their SHA-256, so a result given twice is kept once."""
+
+    def __init__(self):
+        self._results: Dict[str, StoredResult] = {}
+
+    def put(self, text: str) -> StoredResult:
+        key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        stored = self._results.get(key)
+        if stored is None:
+            stored = self._results[key] = StoredResult(key, text)
+        return stored
+
+    def get(self, key: str) -> Optional[StoredResult]:
+        return self._results.get(key)
+
+    def items(self):
+        return self._results.items()
+
+    def __len__(self):
+        return len(self._results)
+
+
+class Scratchpad:
+    """Intermediate results of a notebook (large tool outputs) stored under titles, compressed like step results.
+
+    The stored bytes are kept within `budget` by evicting the oldest entries first; storing a title again replaces
+    it and makes it the newest. Eviction only depends on the order and size of the stores, so replaying the journal
+    of a notebook evicts the same entries. The journal drops the data of entries that were evicted or replaced
+    later, and replays them as placeholders of the same size (`stored=None`), which the same later stores remove.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.size = 0
+        self._entries: 'OrderedDict[str, Optional[StoredResult]]' = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+
+    def put(self, title: str, stored: Optional[StoredResult], size: Optional[int] = None) -> List[str]:
+        """Store an entry under `title`, returns the titles evicted to make room."""
+        if title in self._entries:
+            del self._entries[title]
+            self.size -= self._sizes.pop(title)
+        self._entries[title] = stored
+        self._sizes[title] = len(stored.data) if stored is not None else size
+        self.size += self._sizes[title]
+        evicted = []
+        # The newest entry is kept even when it is larger than the whole budget
+        while self.size > self.budget and len(self._entries) > 1:
+            evicted_title, _ = self._entries.popitem(last=False)
+            self.size -= self._sizes.pop(evicted_title)
+            evicted.append(evicted_title)
+        return evicted
+
+    def get(self, title: str) -> Optional[StoredResult]:
+        return self._entries.get(title)
+
+    def items(self):
+        # Placeholders only exist in the middle of a journal replay
+        return [(title, stored) for title, stored in self._entries.items() if stored is not None]
+
+    def search(self, query: str, top_k: int) -> List[Tuple[str, int, str]]:
+        """Entries containing the words of `query` (case-insensitive), most matches first, as (title, matches,
+        snippet around the first match)."""
+        terms = query.lower().split()
+        found = []
+        for title, stored in self._entries.items():
+            text = stored.text
+            lower = text.lower()
+            matches = sum(lower.count(term) for term in terms) + sum(title.lower().count(term) for term in terms)
+            if not matches:
+                continue
+            first = min((pos for pos in (lower.find(term) for term in terms) if pos >= 0), default=0)
+            start = max(0, first - SNIPPET_CHARS // 2)
+            snippet = ' '.join(text[start:start + SNIPPET_CHARS].split())
+            found.append((title, matches, ('…' if start else '') + snippet))
+        found.sort(key=lambda item: -item[1])
+        return found[:top_k]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+@dataclass(eq=False, slots=True)
 class Task:
 
     name: str = ''
 
     system: str = ''
 
-    result: str = ''
+    stored_result: Optional[StoredResult] = field(default=None, repr=False)
 
     _done: bool = False
 
-    sub_tasks: List['Task'] = field(default_factory=list)
+    # Leaves share the empty tuple, a list is only created for a task's first sub task
+    sub_tasks: List['Task'] = ()
+
+    # Whether the sub tasks are independent, so workers may run them at the same time
+    parallel: bool = False
+
+    # Assigned when the task is added to a notebook, stable across re-plans
+    id: int = 0
+
+    parent: Optional['Task'] = field(default=None, repr=False)
+
+    # The top-level step this task belongs to
+    main: Optional['Task'] = field(default=None, repr=False)
+
+    # Position among the sub tasks of the parent (or the main steps of the notebook)
+    index: int = 0
+
+    # Number of undone leaves in this subtree, kept up to date by `set_done`
+    pending: int = 0
+
+    # Number of leaves in this subtree
+    leaves: int = 1
 
     @staticmethod
-    def parse_tasks(plans: List[Union[str, Dict[str, Any]]]) -> List:
+    def parse_tasks(plans: List[Union[str, Dict[str, Any], 'Task']]) -> List:
         if not plans:
             return []
-        sub_tasks = []
-        for plan in plans:
+        if all(isinstance(plan, Task) for plan in plans):
+            return list(plans)
+        return Task.from_rows(Task.plan_rows(plans))
+
+    @staticmethod
+    def plan_rows(plans: List[Union[str, Dict[str, Any]]]) -> List[list]:
+        """The steps of a plan as flat rows `[parent row or -1, step, system, parallel]` in plan order. Unlike the
+        nested plan they are walked without recursion and can be journaled as JSON at any depth."""
+        rows = []
+        stack = [(plan, -1) for plan in reversed(plans or [])]
+        while stack:
+            plan, parent = stack.pop()
             if isinstance(plan, str):
-                sub_tasks.append(Task(name=plan))
+                rows.append([parent, plan, '', False])
+                continue
+            rows.append([parent, plan['step'], plan.get('system'), bool(plan.get('parallel', False))])
+            stack.extend((substep, len(rows) - 1) for substep in reversed(plan['substeps'] or []))
+        return rows
+
+    @staticmethod
+    def from_rows(rows: List[list]) -> List['Task']:
+        sub_tasks = []
+        tasks = []
+        for parent, name, system, parallel in rows:
+            task = Task(name=name, system=system, parallel=parallel)
+            if parent >= 0:
+                tasks[parent].add_sub_task(task)
             else:
-                step = plan['step']
-                system = plan.get('system')
-                substeps = plan['substeps']
-                sub_tasks.append(Task(name=step, system=system, sub_tasks=substeps))
+                task.index = len(sub_tasks)
+                sub_tasks.append(task)
+            tasks.append(task)
+        # Sub tasks come after their parent, so the counters are computed in reverse
+        for task in reversed(tasks):
+            task.update_pending()
         return sub_tasks
 
     def __post_init__(self):
-        self.sub_tasks = self.parse_tasks(self.sub_tasks)
+        if self.sub_tasks:
+            self.sub_tasks = self.parse_tasks(self.sub_tasks)
+        for index, task in enumerate(self.sub_tasks):
+            task.parent = self
+            task.index = index
+        self.update_pending()
+
+    def add_sub_task(self, task: 'Task'):
+        """Append a sub task; the counters of this task are not updated."""
+        if not self.sub_tasks:
+            self.sub_tasks = []
+        task.parent = self
+        task.index = len(self.sub_tasks)
+        self.sub_tasks.append(task)
+
+    @staticmethod
+    def iter_tasks(tasks: List['Task']):
+        """All tasks under `tasks` in plan order, parents before their sub tasks."""
+        stack = list(reversed(tasks))
+        while stack:
+            task = stack.pop()
+            yield task
+            stack.extend(reversed(task.sub_tasks))
+
+    @property
+    def result(self) -> str:
+        return self.stored_result.text if self.stored_result else ''
+
+    def update_pending(self):
+        if self.sub_tasks:
+            self.pending = sum(task.pending for task in self.sub_tasks)
+            self.leaves = sum(task.leaves for task in self.sub_tasks)
+        else:
+            self.pending = 0 if self._done else 1
+            self.leaves = 1
 
     def set_done(self):
         assert not self.sub_tasks
+        if self._done:
+            return
         self._done = True
+        task = self
+        while task is not None:
+            task.pending -= 1
+            task = task.parent
 
     def get_done(self):
-        if self.sub_tasks:
-            self._done = all([task.get_done() for task in self.sub_tasks])
-        return self._done
+        return self.pending == 0
 
     @staticmethod
     def format_tasks(next_task, tasks, indent=0):
-        result = ""
-        for task in tasks:
-            prefix = "  " * indent
+        result = []
+        stack = [(task, indent) for task in reversed(tasks)]
+        while stack:
+            task, level = stack.pop()
+            prefix = "  " * level
 
-            # Determine the status symbol
+            # Determine the status symbol; the step id is the one `get_step_result` takes
             if task.get_done():
-                result += f"{prefix}✓ {task.name}\n"
-                if task.result:
-                    result += f"{prefix}  Result: {task.result}\nResult end.\n\n"
-            elif task == next_task:
-                result += f"{prefix}🔄 {task.name} (CURRENT)\n"
+                result.append(f"{prefix}✓ [{task.id}] {task.name}\n")
+                if task.stored_result:
+                    result.append(f"{prefix}  Result: {task.result}\nResult end.\n\n")
+            elif task is next_task:
+                result.append(f"{prefix}🔄 [{task.id}] {task.name} (CURRENT)\n")
             else:
-                result += f"{prefix}• {task.name}\n"
+                result.append(f"{prefix}• [{task.id}] {task.name}\n")
 
             # Process subtasks if any
-            if task.sub_tasks:
-                result += Task.format_tasks(next_task, task.sub_tasks, indent + 1)
+            stack.extend((sub_task, level + 1) for sub_task in reversed(task.sub_tasks))
 
-        return result
+        return "".join(result)
+
+    @staticmethod
+    def format_tasks_compact(next_task, tasks, indent=0):
+        """Like `format_tasks`, but only the path to `next_task` is expanded: every other step takes one line,
+        finished subtrees are folded and results are cut to a preview."""
+        path = set()
+        task = next_task
+        while task is not None:
+            path.add(id(task))
+            task = task.parent
+
+        result = []
+        stack = [(task, indent) for task in reversed(tasks)]
+        while stack:
+            task, level = stack.pop()
+            # Capped, so the output of a very deep plan stays linear in its depth
+            prefix = "  " * min(level, COMPACT_MAX_INDENT)
+            if task.get_done():
+                result.append(f"{prefix}✓ [{task.id}] {task.name}")
+                if task.sub_tasks:
+                    result.append(f" ({task.leaves} steps done)\n")
+                elif task.stored_result:
+                    result.append(f" → {task.stored_result.preview}\n")
+                else:
+                    result.append("\n")
+            elif task is next_task:
+                result.append(f"{prefix}🔄 [{task.id}] {task.name} (CURRENT)\n")
+            elif id(task) in path:
+                result.append(f"{prefix}• [{task.id}] {task.name}{' (parallel)' if task.parallel else ''}\n")
+                stack.extend((sub_task, level + 1) for sub_task in reversed(task.sub_tasks))
+            elif task.sub_tasks:
+                result.append(f"{prefix}• [{task.id}] {task.name} ({task.pending} steps"
+                              f"{', parallel' if task.parallel else ''})\n")
+            else:
+                result.append(f"{prefix}• [{task.id}] {task.name}\n")
+        return "".join(result)
+
+
+def preview(text: str, limit: int = None) -> str:
+    limit = RESULT_PREVIEW_CHARS if limit is None else limit
+    text = ' '.join(text.split())
+    return text if len(text) <= limit else text[:limit] + '…'
+
+
+class RunProfile:
+    """Timeline of an agent run on a notebook, to find the steps its time goes to.
+
+    Events are `[unix time, event, step id or None, details]`: `initialize`, `plan` (with the number of steps added
+    and the started steps it removed before they were done), `start` (a step shown as current or claimed by a
+    worker), `complete` (with the result size) and `store` (an intermediate result). The times are those of the
+    journaled changes, so replaying a journal rebuilds the same profile; journal entries written before profiling
+    have no time and are left out.
+    """
+
+    def __init__(self):
+        self.events: List[list] = []
+        # Ids of the steps started so far, and of those not completed yet
+        self.started = set()
+        self.open = set()
+
+    def record(self, now: Optional[float], event: str, step_id: Optional[int] = None, **details):
+        if now is not None:
+            self.events.append([now, event, step_id, details])
+
+    def start(self, task: Optional[Task], now: Optional[float], worker_id: Optional[str] = None):
+        if task is None or now is None or task.id in self.started:
+            return
+        self.started.add(task.id)
+        self.open.add(task.id)
+        self.record(now, 'start', task.id, step=task.name, main=task.main.id, main_step=task.main.name,
+                    worker=worker_id)
+
+    def complete(self, task: Task, now: Optional[float], worker_id: Optional[str] = None):
+        if now is None:
+            return
+        self.open.discard(task.id)
+        stored = task.stored_result
+        self.record(now, 'complete', task.id, step=task.name, main=task.main.id, main_step=task.main.name,
+                    worker=worker_id, result_chars=stored.length if stored else 0,
+                    result_bytes=len(stored.data) if stored else 0)
+
+    def replan(self, now: Optional[float], steps: int):
+        """A new plan of `steps` steps replaced every undone step, including the started ones."""
+        if now is None:
+            return
+        self.record(now, 'plan', steps=steps, replanned=sorted(self.open))
+        self.open.clear()
+
+    @classmethod
+    def from_events(cls, events: List[list]) -> 'RunProfile':
+        profile = cls()
+        for _, event, step_id, details in events:
+            if event == 'start':
+                profile.started.add(step_id)
+                profile.open.add(step_id)
+            elif event == 'complete':
+                profile.open.discard(step_id)
+            elif event == 'plan':
+                profile.open.clear()
+        profile.events = events
+        return profile
+
+    def steps(self) -> List[Dict[str, Any]]:
+        """One row per started or completed step, in the order they were started, with times in seconds since the
+        start of the run."""
+        begin = self.events[0][0] if self.events else 0.0
+        rows: Dict[int, Dict[str, Any]] = {}
+        for now, event, step_id, details in self.events:
+            if event in ('start', 'complete'):
+                row = rows.get(step_id)
+                if row is None:
+                    row = rows[step_id] = {'step_id': step_id, 'step': details['step'], 'main_step_id': details['main'],
+                                           'main_step': details['main_step'], 'worker': details['worker'],
+                                           'started': None, 'completed': None, 'replanned': None, 'seconds': None,
+                                           'result_chars': None}
+                if event == 'start':
+                    row['started'] = round(now - begin, 3)
+                    continue
+                row['completed'] = round(now - begin, 3)
+                row['worker'] = details['worker'] or row['worker']
+                row['result_chars'] = details['result_chars']
+                if row['started'] is not None:
+                    row['seconds'] = round(row['completed'] - row['started'], 3)
+            elif event == 'plan':
+                for step_id in details['replanned']:
+                    if step_id in rows:
+                        rows[step_id]['replanned'] = round(now - begin, 3)
+        return list(rows.values())
+
+    def summary(self, top: int) -> Dict[str, Any]:
+        """Totals of the run, the timeline of its main steps, and its `top` slowest steps."""
+        steps = self.steps()
+        plans = [details for _, event, _, details in self.events if event == 'plan']
+        stores = [details for _, event, _, details in self.events if event == 'store']
+        completes = [details for _, event, _, details in self.events if event == 'complete']
+        main_steps: Dict[int, Dict[str, Any]] = {}
+        for row in steps:
+            main = main_steps.setdefault(row['main_step_id'], {
+                'main_step_id': row['main_step_id'], 'main_step': row['main_step'], 'started': None,
+                'completed': None, 'seconds': None, 'steps_completed': 0, 'result_chars': 0})
+            started = row['started'] if row['started'] is not None else row['completed']
+            if main['started'] is None or started < main['started']:
+                main['started'] = started
+            if row['completed'] is not None:
+                main['completed'] = max(main['completed'] or 0.0, row['completed'])
+                main['steps_completed'] += 1
+                main['result_chars'] += row['result_chars']
+        for main in main_steps.values():
+            if main['completed'] is not None:
+                main['seconds'] = round(main['completed'] - main['started'], 3)
+        timed = [row for row in steps if row['seconds'] is not None]
+        return {
+            'started_at': self.events[0][0] if self.events else None,
+            'wall_seconds': round(self.events[-1][0] - self.events[0][0], 3) if self.events else 0.0,
+            'step_seconds': round(sum(row['seconds'] for row in timed), 3),
+            'plans': len(plans),
+            'plan_overrides': max(0, len(plans) - 1),
+            'steps_planned': sum(details['steps'] for details in plans),
+            'steps_replanned': sum(len(details['replanned']) for details in plans),
+            'steps_started': len(self.started),
+            'steps_completed': len(completes),
+            'result_chars': sum(details['result_chars'] for details in completes),
+            'result_bytes': sum(details['result_bytes'] for details in completes),
+            'intermediate_results': len(stores),
+            'intermediate_chars': sum(details['chars'] for details in stores),
+            'main_steps': list(main_steps.values()),
+            'slowest_steps': sorted(timed, key=lambda row: -row['seconds'])[:top],
+        }
+
+
+class PlanVersions:
+    """Every revision of the plan of a notebook, as recorded after each `create_execution_plan`.
+
+    A revision is an immutable tree of nodes `(step, system, parallel, done, sub node ids)`. Nodes are interned, so
+    a subtree that did not change since an earlier revision is the very same node, and each revision only adds the
+    nodes of what changed (the new steps, and the steps completed since, with their ancestors). Two revisions are
+    diffed by skipping their shared nodes.
+    """
+
+    def __init__(self):
+        self.nodes: List[tuple] = []
+        self._interned: Dict[tuple, int] = {}
+        # [unix time, main node ids, steps, done steps, version restored or 0] per revision, the first is version 1
+        self.versions: List[list] = []
+
+    def intern(self, node: tuple) -> int:
+        node_id = self._interned.get(node)
+        if node_id is None:
+            node_id = self._interned[node] = len(self.nodes)
+            self.nodes.append(node)
+        return node_id
+
+    def record(self, tasks: List[Task], now: Optional[float], restored: int = 0) -> int:
+        """Add the plan `tasks` as the newest revision, returns its version."""
+        node_ids: Dict[int, int] = {}
+        done = 0
+        all_tasks = list(Task.iter_tasks(tasks))
+        # Sub tasks come after their parent in plan order, so they are interned first
+        for task in reversed(all_tasks):
+            node_ids[task.id] = self.intern((task.name, task.system, task.parallel, task.get_done(),
+                                             tuple(node_ids[sub_task.id] for sub_task in task.sub_tasks)))
+            done += task.get_done()
+        self.versions.append([now, tuple(node_ids[task.id] for task in tasks), len(all_tasks), done, restored])
+        return len(self.versions)
+
+    def get(self, version: int) -> Optional[list]:
+        return self.versions[version - 1] if 0 < version <= len(self.versions) else None
+
+    def subtree_size(self, node_id: int) -> int:
+        size = 0
+        stack = [node_id]
+        while stack:
+            size += 1
+            stack.extend(self.nodes[stack.pop()][4])
+        return size
+
+    def plan_rows(self, version: int, done_paths: frozenset = frozenset()) -> List[list]:
+        """The steps of a revision that are still to do, as rows of `Task.plan_rows`. Steps done in that revision
+        are left out, and so are steps without sub steps whose path of step names is in `done_paths` (done in the
+        current plan), and the steps all of whose sub steps are left out. A step with sub steps is not matched by
+        its own path, as a re-plan keeps a step that is only partly done with its done sub steps alone."""
+        rows = []
+        # Per row: whether its node has sub nodes, so a step left without any can be dropped
+        has_sub_nodes = []
+        stack = [(node_id, -1, ()) for node_id in reversed(self.get(version)[1])]
+        while stack:
+            node_id, parent, path = stack.pop()
+            name, system, parallel, done, sub_nodes = self.nodes[node_id]
+            path += (name,)
+            if done or (not sub_nodes and path in done_paths):
+                continue
+            rows.append([parent, name, system, parallel])
+            has_sub_nodes.append(bool(sub_nodes))
+            stack.extend((sub_node, len(rows) - 1, path) for sub_node in reversed(sub_nodes))
+        # Sub steps come after their parent, so emptied steps are found in reverse
+        children = [0] * len(rows)
+        kept = [True] * len(rows)
+        for row in reversed(range(len(rows))):
+            if has_sub_nodes[row] and not children[row]:
+                kept[row] = False
+            elif rows[row][0] >= 0:
+                children[rows[row][0]] += 1
+        new_rows = {}
+        restored = []
+        for row, (parent, name, system, parallel) in enumerate(rows):
+            if kept[row]:
+                new_rows[row] = len(restored)
+                restored.append([new_rows[parent] if parent >= 0 else -1, name, system, parallel])
+        return restored
+
+    def diff(self, old: int, new: int) -> List[str]:
+        """The steps added (`+`), removed (`-`), completed (`✓`) or changed (`~`) from revision `old` to `new`, each
+        with the path of its main step."""
+        lines = []
+        stack = [('', self.get(old)[1], self.get(new)[1])]
+        while stack:
+            path, old_nodes, new_nodes = stack.pop()
+            matcher = difflib.SequenceMatcher(None, old_nodes, new_nodes, autojunk=False)
+            for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+                if tag == 'equal':
+                    continue
+                added = list(new_nodes[new_start:new_end])
+                for old_node in old_nodes[old_start:old_end]:
+                    name, system, parallel, done, sub_nodes = self.nodes[old_node]
+                    new_node = next((node_id for node_id in added if self.nodes[node_id][0] == name), None)
+                    if new_node is None:
+                        size = self.subtree_size(old_node)
+                        lines.append(f"- {path}{name}{f' ({size} steps)' if size > 1 else ''}")
+                        continue
+                    added.remove(new_node)
+                    _, new_system, new_parallel, new_done, new_sub_nodes = self.nodes[new_node]
+                    if (system, parallel) != (new_system, new_parallel):
+                        lines.append(f"~ {path}{name}")
+                    if sub_nodes or new_sub_nodes:
+                        stack.append((f'{path}{name} › ', sub_nodes, new_sub_nodes))
+                    elif done != new_done:
+                        lines.append(f"{'✓' if new_done else '↺'} {path}{name}")
+                for new_node in added:
+                    size = self.subtree_size(new_node)
+                    lines.append(f"+ {path}{self.nodes[new_node][0]}{f' ({size} steps)' if size > 1 else ''}")
+        return lines
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'nodes': [list(node) for node in self.nodes],
+                'versions': [[now, list(roots), steps, done, restored] for now, roots, steps, done, restored in
+                             self.versions]}
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> 'PlanVersions':
+        versions = cls()
+        for name, system, parallel, done, sub_nodes in state.get('nodes', []):
+            versions.intern((name, system, parallel, done, tuple(sub_nodes)))
+        versions.versions = [[now, tuple(roots), steps, done, restored]
+                             for now, roots, steps, done, restored in state.get('versions', [])]
+        return versions
+
+    def __len__(self):
+        return len(self.versions)
 
 
 @dataclass
@@ -81,59 +610,315 @@ class Notebook:
 
     first_push: bool = True
 
-    def override_tasks(self, plans: List[Union[str, Dict[str, Any]]]):
+    # task id -> task, for every task in the plan
+    task_index: Dict[int, Task] = field(default_factory=dict)
+
+    # The first undone leaf, i.e. the step being executed
+    cursor: Optional[Task] = None
+
+    next_id: int = 1
+
+    results: ResultStore = field(default_factory=ResultStore)
+
+    scratchpad: Scratchpad = field(default_factory=lambda: Scratchpad(SCRATCHPAD_BYTES))
+
+    # task id -> (worker id, lease expiry as a unix time) of the steps claimed by workers
+    claims: Dict[int, Tuple[str, float]] = field(default_factory=dict)
+
+    # Held while the notebook is changed and journaled, as several workers may share it
+    lock: Any = field(default_factory=threading.RLock, repr=False)
+
+    # Number of changes applied, see `plan_json`
+    version: int = 0
+
+    # (version, rendering) of the last `plan_json`
+    rendered: Optional[Tuple[int, str]] = field(default=None, repr=False)
+
+    profile: RunProfile = field(default_factory=RunProfile, repr=False)
+
+    versions: PlanVersions = field(default_factory=PlanVersions, repr=False)
+
+    def override_tasks(self, plans: List[Union[str, Dict[str, Any], Task]], now: Optional[float] = None,
+                       restored: int = 0):
+        # Parsed first, so an invalid plan leaves the notebook unchanged
+        new_tasks = Task.parse_tasks(plans)
+        self.profile.replan(now, sum(1 for _ in Task.iter_tasks(new_tasks)))
         self.remove_undone()
-        self.sub_tasks.extend(Task.parse_tasks(plans))
+        self.sub_tasks.extend(new_tasks)
+        for index, task in enumerate(self.sub_tasks):
+            task.index = index
+        self.index_tasks(new_tasks)
+        self.cursor = self.first_undone(self.sub_tasks)
+        # Claims of removed steps are dropped
+        self.claims = {task_id: claim for task_id, claim in self.claims.items() if task_id in self.task_index}
+        self.versions.record(self.sub_tasks, now, restored)
+
+    def index_tasks(self, tasks: List[Task]):
+        for task in Task.iter_tasks(tasks):
+            if not task.id:
+                task.id = self.next_id
+                self.next_id += 1
+            task.main = task.parent.main if task.parent else task
+            self.task_index[task.id] = task
 
     def remove_undone(self):
+        # Sub tasks are filtered before their parent: a task is kept if it is a done step, or if any of its sub
+        # tasks is kept (it is then done, as only done steps remain under it)
+        for task in reversed(list(Task.iter_tasks(self.sub_tasks))):
+            if task.sub_tasks:
+                task.sub_tasks = [sub_task for sub_task in task.sub_tasks if sub_task.get_done()]
+                for index, sub_task in enumerate(task.sub_tasks):
+                    sub_task.index = index
+                task.update_pending()
+        self.sub_tasks = [task for task in self.sub_tasks if task.get_done()]
+        for index, task in enumerate(self.sub_tasks):
+            task.index = index
+        self.task_index = {}
+        self.index_tasks(self.sub_tasks)
 
-        def filter_tasks(tasks):
-            filtered = []
-            for task in tasks:
-                if task.sub_tasks:
-                    task.sub_tasks = filter_tasks(task.sub_tasks)
-                    if task.sub_tasks or task.get_done():
-                        filtered.append(task)
-                elif task.get_done():
-                    filtered.append(task)
-            return filtered
+    @staticmethod
+    def task_path(task: Task) -> Tuple[str, ...]:
+        """The names of a task and its ancestors, from its main step down."""
+        path = []
+        while task is not None:
+            path.append(task.name)
+            task = task.parent
+        return tuple(reversed(path))
 
-        self.sub_tasks = filter_tasks(self.sub_tasks)
+    def get_task(self, task_id: Union[int, str]) -> Optional[Task]:
+        """The task with the given id, which may be written as shown in the plan, e.g. `[12]`."""
+        try:
+            return self.task_index.get(int(str(task_id).strip('[] ')))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def first_undone(tasks: Iterable[Task]) -> Optional[Task]:
+        """The first undone leaf under `tasks`, descending only into subtrees with pending leaves."""
+        task = next((task for task in tasks if task.pending), None)
+        while task is not None and task.sub_tasks:
+            task = next(sub_task for sub_task in task.sub_tasks if sub_task.pending)
+        return task
 
     def get_first_task(self) -> Task:
-        if not self.sub_tasks:
-            return None
+        return self.cursor
 
-        def find_first_undone(tasks):
-            for task in tasks:
-                if not task.get_done():
-                    if task.sub_tasks:
-                        first_undone = find_first_undone(task.sub_tasks)
-                        if first_undone:
-                            return first_undone
-                        else:
-                            raise 'Should not happen'
-                    else:
-                        return task
-            return None
+    def complete_task(self, task: Task):
+        """Mark a leaf done and move the cursor past it: every leaf before the cursor is done, so the next undone
+        leaf is found among the later siblings of the task and its ancestors."""
+        task.set_done()
+        if task is not self.cursor:
+            return
+        self.cursor = None
+        while task is not None:
+            siblings = task.parent.sub_tasks if task.parent else self.sub_tasks
+            # Scanned by index, as a slice would copy every later sibling
+            self.cursor = self.first_undone(siblings[index] for index in range(task.index + 1, len(siblings)))
+            if self.cursor is not None:
+                return
+            task = task.parent
 
-        return find_first_undone(self.sub_tasks)
+    def advance(self, summary_and_result: str, now: Optional[float] = None) -> Tuple[Optional[Task], bool]:
+        """Complete the current step with its result. Returns that step, and whether it finished its main step
+        while other main steps follow."""
+        if summary_and_result:
+            self.first_push = False
+        current_task = self.get_first_task()
 
-    def find_main_task(self, cur_task: Task):
-        for main_task in self.sub_tasks:
-            if self.recursive_find_main(cur_task, main_task):
-                return main_task
+        if current_task and summary_and_result:
+            current_task.stored_result = self.results.put(summary_and_result)
+
+        if current_task and not self.first_push:
+            self.complete_task(current_task)
+            self.profile.complete(current_task, now)
+        # The step shown next starts now
+        self.profile.start(self.cursor, now)
+
+        switching = bool(current_task) and not self.first_push and self.task_switching(current_task)
+        self.first_push = False
+        return current_task, switching
+
+    def ready_steps(self) -> List[Task]:
+        """The undone steps that may run now. Main steps run one after the other, and so do the sub steps of a step
+        unless it is parallel."""
+
+        ready = []
+        stack = [self.cursor.main] if self.cursor else []
+        while stack:
+            task = stack.pop()
+            if not task.sub_tasks:
+                ready.append(task)
+                continue
+            undone = [sub_task for sub_task in task.sub_tasks if sub_task.pending]
+            if not task.parallel:
+                undone = undone[:1]
+            stack.extend(reversed(undone))
+        return ready
+
+    def active_claim(self, task: Task, now: float) -> Optional[Tuple[str, float]]:
+        claim = self.claims.get(task.id)
+        return claim if claim and claim[1] > now else None
+
+    def claim_steps(self, n: int, worker_id: str, lease_seconds: float, now: float) -> List[Task]:
+        """Lease up to `n` ready steps to a worker, skipping the ones leased to other workers. Claiming a step
+        again renews its lease."""
+        claimed = []
+        for task in self.ready_steps():
+            if len(claimed) >= n:
+                break
+            claim = self.active_claim(task, now)
+            if claim and claim[0] != worker_id:
+                continue
+            self.claims[task.id] = (worker_id, now + lease_seconds)
+            self.profile.start(task, now, worker_id)
+            claimed.append(task)
+        return claimed
+
+    def complete_step(self, step_id: str, result: str, worker_id: str, now: float) -> Task:
+        """Complete a step claimed by `worker_id`, or a ready step nobody holds a lease on."""
+        task = self.get_task(step_id)
+        if task is None:
+            raise ValueError(f'No step with id "{step_id}" in the plan.')
+        if task.sub_tasks:
+            raise ValueError(f'Step [{task.id}] "{task.name}" has sub steps, complete those instead.')
+        if task.get_done():
+            raise ValueError(f'Step [{task.id}] "{task.name}" is already done.')
+        claim = self.claims.get(task.id)
+        if not (claim and claim[0] == worker_id):
+            claim = self.active_claim(task, now)
+            if claim:
+                raise ValueError(f'Step [{task.id}] "{task.name}" is claimed by worker "{claim[0]}".')
+            if task not in self.ready_steps():
+                raise ValueError(f'Step [{task.id}] "{task.name}" cannot run before the steps it depends on.')
+        if result:
+            task.stored_result = self.results.put(result)
+        self.claims.pop(task.id, None)
+        self.first_push = False
+        self.complete_task(task)
+        self.profile.complete(task, now, worker_id)
+        return task
+
+    def apply(self, op: str, args: Dict[str, Any]):
+        """Apply one journaled change, see `NotebookStore`."""
+        result = None
+        now = args.get('now')
+        if op == 'initialize':
+            self.query = args['user_query']
+            self.analysis = args['conditions_and_todo_list']
+            self.profile.record(now, 'initialize')
+        elif op == 'plan':
+            # Journals written before plans were flattened hold the nested plan
+            self.override_tasks(Task.from_rows(args['rows']) if 'rows' in args else args['plans'], now,
+                                args.get('restored', 0))
+        elif op == 'advance':
+            result = self.advance(args['summary_and_result'], now)
+        elif op == 'store':
+            if 'packed' in args:
+                stored = StoredResult.unpack(args['title'], args['packed'])
+            elif 'data' in args:
+                # Journals written before entries were packed hold the text
+                stored = StoredResult(args['title'], args['data'])
+            else:
+                # The data was dropped from the journal, as a later store evicts or replaces the entry
+                stored = None
+            result = self.scratchpad.put(args['title'], stored, args.get('size'))
+            self.profile.record(now, 'store', title=args['title'],
+                                chars=stored.length if stored is not None else args['chars'])
+        elif op == 'claim':
+            result = self.claim_steps(args['n'], args['worker_id'], args['lease_seconds'], args['now'])
+        elif op == 'complete':
+            result = self.complete_step(args['step_id'], args['result'], args['worker_id'], args['now'])
+        else:
+            raise ValueError(f'Unknown notebook operation: {op}')
+        # Workers polling for steps do not change anything until they claim one
+        if op != 'claim' or result:
+            self.version += 1
+        return result
+
+    def plan_json(self, session_id: str) -> str:
+        """Read-only JSON view of the notebook for observers, rendered once per version."""
+        with self.lock:
+            if self.rendered is None or self.rendered[0] != self.version:
+                steps = [{'id': task.id, 'parent': task.parent.id if task.parent else None, 'step': task.name,
+                          'done': task.get_done(), 'parallel': task.parallel,
+                          'result_preview': task.stored_result.preview if task.stored_result else None,
+                          'claimed_by': self.claims[task.id][0] if task.id in self.claims else None,
+                          'lease_expires': self.claims[task.id][1] if task.id in self.claims else None}
+                         for task in Task.iter_tasks(self.sub_tasks)]
+                content = json.dumps({'session_id': session_id, 'version': self.version, 'query': self.query,
+                                      'analysis': self.analysis,
+                                      'current_step': self.cursor.id if self.cursor else None,
+                                      'steps_left': sum(task.pending for task in self.sub_tasks),
+                                      'steps': steps, 'intermediate_results': [title for title, _ in
+                                                                               self.scratchpad.items()]},
+                                     ensure_ascii=False)
+                self.rendered = (self.version, content)
+            return self.rendered[1]
+
+    def to_dict(self) -> Dict[str, Any]:
+        # The plan is a flat list of rows in plan order, each naming its parent, as deeply nested JSON would hit
+        # the recursion limit of the json module
+        tasks = [[task.id, task.parent.id if task.parent else 0, task.name, task.system,
+                  task.stored_result.key if task.stored_result else '', task._done, task.parallel]
+                 for task in Task.iter_tasks(self.sub_tasks)]
+        return {'query': self.query, 'analysis': self.analysis, 'first_push': self.first_push,
+                'next_id': self.next_id, 'version': self.version, 'tasks': tasks,
+                'results': {key: stored.text for key, stored in self.results.items()},
+                'scratchpad': [[title, stored.pack()] for title, stored in self.scratchpad.items()],
+                'claims': {task_id: list(claim) for task_id, claim in self.claims.items()},
+                'profile': self.profile.events, 'versions': self.versions.to_dict()}
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> 'Notebook':
+
+        results = ResultStore()
+        stored = {key: results.put(text) for key, text in state.get('results', {}).items()}
+        rows = state['tasks'] if 'tasks' in state else cls.nested_rows(state['sub_tasks'])
+
+        sub_tasks = []
+        loaded = {}
+        for task_id, parent_id, name, system, result, done, parallel in rows:
+            # Snapshots written before the result store hold the result text itself
+            stored_result = stored.get(result) or (results.put(result) if result else None)
+            task = Task(name=name, system=system, stored_result=stored_result, _done=done, id=task_id,
+                        parallel=parallel)
+            if parent_id:
+                loaded[parent_id].add_sub_task(task)
+            else:
+                task.index = len(sub_tasks)
+                sub_tasks.append(task)
+            loaded[task_id] = task
+        for task in reversed(list(loaded.values())):
+            task.update_pending()
+
+        notebook = cls(query=state['query'], analysis=state['analysis'], first_push=state['first_push'],
+                       next_id=state['next_id'], version=state.get('version', 0), sub_tasks=sub_tasks,
+                       results=results)
+        for title, stored in state.get('scratchpad', []):
+            # Snapshots written before entries were packed hold the text
+            notebook.scratchpad.put(title, StoredResult(title, stored) if isinstance(stored, str)
+                                    else StoredResult.unpack(title, stored))
+        notebook.claims = {int(task_id): tuple(claim) for task_id, claim in state.get('claims', {}).items()}
+        notebook.profile = RunProfile.from_events(state.get('profile', []))
+        notebook.versions = PlanVersions.from_dict(state.get('versions', {}))
+        notebook.index_tasks(notebook.sub_tasks)
+        notebook.cursor = notebook.first_undone(notebook.sub_tasks)
+        return notebook
 
     @staticmethod
-    def recursive_find_main(cur_task: Task, search_task: Task):
-        if cur_task is search_task:
-            return True
-        if search_task.sub_tasks:
-            for sub_task in search_task.sub_tasks:
-                find = Notebook.recursive_find_main(cur_task, sub_task)
-                if find:
-                    return True
-        return False
+    def nested_rows(tasks: List[Dict[str, Any]]) -> List[list]:
+        """Rows of the plan of a snapshot written with nested tasks (and string ids)."""
+        rows = []
+        stack = [(task, 0) for task in reversed(tasks)]
+        while stack:
+            task, parent_id = stack.pop()
+            rows.append([int(task['id']), parent_id, task['name'], task['system'], task['result'], task['done'],
+                         task.get('parallel', False)])
+            stack.extend((sub_task, int(task['id'])) for sub_task in reversed(task['sub_tasks']))
+        return rows
+
+    def find_main_task(self, cur_task: Task):
+        return cur_task.main if cur_task else None
 
     def main_task_finished(self, cur_task: Task):
         main_task = self.find_main_task(cur_task)
@@ -141,25 +926,407 @@ class Notebook:
 
     def task_switching(self, cur_task: Task):
         main_task = self.find_main_task(cur_task)
-        idx = self.sub_tasks.index(main_task)
-        return main_task.get_done() and idx < len(self.sub_tasks)-1
+        return main_task.get_done() and main_task.index < len(self.sub_tasks)-1
+
+
+DEFAULT_SESSION = 'default'
+# Longest time the idle time of a persisted session may lag behind
+TOUCH_SECONDS = 60
+
+
+class NotebookStore:
+    """Crash-safe copy of the notebooks in SQLite, so a restarted server can resume them.
 
+    Every change is appended to a journal in its own transaction; once a session has `compact_every` journal
+    entries they are folded into a snapshot of its notebook. A notebook is restored from its snapshot followed by
+    its remaining journal entries. When a store evicts or replaces intermediate results, the journal entries that
+    stored them are cut down to their title and size in the same transaction.
+    """
 
-notebook = None
+    def __init__(self, path: str, compact_every: int):
+        self.path = path
+        self.compact_every = compact_every
+        self._conn: Optional[sqlite3.Connection] = None
+        # session_id -> journal entries since the last snapshot
+        self._journal_length: Dict[str, int] = {}
+        # session_id -> when its `updated` time was last written
+        self._touched: Dict[str, float] = {}
+        # session_id -> {title: (journal row id, its args without the data)} of the stores since the last snapshot
+        self._stores: Dict[str, Dict[str, Tuple[int, str]]] = {}
+        self._lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # With WAL a commit survives a crash of the process, only a power loss can undo the last ones
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    session_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS journal (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    op TEXT NOT NULL,
+                    args TEXT NOT NULL
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS journal_session ON journal (session_id, id)')
+            self._conn = conn
+        return self._conn
+
+    def reset(self, session_id: str, notebook: Notebook):
+        with self._lock:
+            self._snapshot(session_id, notebook)
+
+    def append(self, session_id: str, notebook: Notebook, op: str, args: Dict[str, Any], dropped: List[str] = ()):
+        """Journal a change that was just applied to `notebook`, which evicted or replaced the intermediate results
+        titled `dropped`."""
+        with self._lock:
+            if self._journal_length.get(session_id, 0) + 1 >= self.compact_every:
+                self._snapshot(session_id, notebook)
+                return
+            stores = self._stores.setdefault(session_id, {})
+            conn = self.connect()
+            with conn:
+                conn.execute('BEGIN')
+                for title in dropped:
+                    if title in stores:
+                        dropped_id, dropped_args = stores.pop(title)
+                        conn.execute('UPDATE journal SET args = ? WHERE id = ?', (dropped_args, dropped_id))
+                row_id = conn.execute('INSERT INTO journal (session_id, op, args) VALUES (?, ?, ?)',
+                                      (session_id, op, json.dumps(args, ensure_ascii=False))).lastrowid
+                if op == 'store':
+                    stores[args['title']] = (row_id, self.drop_data(args))
+                # Updating the row rewrites the whole snapshot in it, so it is only done once in a while: the idle
+                # time of a session is only needed to the minute
+                now = time.time()
+                if now - self._touched.get(session_id, 0.0) >= TOUCH_SECONDS:
+                    conn.execute('UPDATE snapshots SET updated = ? WHERE session_id = ?', (now, session_id))
+                    self._touched[session_id] = now
+            self._journal_length[session_id] = self._journal_length.get(session_id, 0) + 1
+
+    def _snapshot(self, session_id: str, notebook: Notebook):
+        conn = self.connect()
+        with conn:
+            conn.execute('BEGIN')
+            conn.execute('INSERT OR REPLACE INTO snapshots (session_id, state, updated) VALUES (?, ?, ?)',
+                         (session_id, json.dumps(notebook.to_dict(), ensure_ascii=False), time.time()))
+            conn.execute('DELETE FROM journal WHERE session_id = ?', (session_id,))
+        self._journal_length[session_id] = 0
+        self._touched[session_id] = time.time()
+        self._stores.pop(session_id, None)
+
+    @staticmethod
+    def drop_data(args: Dict[str, Any]) -> str:
+        """The journal args of a store without its data: enough to replay the evictions it takes part in."""
+        return json.dumps({key: args[key] for key in ('title', 'size', 'chars', 'now')}, ensure_ascii=False)
+
+    def load(self, session_id: str, idle_ttl: float) -> Optional[Notebook]:
+        """Restore a notebook, unless it has been idle for longer than `idle_ttl` seconds."""
+        with self._lock:
+            conn = self.connect()
+            row = conn.execute('SELECT state, updated FROM snapshots WHERE session_id = ?', (session_id,)).fetchone()
+            if row is None or row[1] < time.time() - idle_ttl:
+                return None
+            entries = conn.execute('SELECT id, op, args FROM journal WHERE session_id = ? ORDER BY id',
+                                   (session_id,)).fetchall()
+            notebook = Notebook.from_dict(json.loads(row[0]))
+            stores = self._stores[session_id] = {}
+            for row_id, op, args in entries:
+                args = json.loads(args)
+                notebook.apply(op, args)
+                if op == 'store' and 'packed' in args:
+                    stores[args['title']] = (row_id, self.drop_data(args))
+            self._journal_length[session_id] = len(entries)
+            return notebook
+
+    def prune(self, idle_ttl: float):
+        """Remove the sessions that have been idle for longer than `idle_ttl` seconds."""
+        with self._lock:
+            conn = self.connect()
+            with conn:
+                conn.execute('BEGIN')
+                sessions = [row[0] for row in conn.execute('SELECT session_id FROM snapshots WHERE updated < ?',
+                                                           (time.time() - idle_ttl,))]
+                for session_id in sessions:
+                    conn.execute('DELETE FROM journal WHERE session_id = ?', (session_id,))
+                    conn.execute('DELETE FROM snapshots WHERE session_id = ?', (session_id,))
+                    self._journal_length.pop(session_id, None)
+                    self._touched.pop(session_id, None)
+                    self._stores.pop(session_id, None)
+
+
+class NotebookRegistry:
+    """Notebooks keyed by session id, so concurrent agent runs can share one server.
+
+    Entries are kept in least-recently-used order: a lookup moves its entry to the end, so both the LRU entry and
+    the longest idle ones are always at the front and eviction never scans the whole registry. With a `store`,
+    every change is also persisted, and a notebook missing from memory (after a restart, or evicted for lack of
+    room) is restored from it.
+    """
+
+    def __init__(self, max_size: int, idle_ttl: float, store: Optional[NotebookStore] = None):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.store = store
+        # Called with the session id after each change of a notebook
+        self.listeners: List[Callable[[str], None]] = []
+        # session_id -> (notebook, last used)
+        self._notebooks: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, session_id: str) -> Notebook:
+        notebook = Notebook()
+        with self._lock:
+            # Versions keep growing when a session is initialized again, for the observers of its plan
+            previous = self._notebooks.get(session_id)
+            if previous is not None:
+                notebook.version = previous[0].version
+            self._notebooks[session_id] = (notebook, time.monotonic())
+            self._notebooks.move_to_end(session_id)
+            self._evict()
+        if self.store is not None:
+            self.store.reset(session_id, notebook)
+        return notebook
+
+    def get(self, session_id: str) -> Optional[Notebook]:
+        with self._lock:
+            self._evict()
+            entry = self._notebooks.get(session_id)
+            if entry is not None:
+                self._notebooks[session_id] = (entry[0], time.monotonic())
+                self._notebooks.move_to_end(session_id)
+                return entry[0]
+        if self.store is None:
+            return None
+        notebook = self.store.load(session_id, self.idle_ttl)
+        if notebook is None:
+            return None
+        with self._lock:
+            # Another call may have restored the same session meanwhile
+            entry = self._notebooks.get(session_id)
+            if entry is not None:
+                notebook = entry[0]
+            self._notebooks[session_id] = (notebook, time.monotonic())
+            self._notebooks.move_to_end(session_id)
+            self._evict()
+        return notebook
+
+    def apply(self, session_id: str, notebook: Notebook, op: str, **args):
+        """Apply a change to a notebook and journal it."""
+        with notebook.lock:
+            version = notebook.version
+            result = notebook.apply(op, args)
+            # Only changes are journaled: a worker polling `claim_next_steps` with nothing to lease writes nothing
+            if self.store is not None and notebook.version != version:
+                # A store drops the entries it evicts and the one it replaces
+                dropped = [args['title'], *result] if op == 'store' else []
+                self.store.append(session_id, notebook, op, args, dropped)
+        if notebook.version != version:
+            for listener in self.listeners:
+                listener(session_id)
+        return result
+
+    def _evict(self):
+        deadline = time.monotonic() - self.idle_ttl
+        while self._notebooks:
+            session_id, (_, last_used) = next(iter(self._notebooks.items()))
+            if len(self._notebooks) <= self.max_size and last_used >= deadline:
+                break
+            del self._notebooks[session_id]
+
+    def __len__(self):
+        return len(self._notebooks)
+
+
+# Set to an empty string to keep the notebooks in memory only
+STATE_DB = os.environ.get('NOTEBOOK_STATE_DB', os.path.join(
+    os.path.expanduser('~'), '.cache', 'mcp_central', 'notebook', 'state.db'))
+
+notebooks = NotebookRegistry(
+    max_size=int(os.environ.get('NOTEBOOK_MAX_SESSIONS', 256)),
+    idle_ttl=float(os.environ.get('NOTEBOOK_IDLE_TTL', 24 * 3600)),
+    store=NotebookStore(STATE_DB, compact_every=int(os.environ.get('NOTEBOOK_COMPACT_EVERY', 64))) if STATE_DB else None,
+)
+if notebooks.store is not None:
+    notebooks.store.prune(notebooks.idle_ttl)
+
+
+class PlanObservers:
+    """Who is told about the changes of a notebook: the MCP clients that read its plan resource, which are sent a
+    resource-updated notification, and the `watch_plan` calls waiting for a new version.
+
+    The SDK builds a new client session object for every request, so a client is keyed by the session id of its
+    connection (`None` for stdio and sessionless clients) and each read replaces the session it is reached through.
+    Tools may run outside the event loop of the client session, so notifications are scheduled on the loop the
+    session was seen on; sessions whose notification fails (e.g. closed) are dropped.
+    """
+
+    def __init__(self):
+        # session_id -> {connection session id: (client session, its event loop)}
+        self._observers: Dict[str, Dict[Optional[str], tuple]] = {}
+        # session_id -> {(event loop, event)} of the waiting `watch_plan` calls
+        self._waiters: Dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    def add(self, session_id: str, client_id: Optional[str], client_session, loop: asyncio.AbstractEventLoop):
+        with self._lock:
+            self._observers.setdefault(session_id, {})[client_id] = (client_session, loop)
+
+    def discard(self, session_id: str, client_id: Optional[str], client_session):
+        """Drop a client, unless it has been seen through a newer session since."""
+        with self._lock:
+            observers = self._observers.get(session_id, {})
+            if client_id in observers and observers[client_id][0] is client_session:
+                del observers[client_id]
+            if not observers:
+                self._observers.pop(session_id, None)
+
+    @asynccontextmanager
+    async def waiter(self, session_id: str):
+        """An event set at the next change of the notebook."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._waiters.setdefault(session_id, set()).add(waiter)
+        try:
+            yield waiter[1]
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(session_id, set())
+                waiters.discard(waiter)
+                if not waiters:
+                    self._waiters.pop(session_id, None)
+
+    def notify(self, session_id: str):
+        with self._lock:
+            observers = list(self._observers.get(session_id, {}).items())
+            waiters = list(self._waiters.get(session_id, ()))
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The event loop is closed
+                pass
+        uri = plan_uri(session_id)
+        for client_id, (client_session, loop) in observers:
+            try:
+                future = asyncio.run_coroutine_threadsafe(client_session.send_resource_updated(uri), loop)
+            except RuntimeError:
+                self.discard(session_id, client_id, client_session)
+                continue
+
+            def done(future, client_id=client_id, client_session=client_session):
+                if not future.cancelled() and future.exception() is not None:
+                    self.discard(session_id, client_id, client_session)
+
+            future.add_done_callback(done)
+
+    def __len__(self):
+        return sum(len(observers) for observers in self._observers.values())
+
+
+def plan_uri(session_id: str) -> str:
+    return f'notebook://{session_id}/plan'
+
+
+plan_observers = PlanObservers()
+notebooks.listeners.append(plan_observers.notify)
+
+
+def connection_session_id(ctx: Optional[Context]) -> Optional[str]:
+    """The session id of the MCP connection a request came on, `None` on stdio and sessionless requests.
+
+    The SDK builds a new session object for every request, and only a stateful HTTP connection carries an id that
+    lasts across requests: `ctx.connection.session_id` where the context exposes the connection, else the
+    `mcp-session-id` header the client sends on each request of that connection.
+    """
+    if ctx is None:
+        return None
+    connection = getattr(ctx, 'connection', None)
+    if connection is not None:
+        return connection.session_id
+    request_context = ctx.request_context
+    request = request_context.request if request_context is not None else None
+    return request.headers.get('mcp-session-id') if request is not None else None
+
+
+def resolve_session(session_id: Optional[str], ctx: Optional[Context]) -> str:
+    """The given session id, else the session id of the MCP connection, so that clients never share a notebook by
+    accident. `ctx.session_id` makes up a new id per request without a stateful connection, so stdio (a single
+    client) and sessionless requests use `default` instead."""
+    return session_id or connection_session_id(ctx) or DEFAULT_SESSION
+
+
+def no_notebook(session_id: str) -> str:
+    return (f'No task found for session "{session_id}". Call `initialize_task` with this session_id first; '
+            f'idle sessions are removed after a while.')
+
+
+def plan_status(notebook: Notebook, next_task: Optional[Task], switching: bool = False, compact: bool = False,
+                show_query: bool = True) -> str:
+    if compact:
+        tasks_display = Task.format_tasks_compact(next_task, notebook.sub_tasks)
+    else:
+        tasks_display = Task.format_tasks(next_task, notebook.sub_tasks)
+    tasks_display = tasks_display.strip() if tasks_display else "No tasks found"
+
+    content = f'📋 PLAN STATUS:\n\n'
+
+    if show_query:
+        if notebook.query:
+            content += f'📝 ORIGINAL USER QUERY:\n"{notebook.query}"\n\n'
+        if notebook.analysis:
+            content += f'🎯 TASK REQUIREMENTS:\n{notebook.analysis}\n\n'
+    else:
+        content += '📝 ORIGINAL USER QUERY and 🎯 TASK REQUIREMENTS: unchanged, see `initialize_task`.\n\n'
+
+    if compact:
+        content += (f'📋 TASK LIST (finished steps folded, results shortened; call `get_step_result` with a '
+                    f'[step id] for a full result):\n{tasks_display}\n\n')
+    else:
+        content += f'📋 TASK LIST:\n{tasks_display}\n\n'
+
+    if next_task:
+        content += f'🔄 CURRENT STEP TO EXECUTE:\n"{next_task.name}"\n\n'
+
+        if switching:
+            content += ('⚠️ NOTE: Previous main task done, will move to the next main step.\n\n')
+
+        content += ('OPTIONS:\n'
+                    '1️⃣ Execute this step now and provide the results that need to be preserved.\n'
+                    '2️⃣ If this step is too complex, break it down by using `create_execution_plan` with new detailed sub-steps.\n'
+                    '3️⃣ If you need to revise your entire plan, use `create_execution_plan` with a new complete plan.\n\n'
+                    'After completing this step, call `advance_to_next_step` with a summary of your results.\n\n'
+                    'Please proceed with your chosen option:')
+    else:
+        content += ('⚠️ NO CURRENT STEP AVAILABLE. You have either:\n'
+                    '• Completed all planned steps - use `verify_task_completion` to verify completion\n'
+                    '• Not yet created a plan - use `create_execution_plan` to create one\n')
+    return content
 
 
 @mcp.tool(description='Documents the user\'s original request and task requirements. Use this at the beginning of '
                       'a complex task to record both the user\'s query and the specific success criteria. The '
                       '\'conditions_and_todo_list\' parameter should contain a structured breakdown of completion '
                       'conditions and high-level steps needed. This tool initializes the planning system and clears '
-                      'any existing plans.')
-def initialize_task(user_query: str, conditions_and_todo_list) -> str:
-    global notebook
-    notebook = Notebook()
-    notebook.query = user_query
-    notebook.analysis = conditions_and_todo_list
-    return ('Task initialized successfully. Now you should create a detailed step-by-step plan '
-            'to address the user\'s request. Break down the task into specific, actionable steps and save '
+                      'any existing plans. Without \'session_id\', every notebook tool uses the notebook of the '
+                      'current MCP connection; pass the same \'session_id\' to every tool to share a notebook '
+                      'between connections or to resume it after a reconnect.')
+def initialize_task(user_query: str, conditions_and_todo_list, session_id: Optional[str] = None,
+                    ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.create(session_id)
+    notebooks.apply(session_id, notebook, 'initialize', user_query=user_query,
+                    conditions_and_todo_list=conditions_and_todo_list, now=time.time())
+    return (f'Task initialized successfully in session "{session_id}". Now you should create a detailed '
+            'step-by-step plan to address the user\'s request. Break down the task into specific, actionable steps and save '
             'them using the `create_execution_plan` tool. Support for hierarchical plans is available - '
             'you can create nested plans with main steps and sub-steps for better organization.')
 
@@ -171,11 +1338,17 @@ def initialize_task(user_query: str, conditions_and_todo_list) -> str:
                       'to modify future plans, but each call must include the complete future plan. '
                       'After creating a plan, use `advance_to_next_step` to start executing steps sequentially. '
                       'Example format: [{"step": "Main step 1", "substeps": ["Sub-step 1.1", "Sub-step 1.2"]}, '
-                      '"Simple step without substeps", {"step": "Main step 3", "substeps": ["Sub-step 3.1"]}]')
-def create_execution_plan(plans: List[Union[str, Dict[str, Any]]]) -> str:
+                      '"Simple step without substeps", {"step": "Main step 3", "substeps": ["Sub-step 3.1"]}]. '
+                      'Add "parallel": true to a step whose substeps are independent of each other, so several '
+                      'workers can run them at the same time with `claim_next_steps`.')
+def create_execution_plan(plans: List[Union[str, Dict[str, Any]]], session_id: Optional[str] = None,
+                          ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return no_notebook(session_id)
     try:
-        global notebook
-        notebook.override_tasks(plans)
+        notebooks.apply(session_id, notebook, 'plan', rows=Task.plan_rows(plans), now=time.time())
 
         return (
             'Execution plan successfully created. Now call `advance_to_next_step` to retrieve your first action item and begin execution. '
@@ -186,58 +1359,100 @@ def create_execution_plan(plans: List[Union[str, Dict[str, Any]]]) -> str:
         return f'Error creating execution plan: {str(e)}. Please check your input format and try again.'
 
 
-@mcp.tool(description='Retrieves the next action from your execution plan and marks the current step as complete,'
-                      'or before the first step. '
-                      'Call this after finishing your current task to move to the next step. '
-                      'IMPORTANT: Include all essential information in the summary_and_result parameter - '
-                      'only this summary and the schedule will be retained between main steps. All other information '
-                      'from previous main steps will be lost, so ensure your summary contains everything needed '
-                      'to successfully complete the user\'s request. '
-                      'Main steps are automatically marked complete when all their sub-steps are completed.')
-def advance_to_next_step(summary_and_result: str = "") -> str:
-    global notebook
-    if summary_and_result:
-        notebook.first_push = False
-    current_task = notebook.get_first_task()
-
-    if current_task and summary_and_result:
-        current_task.result = summary_and_result
+def plan_version_line(versions: PlanVersions, version: int) -> str:
+    now, _, steps, done, restored = versions.get(version)
+    line = f'v{version}'
+    if now is not None:
+        line += time.strftime(' at %Y-%m-%d %H:%M:%S', time.localtime(now))
+    line += f': {steps} steps, {done} done'
+    if restored:
+        line += f', restored from v{restored}'
+    return line + (' (current)' if version == len(versions) else '')
 
-    if current_task and not notebook.first_push:
-        current_task.set_done()
 
-    next_task = notebook.get_first_task()
-    main_task = notebook.find_main_task(next_task)
+@mcp.tool(description='Lists the versions of the plan, one per `create_execution_plan` call, oldest first, with the '
+                      'number of steps and of steps done in each. Use `diff_plan_versions` to see what changed '
+                      'between two of them and `restore_plan_version` to go back to one.')
+def list_plan_versions(session_id: Optional[str] = None, ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return no_notebook(session_id)
+    with notebook.lock:
+        if not len(notebook.versions):
+            return 'No plan created yet.'
+        return '\n'.join(plan_version_line(notebook.versions, version)
+                         for version in range(1, len(notebook.versions) + 1))
 
-    tasks_display = Task.format_tasks(next_task, notebook.sub_tasks)
-    tasks_display = tasks_display.strip() if tasks_display else "No tasks found"
 
-    content = f'📋 PLAN STATUS:\n\n'
+@mcp.tool(description='Shows the changes of the plan from \'old_version\' to \'new_version\' (the current version by '
+                      'default), one step per line with the path of its main step: + added, - removed, ✓ completed, '
+                      '~ changed.')
+def diff_plan_versions(old_version: int, new_version: int = 0, session_id: Optional[str] = None,
+                       ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return no_notebook(session_id)
+    with notebook.lock:
+        versions = notebook.versions
+        new_version = new_version or len(versions)
+        for version in (old_version, new_version):
+            if versions.get(version) is None:
+                return f'No plan version {version}, see `list_plan_versions`.'
+        lines = versions.diff(old_version, new_version)
+        header = f'{plan_version_line(versions, old_version)}\n{plan_version_line(versions, new_version)}\n\n'
+    return header + ('\n'.join(lines) if lines else 'No changes.')
 
-    if notebook.query:
-        content += f'📝 ORIGINAL USER QUERY:\n"{notebook.query}"\n\n'
-    if notebook.analysis:
-        content += f'🎯 TASK REQUIREMENTS:\n{notebook.analysis}\n\n'
 
-    content += f'📋 TASK LIST:\n{tasks_display}\n\n'
+@mcp.tool(description='Goes back to an earlier version of the plan: the steps that were still to do in that version '
+                      'replace the steps to do now, as if it was given to `create_execution_plan` again. Steps '
+                      'already done and their results are kept, and steps of that version completed since are not '
+                      'added again. This adds a new version.')
+def restore_plan_version(version: int, session_id: Optional[str] = None, ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return no_notebook(session_id)
+    with notebook.lock:
+        if notebook.versions.get(version) is None:
+            return f'No plan version {version}, see `list_plan_versions`.'
+        # Steps done since that version are not done again
+        done_paths = frozenset(notebook.task_path(task) for task in Task.iter_tasks(notebook.sub_tasks)
+                               if task.get_done())
+        notebooks.apply(session_id, notebook, 'plan', rows=notebook.versions.plan_rows(version, done_paths),
+                        restored=version, now=time.time())
+        return (f'Restored the plan of v{version} as v{len(notebook.versions)}. Call `advance_to_next_step` to '
+                f'continue with its next step.')
 
-    if next_task:
-        content += f'🔄 CURRENT STEP TO EXECUTE:\n"{next_task.name}"\n\n'
 
-        if not notebook.first_push and notebook.task_switching(current_task):
-            content += ('⚠️ NOTE: Previous main task done, will move to the next main step.\n\n')
+@mcp.tool(description='Retrieves the next action from your execution plan and marks the current step as complete,'
+                      'or before the first step. '
+                      'Call this after finishing your current task to move to the next step. '
+                      'IMPORTANT: Include all essential information in the summary_and_result parameter - '
+                      'only this summary and the schedule will be retained between main steps. All other information '
+                      'from previous main steps will be lost, so ensure your summary contains everything needed '
+                      'to successfully complete the user\'s request. '
+                      'Main steps are automatically marked complete when all their sub-steps are completed. '
+                      'Set \'compact\' to fold finished steps and shorten their results in the plan shown.')
+def advance_to_next_step(summary_and_result: str = "", session_id: Optional[str] = None,
+                         compact: Optional[bool] = None, ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return json.dumps([no_notebook(session_id), None], ensure_ascii=False)
+    if compact is None:
+        compact = RENDER_MODE == 'compact'
+    with notebook.lock:
+        first_push = notebook.first_push
+        _, switching = notebooks.apply(session_id, notebook, 'advance', summary_and_result=summary_and_result,
+                                       now=time.time())
 
-        content += ('OPTIONS:\n'
-                    '1️⃣ Execute this step now and provide the results that need to be preserved.\n'
-                    '2️⃣ If this step is too complex, break it down by using `create_execution_plan` with new detailed sub-steps.\n'
-                    '3️⃣ If you need to revise your entire plan, use `create_execution_plan` with a new complete plan.\n\n'
-                    'After completing this step, call `advance_to_next_step` with a summary of your results.\n\n'
-                    'Please proceed with your chosen option:')
-    else:
-        content += ('⚠️ NO CURRENT STEP AVAILABLE. You have either:\n'
-                    '• Completed all planned steps - use `verify_task_completion` to verify completion\n'
-                    '• Not yet created a plan - use `create_execution_plan` to create one\n')
-    notebook.first_push = False
+        next_task = notebook.get_first_task()
+        main_task = notebook.find_main_task(next_task)
+        # Clients drop the history when a main step is done, so the query is repeated then
+        content = plan_status(notebook, next_task, switching, compact=compact,
+                              show_query=not compact or first_push or switching)
     next_step_system = None
     if main_task:
         next_step_system = main_task.system
@@ -249,12 +1464,16 @@ def advance_to_next_step(summary_and_result: str = "") -> str:
                 'you\'ve finished all planned tasks. It will display the original query, success criteria, and '
                 'any remaining plans for verification. Use this final check to ensure all requirements have been '
                 'met before delivering your response to the user.')
-def verify_task_completion() -> str:
-    global notebook
+def verify_task_completion(session_id: Optional[str] = None, ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return no_notebook(session_id)
 
     # Get tasks status
-    next_task = notebook.get_first_task()
-    tasks_display = Task.format_tasks(next_task, notebook.sub_tasks)
+    with notebook.lock:
+        next_task = notebook.get_first_task()
+        tasks_display = Task.format_tasks(next_task, notebook.sub_tasks)
     tasks_display = tasks_display.strip() if tasks_display else "None"
 
     # Check for unfinished tasks
@@ -281,5 +1500,219 @@ def verify_task_completion() -> str:
     return content
 
 
+@mcp.tool(description='Claims up to \'n\' steps of the plan for a worker, when several workers execute one plan at the '
+                      'same time. Main steps still run one after the other, but the substeps of a step marked '
+                      '"parallel" can be claimed by different workers. A claim is a lease of \'lease_seconds\': '
+                      'complete each step with `complete_step` before it runs out, or another worker may claim it. '
+                      'Returns a JSON object with the claimed steps; when it is empty, wait for the other workers '
+                      'or stop if the plan is finished.')
+def claim_next_steps(n: int = 1, worker_id: str = 'worker', lease_seconds: float = LEASE_SECONDS,
+                     session_id: Optional[str] = None, ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return json.dumps({'steps': [], 'message': no_notebook(session_id)}, ensure_ascii=False)
+    with notebook.lock:
+        claimed = notebooks.apply(session_id, notebook, 'claim', n=n, worker_id=worker_id,
+                                  lease_seconds=lease_seconds, now=time.time())
+        steps = [{'step_id': task.id, 'step': task.name, 'main_step': task.main.name, 'system': task.main.system}
+                 for task in claimed]
+        if steps:
+            message = f'Claimed {len(steps)} step(s) for {lease_seconds:g} seconds.'
+        elif notebook.get_first_task() is None:
+            message = 'No step left, the plan is finished. Use `verify_task_completion` to verify completion.'
+        else:
+            message = 'Every ready step is claimed by another worker, try again once they are completed.'
+    return json.dumps({'steps': steps, 'message': message}, ensure_ascii=False)
+
+
+@mcp.tool(description='Completes a step claimed with `claim_next_steps`, storing its result. Include everything the '
+                      'later steps need in \'result\'.')
+def complete_step(step_id: str, result: str = '', worker_id: str = 'worker', session_id: Optional[str] = None,
+                  ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return no_notebook(session_id)
+    with notebook.lock:
+        try:
+            task = notebooks.apply(session_id, notebook, 'complete', step_id=step_id,
+                                   result=result, worker_id=worker_id, now=time.time())
+        except ValueError as e:
+            return str(e)
+        left = sum(main_task.pending for main_task in notebook.sub_tasks)
+    return f'Step [{task.id}] "{task.name}" completed, {left} step(s) left.'
+
+
+@mcp.tool(description='Returns the full result of a finished step by the step id shown in brackets in the plan. '
+                      'The plan shown by `advance_to_next_step` in compact mode only has a short preview of each '
+                      'result; call this when you need the whole text of one.')
+def get_step_result(step_id: str, session_id: Optional[str] = None, ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return no_notebook(session_id)
+    with notebook.lock:
+        task = notebook.get_task(step_id)
+        if task is None:
+            return f'No step with id "{step_id}" in the plan.'
+        if not task.stored_result:
+            return f'Step [{task.id}] "{task.name}" has no result yet.'
+        return task.result
+
+
+@mcp.tool(description='Saves a large intermediate result, such as a crawled page or search results, in the notebook '
+                      'under a short descriptive title, so it can be dropped from the conversation and fetched again '
+                      'later with `fetch_intermediate_result`. \'data\' is the text to keep. Storing a title again '
+                      'replaces it; the oldest results are removed when the notebook runs out of room.')
+def store_intermediate_results(title: str, data: str = '', session_id: Optional[str] = None,
+                               ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return no_notebook(session_id)
+    if not data:
+        return f'Nothing to store under "{title}": \'data\' is empty.'
+    # Compressed once here; the journal keeps the compressed bytes
+    stored = StoredResult(title, data)
+    evicted = notebooks.apply(session_id, notebook, 'store', title=title, packed=stored.pack(),
+                              size=len(stored.data), chars=stored.length, now=time.time())
+    content = f'Stored "{title}" ({stored.length} characters) in the notebook.'
+    if evicted:
+        content += ' Removed to make room: ' + ', '.join(f'"{evicted_title}"' for evicted_title in evicted) + '.'
+    return content
+
+
+@mcp.tool(description='Lists the intermediate results stored with `store_intermediate_results`, oldest first, with '
+                      'their size and the beginning of their text.')
+def list_intermediate_results(session_id: Optional[str] = None, ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return no_notebook(session_id)
+    # Tools run in worker threads, so the scratchpad is read under the lock its stores hold
+    with notebook.lock:
+        items = notebook.scratchpad.items()
+    if not items:
+        return 'No intermediate results stored.'
+    return '\n'.join(f'- "{title}" ({stored.length} characters): {stored.preview}' for title, stored in items)
+
+
+@mcp.tool(description='Returns an intermediate result stored with `store_intermediate_results` by its title. Long '
+                      'results are returned in parts of at most \'max_chars\' characters, starting at \'offset\'.')
+def fetch_intermediate_result(title: str, offset: int = 0, max_chars: int = 20000,
+                              session_id: Optional[str] = None, ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return no_notebook(session_id)
+    with notebook.lock:
+        stored = notebook.scratchpad.get(title)
+    if stored is None:
+        return f'No intermediate result titled "{title}", see `list_intermediate_results`.'
+    end = offset + max_chars
+    content = stored.text[offset:end]
+    if end < stored.length:
+        content += (f'\n\n[{stored.length - end} more characters, call `fetch_intermediate_result` with '
+                    f'offset={end}]')
+    return content
+
+
+@mcp.tool(description='Searches the intermediate results stored with `store_intermediate_results` for the words of '
+                      'the query, and returns the titles of the best matches with a snippet of each.')
+def search_intermediate_results(query: str, top_k: int = 5, session_id: Optional[str] = None,
+                                ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return no_notebook(session_id)
+    with notebook.lock:
+        found = notebook.scratchpad.search(query, top_k)
+    if not found:
+        return f'No intermediate result matches "{query}".'
+    return '\n\n'.join(f'"{title}" ({matches} matches): {snippet}' for title, matches, snippet in found)
+
+
+@mcp.resource('notebook://{session_id}/plan', mime_type='application/json',
+              description='Read-only live view of the notebook of a session: the query, every step with its status, '
+                          'result preview and claim, the current step and a version that grows with each change. '
+                          'Reading it does not change the notebook, and the client that read it is sent a '
+                          'resource-updated notification each time the plan changes, so it does not need to poll.')
+async def notebook_plan(session_id: str, ctx: Context) -> str:
+    plan_observers.add(session_id, connection_session_id(ctx), ctx.session, asyncio.get_running_loop())
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return json.dumps({'session_id': session_id, 'version': None, 'error': no_notebook(session_id)},
+                          ensure_ascii=False)
+    return notebook.plan_json(session_id)
+
+
+@mcp.tool(description='Waits until the plan of a session changes and returns it, for observers such as a UI showing '
+                      'the live plan, which cannot receive resource notifications. Returns the JSON of the '
+                      '`notebook://{session_id}/plan` resource as soon as its version is greater than '
+                      '\'since_version\' (at once with 0), or after \'timeout\' seconds unchanged; pass the '
+                      'returned version to the next call. Does not change the notebook.')
+async def watch_plan(since_version: int = 0, timeout: float = 30, session_id: Optional[str] = None,
+                     ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    deadline = time.monotonic() + max(0.0, min(timeout, WATCH_MAX_SECONDS))
+    while True:
+        async with plan_observers.waiter(session_id) as changed:
+            notebook = notebooks.get(session_id)
+            remaining = deadline - time.monotonic()
+            if notebook is not None and (notebook.version > since_version or remaining <= 0):
+                return notebook.plan_json(session_id)
+            if remaining <= 0:
+                return json.dumps({'session_id': session_id, 'version': None, 'error': no_notebook(session_id)},
+                                  ensure_ascii=False)
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+
+@mcp.tool(description='Profiles the run of a session: its wall-clock time, the number of plans and re-plans, the '
+                      'steps started, completed and dropped by a re-plan, the result sizes, the timeline of each main '
+                      'step and the \'top\' slowest steps, as JSON with times in seconds since the start of the run. '
+                      'With \'export_path\', every event and step of the run is also appended to that file as JSON '
+                      'lines for offline analysis. Does not change the notebook.')
+def notebook_profile(session_id: Optional[str] = None, top: int = 10, export_path: str = '',
+                     ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return no_notebook(session_id)
+    with notebook.lock:
+        profile = notebook.profile
+        content = {'session_id': session_id, 'version': notebook.version, **profile.summary(top),
+                   'steps_left': sum(task.pending for task in notebook.sub_tasks)}
+        if export_path:
+            lines = [{'session_id': session_id, 'record': 'event', 'time': now, 'event': event, 'step_id': step_id,
+                      **details} for now, event, step_id, details in profile.events]
+            lines += [{'session_id': session_id, 'record': 'step', 'run_started_at': content['started_at'], **row}
+                      for row in profile.steps()]
+    if export_path:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(export_path)), exist_ok=True)
+            with open(export_path, 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(line, ensure_ascii=False) + '\n' for line in lines)
+        except OSError as e:
+            return f'Error exporting the profile to {export_path}: {e}'
+        content['exported'] = {'path': export_path, 'lines': len(lines)}
+    return json.dumps(content, ensure_ascii=False)
+
+
+@mcp.tool(description='Resumes a task after the notebook server restarted, without losing the plan or any step '
+                      'result. Shows the plan status and the current step, without completing it; continue with '
+                      '`advance_to_next_step` once that step is done.')
+def resume_task(session_id: Optional[str] = None, ctx: Optional[Context] = None) -> str:
+    session_id = resolve_session(session_id, ctx)
+    notebook = notebooks.get(session_id)
+    if notebook is None:
+        return no_notebook(session_id)
+    with notebook.lock:
+        return plan_status(notebook, notebook.get_first_task())
+
+
 if __name__ == "__main__":
     mcp.run(transport="stdio")
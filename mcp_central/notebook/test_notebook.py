@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Notebook MCP server tests, runnable with pytest or directly with python.
+The notebooks are kept in a temporary state db.
+"""
+
+import asyncio
+import os
+import tempfile
+from unittest import mock
+
+os.environ['NOTEBOOK_STATE_DB'] = os.path.join(tempfile.mkdtemp(), 'state.db')
+
+from fastmcp import Client
+from mcp.server.session import ServerSession
+
+import server
+
+
+def test_plan_resource_observers():
+    """Reading the plan resource again keeps one observer per client, sent one notification per change."""
+    sent = []
+    send_resource_updated = ServerSession.send_resource_updated
+
+    async def send(self, uri):
+        sent.append(str(uri))
+        await send_resource_updated(self, uri)
+
+    async def run():
+        async with Client(server.mcp) as client:
+            await client.call_tool('initialize_task', {'user_query': 'observe', 'conditions_and_todo_list': '-',
+                                                       'session_id': 'observed'})
+            for _ in range(4):
+                await client.read_resource(server.plan_uri('observed'))
+            assert len(server.plan_observers) == 1, len(server.plan_observers)
+
+            await client.call_tool('create_execution_plan', {'plans': ['a', 'b'], 'session_id': 'observed'})
+            await asyncio.sleep(0.1)
+            assert len(server.plan_observers) == 1, len(server.plan_observers)
+            assert sent == [server.plan_uri('observed')], sent
+
+    with mock.patch.object(ServerSession, 'send_resource_updated', send):
+        asyncio.run(run())
+
+
+def test_restore_plan_version_after_progress():
+    """Restoring an earlier plan version does not bring back the steps completed since."""
+    session = {'session_id': 'restored'}
+    server.initialize_task('restore', '-', **session)
+    server.create_execution_plan([{'step': 'M1', 'substeps': ['a', 'b']}, 'M2',
+                                  {'step': 'M3', 'substeps': ['c', 'd']}, 'M4'], **session)
+    server.advance_to_next_step(**session)
+    for result in ('result a', 'result b', 'result M2', 'result c'):
+        server.advance_to_next_step(result, **session)
+    server.create_execution_plan(['other'], **session)
+    server.restore_plan_version(1, **session)
+
+    notebook = server.notebooks.get('restored')
+    undone = [notebook.task_path(task) for task in server.Task.iter_tasks(notebook.sub_tasks)
+              if not task.sub_tasks and not task.get_done()]
+    assert undone == [('M3', 'd'), ('M4',)], undone
+    assert notebook.get_first_task().name == 'd'
+    results = [task.result for task in server.Task.iter_tasks(notebook.sub_tasks) if task.get_done()]
+    assert results == ['', 'result a', 'result b', 'result M2', '', 'result c'], results
+    assert server.list_plan_versions(**session).splitlines()[-1].endswith(
+        '9 steps, 6 done, restored from v1 (current)')
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print(f'✅ {name}')
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Benchmark the OCR server on a fixed corpus of PDF files, or on synthetic scanned documents generated locally.
+
+    python benchmark.py --corpus /path/to/pdfs --profiles fast,balanced,archival
+    python benchmark.py --synthetic --documents 8 --pages 4 --dpi 200 --concurrency 1,4
+    python benchmark.py --search-pages 20000
+
+A PDF with a `<name>.gt.txt` file next to it (pages separated by form feeds) also gets a character-accuracy check.
+Every profile and concurrency runs in a process of its own, so the peak RSS reported for it only covers its own
+OCR processes. `--search-pages` instead indexes that many pages of synthetic OCR text and times `search_ocr_corpus`
+queries against them, and re-indexing one document.
+"""
+
+import argparse
+import asyncio
+import difflib
+import glob
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageFont
+
+from server import PAGE_SEPARATOR, PROFILES, SearchIndex, iter_sidecar_pages, ocr_pdf
+
+LATIN_WORDS = ('the quick brown fox jumps over lazy dog scanned archive invoice report contract page total amount '
+               'date signature table figure section result method data model server request value').split()
+CJK_CHARS = '的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定'
+CJK_FONTS = [
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/truetype/wqy/wqy-microhei.ttc',
+    '/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc',
+    '/System/Library/Fonts/PingFang.ttc',
+    'C:/Windows/Fonts/msyh.ttc',
+]
+LATIN_FONTS = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/System/Library/Fonts/Helvetica.ttc',
+    'C:/Windows/Fonts/arial.ttf',
+]
+
+
+def find_font(candidates):
+    for path in candidates:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def random_line(rng, cjk):
+    kind = rng.choice(['latin', 'cjk', 'mixed']) if cjk else 'latin'
+    if kind == 'latin':
+        return ' '.join(rng.choice(LATIN_WORDS) for _ in range(rng.randint(5, 9)))
+    if kind == 'cjk':
+        return ''.join(rng.choice(CJK_CHARS) for _ in range(rng.randint(10, 18)))
+    return (' '.join(rng.choice(LATIN_WORDS) for _ in range(3)) + ' '
+            + ''.join(rng.choice(CJK_CHARS) for _ in range(6)))
+
+
+def render_page(lines, font, dpi, rng, noise, max_rotation):
+    """Render text lines on an A4 page and degrade it like a scan: speckles, blur and a small skew."""
+    width, height = int(8.27 * dpi), int(11.69 * dpi)
+    page = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(page)
+    margin = dpi
+    line_height = int(font.size * 1.6)
+    for idx, line in enumerate(lines):
+        draw.text((margin, margin + idx * line_height), line, font=font, fill=0)
+    if noise > 0:
+        # Only the darkest values of the gaussian noise are kept, as isolated black speckles
+        speckles = Image.effect_noise((width, height), 64).point(lambda v: 0 if v < 128 - 3 * 64 * noise else 255)
+        page = ImageChops.darker(page, speckles)
+        page = page.filter(ImageFilter.GaussianBlur(0.6))
+    if max_rotation > 0:
+        page = page.rotate(rng.uniform(-max_rotation, max_rotation), resample=Image.BICUBIC, fillcolor=255)
+    return page
+
+
+def generate_corpus(output_dir, documents, pages, dpi, seed, font_path=None, cjk=True, noise=0.3,
+                    max_rotation=1.5):
+    """Write `documents` PDFs of `pages` scanned pages each, with their ground truth in `<name>.gt.txt`."""
+    rng = random.Random(seed)
+    if font_path is None and cjk:
+        font_path = find_font(CJK_FONTS)
+        if font_path is None:
+            print('No CJK font found (use --font), generating Latin-only pages')
+            cjk = False
+    font_path = font_path or find_font(LATIN_FONTS)
+    font_size = int(dpi * 0.17)
+    font = ImageFont.truetype(font_path, font_size) if font_path else ImageFont.load_default(font_size)
+    lines_per_page = int((11.69 * dpi - 2 * dpi) / (font_size * 1.6))
+
+    os.makedirs(output_dir, exist_ok=True)
+    corpus = []
+    for doc_idx in range(documents):
+        texts = []
+        images = []
+        for _ in range(pages):
+            lines = [random_line(rng, cjk) for _ in range(lines_per_page)]
+            texts.append('\n'.join(lines))
+            images.append(render_page(lines, font, dpi, rng, noise, max_rotation))
+        pdf_path = os.path.join(output_dir, f'synthetic_{doc_idx:03d}.pdf')
+        images[0].save(pdf_path, save_all=True, append_images=images[1:], resolution=dpi)
+        with open(ground_truth_path(pdf_path), 'w', encoding='utf-8') as f:
+            f.write(PAGE_SEPARATOR.join(texts))
+        corpus.append(pdf_path)
+    return corpus
+
+
+def ground_truth_path(pdf_path):
+    return os.path.splitext(pdf_path)[0] + '.gt.txt'
+
+
+def char_accuracy(expected, actual):
+    """Similarity of the two texts with whitespace removed, since Tesseract spaces CJK text differently."""
+    expected = ''.join(expected.split())
+    actual = ''.join(actual.split())
+    if not expected:
+        return 1.0 if not actual else 0.0
+    return difflib.SequenceMatcher(None, expected, actual, autojunk=False).ratio()
+
+
+def document_accuracy(pdf_path, sidecar):
+    gt_path = ground_truth_path(pdf_path)
+    if not os.path.isfile(gt_path):
+        return None
+    with open(gt_path, 'r', encoding='utf-8') as f:
+        expected = f.read().split(PAGE_SEPARATOR)
+    actual = list(iter_sidecar_pages(sidecar))
+    actual += [''] * (len(expected) - len(actual))
+    return sum(char_accuracy(e, a) for e, a in zip(expected, actual)) / len(expected)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, round(pct / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def peak_child_rss_mb():
+    # ru_maxrss is the largest resident set of any finished child process over the lifetime of this process (which
+    # is why each configuration runs in a process of its own): KB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+async def run_config(profile, concurrency, corpus, output_dir, language=None):
+    limit = asyncio.Semaphore(concurrency)
+
+    async def run_one(input_pdf):
+        output_pdf = os.path.join(output_dir, f'{profile}_c{concurrency}', os.path.basename(input_pdf))
+        os.makedirs(os.path.dirname(output_pdf), exist_ok=True)
+        async with limit:
+            start = time.perf_counter()
+            result = json.loads(await ocr_pdf(input_pdf, output_pdf, preview_chars=0, profile=profile,
+                                              language=language))
+            seconds = time.perf_counter() - start
+        if not result['success']:
+            print(f"  {os.path.basename(input_pdf)}: {result['error'].strip()}")
+            return None
+        return {
+            'file': os.path.basename(input_pdf),
+            'pages': result['pages'],
+            'seconds': seconds,
+            'language': result['language'],
+            'size_ratio': os.path.getsize(output_pdf) / os.path.getsize(input_pdf),
+            'accuracy': document_accuracy(input_pdf, result['sidecar']),
+        }
+
+    start = time.perf_counter()
+    rows = await asyncio.gather(*[run_one(input_pdf) for input_pdf in corpus])
+    return [row for row in rows if row], time.perf_counter() - start
+
+
+def run_config_process(profile, concurrency, corpus_list, output_dir, language=None):
+    """Run one configuration in a child process and return its rows, wall time and the peak RSS of its OCR runs."""
+    command = [sys.executable, os.path.abspath(__file__), '--config', f'{profile}:{concurrency}',
+               '--corpus-list', corpus_list, '--output', output_dir]
+    if language:
+        command += ['--language', language]
+    completed = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
+    # Failed files are reported on the lines before the result
+    *messages, result = completed.stdout.rstrip().splitlines()
+    for message in messages:
+        print(message)
+    result = json.loads(result)
+    return result['rows'], result['wall_seconds'], result['peak_rss_mb']
+
+
+def benchmark_search(pages, pages_per_document, seed, queries_per_kind=50):
+    """Index synthetic sidecars of `pages` pages in total, then time queries of several kinds against the index."""
+    rng = random.Random(seed)
+    lines_per_page = 40
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index = SearchIndex(os.path.join(tmp_dir, 'index.db'))
+        start = time.perf_counter()
+        for doc_idx in range(0, pages, pages_per_document):
+            sidecar = os.path.join(tmp_dir, f'doc_{doc_idx:06d}.txt')
+            with open(sidecar, 'w', encoding='utf-8') as f:
+                for _ in range(min(pages_per_document, pages - doc_idx)):
+                    f.write('\n'.join(random_line(rng, True) for _ in range(lines_per_page)) + PAGE_SEPARATOR)
+            index.add_document(sidecar.replace('.txt', '.pdf'), sidecar)
+        index_seconds = time.perf_counter() - start
+        print(f"indexed pages={pages} seconds={index_seconds:.1f} "
+              f"size_mb={os.path.getsize(index.path) / (1024 * 1024):.1f}")
+
+        def cjk(length):
+            return ''.join(rng.choice(CJK_CHARS) for _ in range(length))
+
+        kinds = {
+            'cjk_char': lambda: cjk(1),
+            'cjk_2': lambda: cjk(2),
+            'cjk_4': lambda: cjk(4),
+            'latin_word': lambda: rng.choice(LATIN_WORDS),
+            'latin_2': lambda: f'{rng.choice(LATIN_WORDS)} {rng.choice(LATIN_WORDS)}',
+            'mixed': lambda: f'{rng.choice(LATIN_WORDS)} {cjk(2)}',
+        }
+        for kind, make_query in kinds.items():
+            latencies = []
+            hits = 0
+            for _ in range(queries_per_kind):
+                query_start = time.perf_counter()
+                hits += bool(index.search(make_query(), 10))
+                latencies.append(time.perf_counter() - query_start)
+            print(f"{kind:<12} queries={queries_per_kind:<4} with_hits={hits:<4} "
+                  f"p50_ms={percentile(latencies, 50) * 1000:<7.1f} p99_ms={percentile(latencies, 99) * 1000:<7.1f}")
+
+        # Re-indexing a document replaces its chunks, as when a file is OCRed again
+        sidecar = os.path.join(tmp_dir, 'doc_000000.txt')
+        latencies = []
+        for _ in range(10):
+            reindex_start = time.perf_counter()
+            index.add_document(sidecar.replace('.txt', '.pdf'), sidecar)
+            latencies.append(time.perf_counter() - reindex_start)
+        print(f"{'reindex':<12} documents=10   pages={min(pages_per_document, pages):<5} "
+              f"p50_ms={percentile(latencies, 50) * 1000:<7.1f} p99_ms={percentile(latencies, 99) * 1000:<7.1f}")
+
+
+def report(profile, concurrency, rows, wall_seconds, peak_rss_mb):
+    name = f'{profile} x{concurrency}'
+    if not rows:
+        print(f"{name:<16} no successful runs")
+        return
+    pages = sum(row['pages'] for row in rows)
+    latencies = [row['seconds'] for row in rows]
+    size_ratio = sum(row['size_ratio'] for row in rows) / len(rows)
+    accuracies = [row['accuracy'] for row in rows if row['accuracy'] is not None]
+    accuracy = f'{sum(accuracies) / len(accuracies):.3f}' if accuracies else 'n/a'
+    languages = sorted({row['language'] for row in rows})
+    print(f"{name:<16} files={len(rows):<4} pages={pages:<5} pages/sec={pages / wall_seconds:<6.2f} "
+          f"p50={percentile(latencies, 50):<6.2f} p90={percentile(latencies, 90):<6.2f} "
+          f"p99={percentile(latencies, 99):<6.2f} peak_rss_mb={peak_rss_mb:<7.1f} "
+          f"size_ratio={size_ratio:<5.2f} accuracy={accuracy} languages={','.join(languages)}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', type=str, default=None, help='Directory of the PDF files to OCR')
+    parser.add_argument('--synthetic', action='store_true', help='Generate scanned documents instead of a corpus')
+    parser.add_argument('--documents', type=int, default=8)
+    parser.add_argument('--pages', type=int, default=4)
+    parser.add_argument('--dpi', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--font', type=str, default=None, help='TrueType font for the synthetic pages')
+    parser.add_argument('--latin-only', action='store_true', help='Do not mix CJK text into the synthetic pages')
+    parser.add_argument('--profiles', type=str, default=','.join(PROFILES))
+    parser.add_argument('--concurrency', type=str, default='1', help='Comma-separated numbers of concurrent calls')
+    parser.add_argument('--language', type=str, default=None, help='Override the language of every profile')
+    parser.add_argument('--output', type=str, default=None, help='Directory for the OCR output, a temp dir by default')
+    parser.add_argument('--search-pages', type=int, default=0, help='Benchmark the search index on this many pages')
+    parser.add_argument('--pages-per-document', type=int, default=50)
+    # Used by the benchmark itself to run one configuration in a child process
+    parser.add_argument('--config', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--corpus-list', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.config:
+        profile, concurrency = args.config.split(':')
+        with open(args.corpus_list, 'r', encoding='utf-8') as f:
+            corpus = json.load(f)
+        rows, wall_seconds = await run_config(profile, int(concurrency), corpus, args.output, args.language)
+        print(json.dumps({'rows': rows, 'wall_seconds': wall_seconds, 'peak_rss_mb': peak_child_rss_mb()}))
+        return
+    if args.search_pages:
+        benchmark_search(args.search_pages, args.pages_per_document, args.seed)
+        return
+    if not args.corpus and not args.synthetic:
+        parser.error('either --corpus or --synthetic is required')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_dir = args.output or tmp_dir
+        if args.synthetic:
+            corpus = generate_corpus(os.path.join(output_dir, 'corpus'), args.documents, args.pages, args.dpi,
+                                     args.seed, args.font, cjk=not args.latin_only)
+        else:
+            # Sorted, so every run sees the files in the same order
+            corpus = sorted(glob.glob(os.path.join(args.corpus, '*.pdf')))
+        if not corpus:
+            raise FileNotFoundError(f'No PDF files found in {args.corpus}')
+        corpus_list = os.path.join(tmp_dir, 'corpus.json')
+        with open(corpus_list, 'w', encoding='utf-8') as f:
+            json.dump(corpus, f)
+        for profile in args.profiles.split(','):
+            for concurrency in map(int, args.concurrency.split(',')):
+                rows, wall_seconds, peak_rss_mb = run_config_process(profile, concurrency, corpus_list, output_dir,
+                                                                     args.language)
+                report(profile, concurrency, rows, wall_seconds, peak_rss_mb)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
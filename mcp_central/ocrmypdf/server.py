@@ -1,36 +1,1104 @@
+import asyncio
+import glob
+import hashlib
 import json
-import subprocess
+import logging
+import os
+import re
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import ExitStack, asynccontextmanager
+from logging.handlers import RotatingFileHandler
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union
+
+import img2pdf
+import pikepdf
+from PIL import Image
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
 from fastmcp import FastMCP
 
 mcp = FastMCP("ocrmypdf_server")
 
-@mcp.tool(description='A tool to perform OCR on a PDF file and return the extracted text.')
-async def ocr_pdf(input_pdf: str, output_pdf: str) -> str:
+# Stdout carries the stdio MCP transport, so diagnostics only go to the logger (stderr by default)
+logger = logging.getLogger(__name__)
+
+# Tesseract terminates the text of every page in the sidecar file with a form feed
+PAGE_SEPARATOR = '\f'
+PREVIEW_CHARS = 2000
+READ_CHUNK_SIZE = 64 * 1024
+MANIFEST_NAME = 'ocr_manifest.json'
+# Image formats that are assembled into a PDF before OCR
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.jp2', '.tif', '.tiff', '.bmp', '.gif')
+# Most PDF files kept open at once while merging; longer lists are merged in rounds through intermediate files
+MERGE_MAX_OPEN = max(2, int(os.environ.get('OCR_MERGE_MAX_OPEN', 0)) or 256)
+# Total number of OCR threads shared by all running jobs
+CPU_BUDGET = int(os.environ.get('OCR_CPU_BUDGET', 0)) or os.cpu_count() or 1
+# Most threads a single job may take, so a big job started on an idle server leaves room for the next ones
+JOB_MAX_THREADS = int(os.environ.get('OCR_JOB_MAX_THREADS', 0)) or CPU_BUDGET
+# Wall-clock limit of one ocrmypdf run in seconds, 0 for none
+JOB_TIMEOUT = float(os.environ.get('OCR_JOB_TIMEOUT', 0)) or None
+# Address space limit of each process of an ocrmypdf run in MB, 0 for none. Not supported on Windows.
+JOB_MEMORY_MB = int(os.environ.get('OCR_JOB_MEMORY_MB', 0)) or None
+# `prlimit` from util-linux, which sets the limit before the command runs
+PRLIMIT = shutil.which('prlimit') if sys.platform.startswith('linux') else None
+
+DEFAULT_LANGUAGE = 'eng+chi_sim'
+AUTO_LANGUAGE = 'auto'
+# Resolution of the sample page rendered for language detection
+DETECT_DPI = 150
+# Resolution of the page renderings hashed to find changed pages
+FINGERPRINT_DPI = 100
+# Per-page OCR output of `ocr_pdf_incremental`, keyed by page fingerprint, profile and language
+PAGE_CACHE_DIR = os.environ.get('OCR_PAGE_CACHE_DIR') or os.path.join(
+    os.path.expanduser('~'), '.cache', 'mcp_central', 'ocrmypdf', 'pages')
+# Full-text index of every finished OCR job
+INDEX_PATH = os.environ.get('OCR_INDEX_PATH') or os.path.join(
+    os.path.expanduser('~'), '.cache', 'mcp_central', 'ocrmypdf', 'index.db')
+# Pages are indexed in chunks of about this many characters, split at line breaks
+INDEX_CHUNK_CHARS = 500
+# Schema version of the index in `PRAGMA user_version`; older indexes are rebuilt from their sidecars
+INDEX_VERSION = 2
+SNIPPET_CHARS = 160
+# ocrmypdf output of every job is written to `<job_id>.log` here, rotated at LOG_MAX_BYTES
+LOG_DIR = os.environ.get('OCR_LOG_DIR') or os.path.join(
+    os.path.expanduser('~'), '.cache', 'mcp_central', 'ocrmypdf', 'logs')
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 2
+# Lines of ocrmypdf output kept in memory per job, for error messages and `ocr_metrics`
+LOG_TAIL_LINES = 50
+# Longest output line kept; longer lines are cut
+LOG_LINE_CHARS = 1000
+# Metrics of this many most recent jobs are kept
+METRICS_MAX_JOBS = 1000
+# ocrmypdf prefixes the messages about one page with its number, e.g. `   3 Rasterize with png16m, rotation 0`
+PAGE_LINE = re.compile(r'^\s*(\d+) ')
+
+# Each profile is a set of extra ocrmypdf arguments and the language used when the caller does not give one
+PROFILES = {
+    # A single Tesseract model, no image optimization and a plain PDF instead of PDF/A
+    'fast': {'args': ['--optimize', '0', '--output-type', 'pdf'], 'language': AUTO_LANGUAGE},
+    'balanced': {'args': ['--optimize', '1'], 'language': DEFAULT_LANGUAGE},
+    # Straightened, upright pages with the strongest lossless optimization in a PDF/A file
+    'archival': {'args': ['--optimize', '2', '--deskew', '--rotate-pages', '--output-type', 'pdfa'],
+                 'language': DEFAULT_LANGUAGE},
+}
+DEFAULT_PROFILE = 'balanced'
+
+# Tesseract OSD script name -> language model
+SCRIPT_LANGUAGES = {
+    'Latin': 'eng',
+    'Han': 'chi_sim',
+    'Japanese': 'jpn',
+    'Hangul': 'kor',
+    'Korean': 'kor',
+    'Cyrillic': 'rus',
+    'Greek': 'ell',
+    'Arabic': 'ara',
+    'Hebrew': 'heb',
+    'Devanagari': 'hin',
+    'Thai': 'tha',
+}
+
+# job_id -> paths of a finished OCR job, so later tools can refer to it by id
+jobs: Dict[str, Dict[str, Any]] = {}
+
+_installed_languages: Optional[List[str]] = None
+# job_id -> metrics of queued, running and finished ocrmypdf runs, oldest first
+metrics: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+
+
+class OcrError(Exception):
+    pass
+
+
+class CpuScheduler:
+    """Split a fixed budget of threads across the OCR jobs.
+
+    A job is admitted once a thread is free, and gets an equal share of the budget among the running and waiting
+    jobs, capped by the free threads and `JOB_MAX_THREADS`. The job runs ocrmypdf with `--jobs` set to its share and
+    `OMP_THREAD_LIMIT=1`, so Tesseract does not add threads of its own. A running process cannot change its
+    `--jobs`, so the split is rebalanced at admission: jobs admitted while many others wait get fewer threads, and
+    the threads of finished jobs go to the next admitted ones.
+    """
+
+    def __init__(self, budget: int, max_threads: int):
+        self.budget = budget
+        self.max_threads = max(1, min(max_threads, budget))
+        self.free = budget
+        self.waiting = 0
+        # job_id -> threads
+        self.running: Dict[str, int] = {}
+        self._condition: Optional[asyncio.Condition] = None
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        # Created lazily, so it binds to the event loop of the server rather than the one at import time
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self, job_id: str, threads: Optional[int] = None) -> int:
+        """Wait for free threads and take a share of them, or exactly `threads` (capped by the budget) if given."""
+        self.waiting += 1
+        try:
+            # Let jobs submitted together (e.g. by `ocr_directory`) register before the first share is computed
+            await asyncio.sleep(0)
+            async with self.condition:
+                needed = 1 if threads is None else max(1, min(threads, self.budget))
+                await self.condition.wait_for(lambda: self.free >= needed)
+                if threads is None:
+                    share = self.budget // (len(self.running) + self.waiting)
+                    threads = max(1, min(share, self.free, self.max_threads))
+                else:
+                    threads = needed
+                self.free -= threads
+                self.running[job_id] = threads
+                return threads
+        finally:
+            self.waiting -= 1
+
+    async def release(self, job_id: str):
+        async with self.condition:
+            self.free += self.running.pop(job_id)
+            self.condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self, job_id: str, threads: Optional[int] = None) -> AsyncIterator[int]:
+        threads = await self.acquire(job_id, threads)
+        try:
+            yield threads
+        finally:
+            await self.release(job_id)
+
+
+scheduler = CpuScheduler(CPU_BUDGET, JOB_MAX_THREADS)
+
+
+# Han, kana and hangul runs have no spaces between words, so they are indexed as overlapping bigrams, and every
+# character once more on its own for single-character queries
+CJK_RUN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+')
+
+
+def cjk_bigrams(run: str) -> str:
+    if len(run) == 1:
+        return run
+    return ' '.join(run[idx:idx + 2] for idx in range(len(run) - 1))
+
+
+def segment(text: str) -> str:
+    """Rewrite CJK runs as space-separated bigrams for the FTS5 `unicode61` tokenizer; other text is unchanged."""
+    return CJK_RUN.sub(lambda match: f' {cjk_bigrams(match.group())} ', text)
+
+
+def cjk_unigrams(text: str) -> str:
+    """The CJK characters of a text, space-separated, so a character at the end of a run is a token too."""
+    return ' '.join(''.join(CJK_RUN.findall(text)))
+
+
+def fts_query(query: str) -> Tuple[str, List[str]]:
+    """Build an FTS5 query that requires every term, and return the terms for snippet extraction.
+
+    A CJK run becomes a phrase of its bigrams, and a single CJK character is looked up in the `unigrams` column.
+    Every term is quoted, so FTS5 operators in the query are matched as text.
+    """
+    terms = [term for term in CJK_RUN.sub(lambda match: f' {match.group()} ', query).split() if term]
+    clauses = []
+    for term in terms:
+        if CJK_RUN.fullmatch(term) and len(term) == 1:
+            clauses.append(f'unigrams : "{term}"')
+        else:
+            phrase = (cjk_bigrams(term) if CJK_RUN.fullmatch(term) else term).replace('"', '""')
+            clauses.append(f'body : "{phrase}"')
+    return ' AND '.join(clauses), terms
+
+
+def chunk_page(text: str) -> Iterator[Tuple[int, str]]:
+    """Split a page into (offset, chunk) pieces of about `INDEX_CHUNK_CHARS` characters, at line breaks if possible."""
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + INDEX_CHUNK_CHARS)
+        if end < len(text):
+            newline = text.rfind('\n', start + INDEX_CHUNK_CHARS // 2, end)
+            end = newline + 1 if newline != -1 else end
+        yield start, text[start:end]
+        start = end
+
+
+def make_snippet(text: str, terms: List[str]) -> str:
+    lowered = text.lower()
+    positions = [pos for pos in (lowered.find(term.lower()) for term in terms) if pos != -1]
+    center = min(positions) if positions else 0
+    start = max(0, center - SNIPPET_CHARS // 2)
+    snippet = ' '.join(text[start:start + SNIPPET_CHARS].split())
+    return ('...' if start > 0 else '') + snippet + ('...' if start + SNIPPET_CHARS < len(text) else '')
+
+
+class SearchIndex:
+    """SQLite FTS5 index of OCR text with document, page and character-offset granularity.
+
+    The chunks of a document get consecutive rowids, recorded in `documents`, so re-indexing a document deletes its
+    chunks by rowid: `doc_id` is an unindexed column of the FTS table, and filtering on it scans every chunk.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT NOT NULL UNIQUE,
+                sidecar TEXT NOT NULL,
+                pages INTEGER NOT NULL,
+                indexed_at REAL NOT NULL,
+                first_chunk INTEGER NOT NULL DEFAULT 0,
+                last_chunk INTEGER NOT NULL DEFAULT -1
+            )
+        """)
+        if conn.execute('PRAGMA user_version').fetchone()[0] < INDEX_VERSION:
+            self.upgrade(conn)
+        return conn
+
+    @staticmethod
+    def create_chunks(conn: sqlite3.Connection):
+        # `body` holds the segmented text that is searched, `unigrams` its CJK characters and `text` the original
+        # chunk for snippets
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(
+                body, unigrams, doc_id UNINDEXED, page UNINDEXED, start UNINDEXED, text UNINDEXED,
+                tokenize = 'unicode61'
+            )
+        """)
+
+    @staticmethod
+    def insert_chunks(conn: sqlite3.Connection, doc_id: int, sidecar: str):
+        """Index every page of a sidecar under `doc_id`, recording its pages and the rowids of its chunks."""
+        first_chunk = next_chunk = conn.execute('SELECT COALESCE(MAX(rowid), 0) + 1 FROM chunks').fetchone()[0]
+        pages = 0
+        for pages, page_text in enumerate(iter_sidecar_pages(sidecar), start=1):
+            rows = [(segment(chunk), cjk_unigrams(chunk), doc_id, pages, start, chunk)
+                    for start, chunk in chunk_page(page_text) if chunk.strip()]
+            conn.executemany('INSERT INTO chunks (rowid, body, unigrams, doc_id, page, start, text) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             [(next_chunk + idx, *row) for idx, row in enumerate(rows)])
+            next_chunk += len(rows)
+        conn.execute('UPDATE documents SET pages = ?, first_chunk = ?, last_chunk = ? WHERE id = ?',
+                     (pages, first_chunk, next_chunk - 1, doc_id))
+
+    def upgrade(self, conn: sqlite3.Connection):
+        """Recreate the chunks of an index written by an older version, from the sidecars that still exist."""
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another connection may have upgraded the index while this one waited for the lock
+            if conn.execute('PRAGMA user_version').fetchone()[0] < INDEX_VERSION:
+                columns = {row[1] for row in conn.execute('PRAGMA table_info(documents)')}
+                for column, default in (('first_chunk', 0), ('last_chunk', -1)):
+                    if column not in columns:
+                        conn.execute(f'ALTER TABLE documents ADD COLUMN {column} INTEGER NOT NULL DEFAULT {default}')
+                conn.execute('DROP TABLE IF EXISTS chunks')
+                self.create_chunks(conn)
+                for doc_id, sidecar in conn.execute('SELECT id, sidecar FROM documents').fetchall():
+                    try:
+                        self.insert_chunks(conn, doc_id, sidecar)
+                    except OSError:
+                        conn.execute('DELETE FROM documents WHERE id = ?', (doc_id,))
+                conn.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def add_document(self, path: str, sidecar: str):
+        """Index a sidecar, replacing any earlier index of the same output file."""
+        path = os.path.abspath(path)
+        conn = self.connect()
+        try:
+            with conn:
+                row = conn.execute('SELECT id, first_chunk, last_chunk FROM documents WHERE path = ?',
+                                   (path,)).fetchone()
+                if row:
+                    conn.execute('DELETE FROM chunks WHERE rowid BETWEEN ? AND ?', (row[1], row[2]))
+                    conn.execute('DELETE FROM documents WHERE id = ?', (row[0],))
+                doc_id = conn.execute('INSERT INTO documents (path, sidecar, pages, indexed_at) VALUES (?, ?, 0, ?)',
+                                      (path, os.path.abspath(sidecar), time.time())).lastrowid
+                self.insert_chunks(conn, doc_id, sidecar)
+        finally:
+            conn.close()
+
+    def search(self, query: str, top_k: int) -> List[Dict[str, Any]]:
+        match, terms = fts_query(query)
+        if not match:
+            return []
+        conn = self.connect()
+        try:
+            rows = conn.execute("""
+                SELECT documents.path, chunks.page, chunks.start, chunks.text, bm25(chunks) AS score
+                FROM chunks JOIN documents ON documents.id = chunks.doc_id
+                WHERE chunks MATCH ?
+                ORDER BY score
+                LIMIT ?
+            """, (match, top_k)).fetchall()
+        finally:
+            conn.close()
+        return [{'document': path, 'page': page, 'offset': start, 'score': round(-score, 6),
+                 'snippet': make_snippet(text, terms)} for path, page, start, text, score in rows]
+
+
+search_index = SearchIndex(INDEX_PATH)
+
+
+async def index_job(job: Dict[str, Any]):
+    try:
+        await asyncio.to_thread(search_index.add_document, job['output_pdf'], job['sidecar'])
+    except (sqlite3.Error, OSError) as e:
+        logger.warning('Indexing failed: %s: %s', job['output_pdf'], e)
+
+
+def sidecar_path(output_pdf: str) -> str:
+    return os.path.splitext(output_pdf)[0] + '.txt'
+
+
+def iter_sidecar_pages(sidecar: str) -> Iterator[str]:
+    """Yield the text of each page in a sidecar file, reading it in fixed-size chunks."""
+    pending = ''
+    with open(sidecar, 'r', encoding='utf-8') as f:
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            pending += chunk
+            *pages, pending = pending.split(PAGE_SEPARATOR)
+            yield from pages
+    if pending:
+        yield pending
+
+
+def summarize_sidecar(sidecar: str, preview_chars: int = PREVIEW_CHARS) -> Dict:
+    """Collect the leading text and the [start, end) character offsets of every page."""
+    preview = []
+    preview_len = 0
+    boundaries = []
+    offset = 0
+    total_chars = 0
+    for page in iter_sidecar_pages(sidecar):
+        boundaries.append([offset, offset + len(page)])
+        offset += len(page) + len(PAGE_SEPARATOR)
+        total_chars += len(page)
+        if preview_len < preview_chars:
+            preview.append(page[:preview_chars - preview_len])
+            preview_len += len(preview[-1])
+    return {
+        'pages': len(boundaries),
+        'page_boundaries': boundaries,
+        'text': PAGE_SEPARATOR.join(preview),
+        'truncated': total_chars > preview_len,
+    }
+
+
+def resolve_sidecar(job_or_path: str) -> Optional[str]:
+    if job_or_path in jobs:
+        return jobs[job_or_path]['sidecar']
+    if job_or_path.lower().endswith('.pdf'):
+        job_or_path = sidecar_path(job_or_path)
+    if os.path.isfile(job_or_path):
+        return job_or_path
+    return None
+
+
+def kill_process_group(process: asyncio.subprocess.Process):
+    # ocrmypdf runs Tesseract and Ghostscript in child processes, so the whole group is stopped
+    if sys.platform == 'win32':
+        process.kill()
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+async def start_process(command: Tuple[str, ...], env: Optional[Dict[str, str]],
+                        memory_mb: Optional[int]) -> asyncio.subprocess.Process:
+    """Start a command in its own process group, with the address space of its process limited to `memory_mb` MB.
+
+    RLIMIT_AS is a limit per process: the processes the command starts (Tesseract, Ghostscript) inherit a limit of
+    the same size each, they do not share one. A `preexec_fn` is unsafe in this server, whose threads (indexing,
+    image conversion) may hold locks while the child is forked, so the command is started through `prlimit`. Without
+    it the limit is set on the started process, and only applies to the processes it starts after that.
+    """
+    kwargs = {}
+    limit = None
+    if sys.platform != 'win32':
+        kwargs['start_new_session'] = True
+        if memory_mb:
+            limit = memory_mb * 1024 * 1024
+            if PRLIMIT:
+                command = (PRLIMIT, f'--as={limit}', '--', *command)
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=env, **kwargs)
+    if limit and not PRLIMIT and hasattr(resource, 'prlimit'):
+        try:
+            resource.prlimit(process.pid, resource.RLIMIT_AS, (limit, limit))
+        except (ProcessLookupError, PermissionError):
+            # Already exited
+            pass
+    return process
+
+
+async def wait_or_kill(process: asyncio.subprocess.Process, waiter, timeout: Optional[float],
+                       command: Tuple[str, ...]):
     try:
-        command = [
-            'ocrmypdf',
-            '--language', 'eng+chi_sim',  # language
-            '--force-ocr',  # Force OCR processing
-            input_pdf,
-            output_pdf
-        ]
+        return await asyncio.wait_for(waiter, timeout)
+    except asyncio.TimeoutError:
+        kill_process_group(process)
+        await process.wait()
+        raise OcrError(f'Timed out after {timeout} seconds: {" ".join(command)}')
+
+
+async def run_command(*command: str, env: Optional[Dict[str, str]] = None, timeout: Optional[float] = None,
+                      memory_mb: Optional[int] = None) -> Tuple[int, str, str]:
+    """Run a command with little output and return its exit code, stdout and stderr."""
+    process = await start_process(command, env, memory_mb)
+    stdout, stderr = await wait_or_kill(process, process.communicate(), timeout, command)
+    return (process.returncode, stdout.decode('utf-8', errors='replace'),
+            stderr.decode('utf-8', errors='replace'))
+
+
+class JobLog:
+    """Output of one ocrmypdf run: written to a rotating log file, with a bounded tail and page progress in memory."""
+
+    def __init__(self, job_id: str):
+        os.makedirs(LOG_DIR, exist_ok=True)
+        self.path = os.path.join(LOG_DIR, f'{job_id}.log')
+        # The file is only opened by the first write, so queued jobs do not hold a file descriptor each
+        self.handler = RotatingFileHandler(self.path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                           encoding='utf-8', delay=True)
+        self.handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+        self.tail: deque = deque(maxlen=LOG_TAIL_LINES)
+        # page number -> [first seen, last seen] timestamps
+        self.pages: Dict[int, List[float]] = {}
+
+    def feed(self, stream: str, line: str):
+        line = line.rstrip()[:LOG_LINE_CHARS]
+        if not line:
+            return
+        self.tail.append(line)
+        self.handler.handle(logging.makeLogRecord({'name': stream, 'msg': line, 'levelno': logging.INFO}))
+        match = PAGE_LINE.match(line)
+        if match:
+            now = time.time()
+            self.pages.setdefault(int(match.group(1)), [now, now])[1] = now
+
+    def page_seconds(self) -> List[float]:
+        return [last - first for first, last in self.pages.values()]
+
+    def close(self):
+        self.handler.close()
+
+
+async def pump_lines(stream: asyncio.StreamReader, name: str, job_log: JobLog):
+    # Fixed-size reads, so a very long line cannot make the server buffer unbounded output
+    pending = b''
+    while True:
+        chunk = await stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        *lines, pending = (pending + chunk).split(b'\n')
+        for line in lines:
+            job_log.feed(name, line.decode('utf-8', errors='replace'))
+        if len(pending) > LOG_LINE_CHARS:
+            job_log.feed(name, pending.decode('utf-8', errors='replace'))
+            pending = b''
+    if pending:
+        job_log.feed(name, pending.decode('utf-8', errors='replace'))
+
+
+async def run_logged(*command: str, job_log: JobLog, env: Optional[Dict[str, str]] = None,
+                     timeout: Optional[float] = None, memory_mb: Optional[int] = None) -> int:
+    """Run a command, streaming its output into `job_log` instead of collecting it in memory."""
+    process = await start_process(command, env, memory_mb)
+
+    async def drain():
+        await asyncio.gather(pump_lines(process.stdout, 'stdout', job_log),
+                             pump_lines(process.stderr, 'stderr', job_log))
+        return await process.wait()
+
+    return await wait_or_kill(process, drain(), timeout, command)
+
+
+async def installed_languages() -> List[str]:
+    global _installed_languages
+    if _installed_languages is None:
+        code, stdout, _ = await run_command('tesseract', '--list-langs')
+        # The first line is a header like `List of available languages in "/usr/share/tessdata/" (3):`
+        _installed_languages = stdout.splitlines()[1:] if code == 0 else []
+    return _installed_languages
 
 
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
+async def detect_language(input_pdf: str) -> str:
+    """Pick one Tesseract language from the script of the first page, rendered at a low resolution.
 
+    Falls back to `DEFAULT_LANGUAGE` when Ghostscript or the Tesseract OSD model is missing, the script is not
+    recognized, or its language model is not installed. Ghostscript and Tesseract run in a one-thread slot of the
+    scheduler, so detecting the language of many files at once does not oversubscribe the host.
+    """
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sample = os.path.join(tmp_dir, 'sample.png')
+            async with scheduler.slot(f'detect-{uuid.uuid4().hex[:12]}', threads=1):
+                code, _, _ = await run_command(
+                    'gs', '-q', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-sDEVICE=pnggray', f'-r{DETECT_DPI}',
+                    '-dFirstPage=1', '-dLastPage=1', f'-sOutputFile={sample}', input_pdf)
+                if code != 0 or not os.path.isfile(sample):
+                    return DEFAULT_LANGUAGE
+                code, stdout, _ = await run_command('tesseract', sample, 'stdout', '--psm', '0')
+        if code != 0:
+            return DEFAULT_LANGUAGE
+        for line in stdout.splitlines():
+            if line.startswith('Script:'):
+                language = SCRIPT_LANGUAGES.get(line.split(':', 1)[1].strip())
+                if language and language in await installed_languages():
+                    return language
+    except OSError:
+        pass
+    return DEFAULT_LANGUAGE
+
+
+def is_image(path: str) -> bool:
+    return path.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def image_to_pdf(image_path: str, pdf_path: str):
+    """Embed an image in a PDF without re-encoding it; every frame of a multi-page TIFF becomes a page.
+
+    img2pdf copies JPEG, JPEG 2000, CCITT and most PNG data as is. Images with an alpha channel cannot be embedded
+    losslessly, so they are flattened onto white with Pillow and stored as PNG first.
+    """
+    try:
+        with open(pdf_path, 'wb') as f:
+            img2pdf.convert(image_path, outputstream=f)
+    except img2pdf.AlphaChannelError:
+        flat_path = pdf_path + '.png'
+        with Image.open(image_path) as image:
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.convert('RGBA').getchannel('A'))
+            background.save(flat_path, dpi=image.info.get('dpi', (96, 96)))
+        try:
+            with open(pdf_path, 'wb') as f:
+                img2pdf.convert(flat_path, outputstream=f)
+        finally:
+            os.remove(flat_path)
+
+
+def merge_pdfs(pdf_paths: List[str], output_pdf: str, tmp_dir: str):
+    """Concatenate PDFs with at most MERGE_MAX_OPEN of them open at a time.
+
+    pikepdf copies the page streams from the source files while saving, so each source stays open until then.
+    Longer lists are merged in chunks into intermediate files in `tmp_dir`, which are merged in turn.
+    """
+    level = 0
+    while len(pdf_paths) > MERGE_MAX_OPEN:
+        merged = []
+        for start in range(0, len(pdf_paths), MERGE_MAX_OPEN):
+            merged.append(os.path.join(tmp_dir, f'merge_{level}_{start // MERGE_MAX_OPEN:05d}.pdf'))
+            merge_pdfs(pdf_paths[start:start + MERGE_MAX_OPEN], merged[-1], tmp_dir)
+        if level:
+            for path in pdf_paths:
+                os.remove(path)
+        pdf_paths = merged
+        level += 1
+    with ExitStack() as stack, pikepdf.new() as pdf:
+        for path in pdf_paths:
+            pdf.pages.extend(stack.enter_context(pikepdf.open(path)).pages)
+        pdf.save(output_pdf)
+    if level:
+        for path in pdf_paths:
+            os.remove(path)
+
+
+def images_to_pdf(image_paths: List[str], pdf_path: str, tmp_dir: str):
+    """Assemble images into one PDF, holding the data of a single image in memory at a time.
+
+    Each image is first written to its own PDF, and those are merged by `merge_pdfs`.
+    """
+    parts = []
+    for idx, image_path in enumerate(image_paths):
+        parts.append(os.path.join(tmp_dir, f'image_{idx:05d}.pdf'))
+        image_to_pdf(image_path, parts[-1])
+    merge_pdfs(parts, pdf_path, tmp_dir)
+
+
+async def run_ocr(input_path: Union[str, List[str]], output_pdf: str, profile: str = DEFAULT_PROFILE,
+                  language: Optional[str] = None) -> Dict[str, Any]:
+    """Run ocrmypdf on a PDF or a list of images with the threads granted by the scheduler and register the job."""
+    if profile not in PROFILES:
+        raise OcrError(f'Unknown profile: {profile}, choose from {list(PROFILES)}')
+    inputs = [input_path] if isinstance(input_path, str) else list(input_path)
+    if not inputs:
+        raise OcrError('No input files given')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if len(inputs) == 1 and not is_image(inputs[0]):
+            input_pdf = inputs[0]
+        else:
+            not_images = [path for path in inputs if not is_image(path)]
+            if not_images:
+                raise OcrError(f'Only images can be combined, got: {not_images}')
+            input_pdf = os.path.join(tmp_dir, 'images.pdf')
+            try:
+                await asyncio.to_thread(images_to_pdf, inputs, input_pdf, tmp_dir)
+            except (img2pdf.ImageOpenError, pikepdf.PdfError, ValueError) as e:
+                raise OcrError(f'Cannot convert images to PDF: {e}')
+        result = await ocr_file(input_pdf, output_pdf, profile, language)
+    result['input_pdf'] = input_path
+    jobs[result['job_id']]['input_pdf'] = input_path
+    await index_job(result)
+    return result
+
+
+def remove_job_log(path: str):
+    """Delete a job log and its rotated backups."""
+    for log_path in [path] + [f'{path}.{idx}' for idx in range(1, LOG_BACKUP_COUNT + 1)]:
+        try:
+            os.remove(log_path)
+        except OSError:
+            pass
+
+
+def prune_logs():
+    """Keep the logs of the METRICS_MAX_JOBS most recent jobs, e.g. those left by earlier runs of the server."""
+    try:
+        paths = glob.glob(os.path.join(LOG_DIR, '*.log'))
+        paths.sort(key=os.path.getmtime)
+    except OSError:
+        return
+    for path in paths[:-METRICS_MAX_JOBS]:
+        remove_job_log(path)
+
+
+def track_job(job_id: str, **values) -> Dict[str, Any]:
+    """Register the metrics of a job; they are dropped by `prune_metrics` once it is finished."""
+    metrics[job_id] = values
+    return values
+
+
+def prune_metrics():
+    """Drop the oldest finished jobs and their log files past METRICS_MAX_JOBS. Queued and running jobs are always
+    kept, so while more of them wait than METRICS_MAX_JOBS the metrics hold more jobs for a while."""
+    excess = len(metrics) - METRICS_MAX_JOBS
+    if excess <= 0:
+        return
+    evicted = [job_id for job_id, job_metrics in metrics.items() if job_metrics['status'] in ('done', 'failed')]
+    for job_id in evicted[:excess]:
+        job_metrics = metrics.pop(job_id)
+        if job_metrics.get('log'):
+            remove_job_log(job_metrics['log'])
+
+
+def finish_job(job_metrics: Dict[str, Any], code: Optional[int], output_pdf: str, sidecar: str):
+    finished_at = time.time()
+    job_log: Optional[JobLog] = job_metrics.pop('job_log', None)
+    job_metrics.update(status='done' if code == 0 else 'failed', exit_code=code, finished_at=finished_at,
+                       ocr_seconds=round(finished_at - job_metrics.get('started_at', finished_at), 3))
+    if job_log is not None:
+        page_seconds = job_log.page_seconds()
+        if page_seconds:
+            job_metrics.update(avg_page_seconds=round(sum(page_seconds) / len(page_seconds), 3),
+                               max_page_seconds=round(max(page_seconds), 3))
+        job_metrics['pages'] = len(job_log.pages)
+        if code != 0:
+            job_metrics['tail'] = list(job_log.tail)[-10:]
+    if code == 0:
+        job_metrics['pages'] = summarize_sidecar(sidecar, 0)['pages']
+        job_metrics['input_size'] = os.path.getsize(job_metrics['input_pdf'])
+        job_metrics['output_size'] = os.path.getsize(output_pdf)
+        job_metrics['size_ratio'] = round(job_metrics['output_size'] / max(1, job_metrics['input_size']), 3)
+
+
+def job_snapshot(job_id: str) -> Dict[str, Any]:
+    job_metrics = metrics[job_id]
+    snapshot = {key: value for key, value in job_metrics.items() if key != 'job_log'}
+    job_log: Optional[JobLog] = job_metrics.get('job_log')
+    if job_log is not None:
+        # Still running: report progress from the pages seen in the output so far
+        snapshot['pages_started'] = len(job_log.pages)
+        snapshot['elapsed'] = round(time.time() - job_metrics['started_at'], 3)
+        snapshot['tail'] = list(job_log.tail)[-10:]
+    return {'job_id': job_id, **snapshot}
+
+
+def summarize_metrics() -> Dict[str, Any]:
+    finished = [m for m in metrics.values() if m['status'] in ('done', 'failed')]
+    done = [m for m in finished if m['status'] == 'done']
+    summary = {status: sum(1 for m in metrics.values() if m['status'] == status)
+               for status in ('queued', 'running', 'done', 'failed')}
+    summary['jobs'] = len(metrics)
+    summary['cpu_budget'] = scheduler.budget
+    summary['free_threads'] = scheduler.free
+    if finished:
+        summary['avg_queue_wait'] = round(sum(m.get('queue_wait', 0) for m in finished) / len(finished), 3)
+    if done:
+        pages = sum(m['pages'] for m in done)
+        ocr_seconds = sum(m['ocr_seconds'] for m in done)
+        summary['pages'] = pages
+        summary['avg_ocr_seconds'] = round(ocr_seconds / len(done), 3)
+        summary['pages_per_second'] = round(pages / ocr_seconds, 3) if ocr_seconds else None
+        summary['avg_size_ratio'] = round(sum(m['size_ratio'] for m in done) / len(done), 3)
+    return summary
+
+
+async def resolve_language(input_pdf: str, profile: str, language: Optional[str]) -> str:
+    language = language or PROFILES[profile]['language']
+    if language == AUTO_LANGUAGE:
+        language = await detect_language(input_pdf)
+    return language
+
+
+async def ocr_file(input_pdf: str, output_pdf: str, profile: str, language: Optional[str]) -> Dict[str, Any]:
+    language = await resolve_language(input_pdf, profile, language)
+    sidecar = sidecar_path(output_pdf)
+    job_id = uuid.uuid4().hex[:12]
+    job_log = JobLog(job_id)
+    job_metrics = track_job(job_id, input_pdf=input_pdf, profile=profile, language=language, log=job_log.path,
+                            status='queued', queued_at=time.time())
+    code = None
+    try:
+        async with scheduler.slot(job_id) as threads:
+            started_at = time.time()
+            job_metrics.update(status='running', started_at=started_at, threads=threads,
+                               queue_wait=round(started_at - job_metrics['queued_at'], 3), job_log=job_log)
+            command = [
+                'ocrmypdf',
+                '--language', language,  # language
+                '--force-ocr',  # Force OCR processing
+                '--sidecar', sidecar,  # Plain text output, one form feed per page
+                '--jobs', str(threads),
+                '--verbose', '1',  # Per-page messages, parsed for progress and timing
+                '--no-progress-bar',
+                *PROFILES[profile]['args'],
+                input_pdf,
+                output_pdf
+            ]
+            env = dict(os.environ, OMP_THREAD_LIMIT='1')
+            code = await run_logged(*command, job_log=job_log, env=env, timeout=JOB_TIMEOUT,
+                                    memory_mb=JOB_MEMORY_MB)
+    except OcrError as e:
+        job_log.feed('server', str(e))
+        raise
+    finally:
+        finish_job(job_metrics, code, output_pdf, sidecar)
+        job_log.close()
+        # Pruned once the log is written and closed, so the files of the jobs dropped are really removed
+        prune_metrics()
+
+    if code != 0:
+        logger.warning('OCR failed: %s, see %s', input_pdf, job_log.path)
+        raise OcrError('\n'.join(job_log.tail))
+
+    jobs[job_id] = {'input_pdf': input_pdf, 'output_pdf': output_pdf, 'sidecar': sidecar,
+                    'profile': profile, 'language': language, 'threads': threads}
+    return {'job_id': job_id, **jobs[job_id]}
+
+
+async def page_fingerprints(input_pdf: str, tmp_dir: str) -> List[str]:
+    """Hash the pixels of every page rendered by Ghostscript, so a page is only considered changed if it looks
+    different, whatever happened to the PDF structure around it. Rendering and hashing take a one-thread slot of the
+    scheduler."""
+    pattern = os.path.join(tmp_dir, 'page_%06d.png')
+
+    def hash_pages() -> List[str]:
+        fingerprints = []
+        for name in sorted(os.listdir(tmp_dir)):
+            if not name.startswith('page_'):
+                continue
+            path = os.path.join(tmp_dir, name)
+            with Image.open(path) as image:
+                digest = hashlib.sha256(f'{image.size}'.encode())
+                digest.update(image.tobytes())
+            fingerprints.append(digest.hexdigest())
+            os.remove(path)
+        return fingerprints
+
+    async with scheduler.slot(f'fingerprint-{uuid.uuid4().hex[:12]}', threads=1):
+        code, _, stderr = await run_command(
+            'gs', '-q', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-sDEVICE=pnggray', f'-r{FINGERPRINT_DPI}',
+            f'-sOutputFile={pattern}', input_pdf)
+        if code != 0:
+            raise OcrError(f'Cannot render {input_pdf}: {stderr}')
+        return await asyncio.to_thread(hash_pages)
+
+
+def page_cache_path(key: str, ext: str) -> str:
+    return os.path.join(PAGE_CACHE_DIR, key[:2], key + ext)
+
+
+def write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def extract_pages(input_pdf: str, page_indexes: List[int], output_pdf: str):
+    with pikepdf.open(input_pdf) as source, pikepdf.new() as pdf:
+        for idx in page_indexes:
+            pdf.pages.append(source.pages[idx])
+        pdf.save(output_pdf)
+
+
+def cache_pages(ocr_pdf_path: str, sidecar: str, keys: List[str]):
+    """Store every page of an OCR result, with its text, under the key of the source page."""
+    with pikepdf.open(ocr_pdf_path) as source:
+        for page, text, key in zip(source.pages, iter_sidecar_pages(sidecar), keys):
+            path = page_cache_path(key, '.pdf')
+            tmp_path = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with pikepdf.new() as pdf:
+                pdf.pages.append(page)
+                pdf.save(tmp_path)
+            os.replace(tmp_path, path)
+            write_atomic(page_cache_path(key, '.txt'), text.encode('utf-8'))
+
+
+def stitch_pages(keys: List[str], output_pdf: str, sidecar: str, tmp_dir: str):
+    """Assemble the output PDF and its sidecar from cached pages, one page of text in memory at a time."""
+    merge_pdfs([page_cache_path(key, '.pdf') for key in keys], output_pdf, tmp_dir)
+    with open(sidecar, 'w', encoding='utf-8') as out:
+        for key in keys:
+            with open(page_cache_path(key, '.txt'), 'r', encoding='utf-8') as f:
+                out.write(f.read())
+            out.write(PAGE_SEPARATOR)
+
+
+async def run_incremental_ocr(input_pdf: str, output_pdf: str, profile: str = DEFAULT_PROFILE,
+                              language: Optional[str] = None) -> Dict[str, Any]:
+    """OCR only the pages whose rendering is not in the page cache yet, and stitch the rest in from the cache."""
+    if profile not in PROFILES:
+        raise OcrError(f'Unknown profile: {profile}, choose from {list(PROFILES)}')
+    language = await resolve_language(input_pdf, profile, language)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fingerprints = await page_fingerprints(input_pdf, tmp_dir)
+        keys = [hashlib.sha256(f'{fingerprint}:{profile}:{language}'.encode()).hexdigest()
+                for fingerprint in fingerprints]
+        missing: Dict[str, int] = {}
+        for idx, key in enumerate(keys):
+            if key not in missing and not (os.path.isfile(page_cache_path(key, '.pdf'))
+                                           and os.path.isfile(page_cache_path(key, '.txt'))):
+                missing[key] = idx
+
+        job_id = None
+        if missing:
+            changed_pdf = os.path.join(tmp_dir, 'changed.pdf')
+            changed_ocr = os.path.join(tmp_dir, 'changed_ocr.pdf')
+            await asyncio.to_thread(extract_pages, input_pdf, list(missing.values()), changed_pdf)
+            result = await ocr_file(changed_pdf, changed_ocr, profile, language)
+            job_id = result['job_id']
+            await asyncio.to_thread(cache_pages, changed_ocr, result['sidecar'], list(missing))
+        sidecar = sidecar_path(output_pdf)
+        await asyncio.to_thread(stitch_pages, keys, output_pdf, sidecar, tmp_dir)
+
+    if job_id in metrics:
+        metrics[job_id]['reused_pages'] = len(keys) - len(missing)
+    job_id = job_id or uuid.uuid4().hex[:12]
+    jobs[job_id] = {'input_pdf': input_pdf, 'output_pdf': output_pdf, 'sidecar': sidecar, 'profile': profile,
+                    'language': language, 'ocr_pages': len(missing), 'reused_pages': len(keys) - len(missing)}
+    await index_job(jobs[job_id])
+    return {'job_id': job_id, **jobs[job_id]}
+
+
+def load_manifest(manifest_path: str) -> Dict[str, Dict]:
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('files', {})
+
+
+def save_manifest(manifest_path: str, files: Dict[str, Dict]):
+    """Write the manifest atomically, so an interrupted run never leaves a truncated file behind."""
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'updated_at': time.time(), 'files': files}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def is_finished(entry: Optional[Dict], size: int, mtime: float) -> bool:
+    return (entry is not None and entry.get('status') == 'done'
+            and entry.get('size') == size and entry.get('mtime') == mtime
+            and os.path.isfile(entry['output_pdf']))
+
+
+@mcp.tool(description='A tool to perform OCR on a PDF file (or a PNG/JPEG/TIFF image) and return the extracted text. '
+                      'The result contains the path of the searchable PDF, a job id, the page count, the character '
+                      'offsets of each page and the first `preview_chars` characters of the text. Use `read_ocr_text` '
+                      'with the job id to read further pages. `profile` is one of `fast` (one auto-detected language, no optimization, plain '
+                      'PDF), `balanced` (default) or `archival` (deskew, page rotation, strongest optimization, '
+                      'PDF/A). `language` is a Tesseract language such as `eng`, `chi_sim` or `eng+chi_sim`, or '
+                      '`auto` to detect it from the first page; it overrides the language of the profile.')
+async def ocr_pdf(input_pdf: str, output_pdf: str, preview_chars: int = PREVIEW_CHARS,
+                  profile: str = DEFAULT_PROFILE, language: Optional[str] = None) -> str:
+    try:
+        job = await run_ocr(input_pdf, output_pdf, profile, language)
+        output = {'success': True, **job}
+        output.update(summarize_sidecar(job['sidecar'], preview_chars))
+        return json.dumps(output, ensure_ascii=False)
+    except (OcrError, OSError) as e:
+        return json.dumps({'success': False, 'error': f'OCR failed: {e}'}, ensure_ascii=False)
+
+
+@mcp.tool(description='Combine images (PNG, JPEG, TIFF including multi-page TIFF, BMP, GIF, JPEG 2000) into one '
+                      'searchable PDF, in the given order, and return the extracted text like `ocr_pdf`. Use this for '
+                      'screenshots and phone scans; the images are embedded without re-encoding.')
+async def ocr_images(image_paths: List[str], output_pdf: str, preview_chars: int = PREVIEW_CHARS,
+                     profile: str = DEFAULT_PROFILE, language: Optional[str] = None) -> str:
+    try:
+        job = await run_ocr(image_paths, output_pdf, profile, language)
+        output = {'success': True, **job}
+        output.update(summarize_sidecar(job['sidecar'], preview_chars))
+        return json.dumps(output, ensure_ascii=False)
+    except (OcrError, OSError) as e:
+        return json.dumps({'success': False, 'error': f'OCR failed: {e}'}, ensure_ascii=False)
+
+
+@mcp.tool(description='OCR a new version of a document, running Tesseract only on pages that are new or changed '
+                      'since any earlier `ocr_pdf_incremental` call with the same profile and language; unchanged '
+                      'pages are reused from the page cache. Returns the same fields as `ocr_pdf`, plus `ocr_pages` '
+                      'and `reused_pages`.')
+async def ocr_pdf_incremental(input_pdf: str, output_pdf: str, preview_chars: int = PREVIEW_CHARS,
+                              profile: str = DEFAULT_PROFILE, language: Optional[str] = None) -> str:
+    try:
+        job = await run_incremental_ocr(input_pdf, output_pdf, profile, language)
+        output = {'success': True, **job}
+        output.update(summarize_sidecar(job['sidecar'], preview_chars))
+        return json.dumps(output, ensure_ascii=False)
+    except (OcrError, OSError, pikepdf.PdfError) as e:
+        return json.dumps({'success': False, 'error': f'OCR failed: {e}'}, ensure_ascii=False)
+
+
+@mcp.tool(description='OCR every file matching `pattern` (a glob relative to `input_dir`, `**` is supported) into '
+                      '`output_dir`, keeping the relative paths. Images get a `.pdf` extension in the output. Files '
+                      'are processed largest first by the shared '
+                      'CPU scheduler. Progress is recorded in `ocr_manifest.json` in `output_dir`; calling the tool '
+                      'again after an interruption skips the files that are already done. `profile` and `language` '
+                      'work as in `ocr_pdf`.')
+async def ocr_directory(input_dir: str, output_dir: str, pattern: str = '*.pdf', profile: str = DEFAULT_PROFILE,
+                        language: Optional[str] = None) -> str:
+    if not os.path.isdir(input_dir):
+        return json.dumps({'success': False, 'error': f'Not a directory: {input_dir}'}, ensure_ascii=False)
+    if profile not in PROFILES:
+        return json.dumps({'success': False, 'error': f'Unknown profile: {profile}, choose from {list(PROFILES)}'},
+                          ensure_ascii=False)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    files = load_manifest(manifest_path)
+
+    output_root = os.path.abspath(output_dir) + os.sep
+    pending: List[str] = []
+    skipped = 0
+    for path in glob.glob(os.path.join(input_dir, pattern), recursive=True):
+        if not os.path.isfile(path) or os.path.abspath(path).startswith(output_root):
+            continue
+        rel_path = os.path.relpath(path, input_dir)
+        output_name = os.path.splitext(rel_path)[0] + '.pdf' if is_image(rel_path) else rel_path
+        stat = os.stat(path)
+        if is_finished(files.get(rel_path), stat.st_size, stat.st_mtime):
+            skipped += 1
+            continue
+        files[rel_path] = {
+            'status': 'pending',
+            'input_pdf': path,
+            'output_pdf': os.path.join(output_dir, output_name),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+        }
+        pending.append(rel_path)
+    # Longest jobs first, so a big file started last does not stretch the total run time
+    pending.sort(key=lambda rel: files[rel]['size'], reverse=True)
+    save_manifest(manifest_path, files)
+
+    async def process(rel_path: str):
+        entry = files[rel_path]
+        os.makedirs(os.path.dirname(entry['output_pdf']) or '.', exist_ok=True)
+        start = time.time()
+        entry.update(status='running', started_at=start)
+        try:
+            job = await run_ocr(entry['input_pdf'], entry['output_pdf'], profile, language)
+            entry.update(status='done', job_id=job['job_id'], sidecar=job['sidecar'], language=job['language'],
+                         pages=summarize_sidecar(job['sidecar'], 0)['pages'], error=None)
+        except (OcrError, OSError) as e:
+            entry.update(status='failed', error=str(e))
+        entry.update(finished_at=time.time(), seconds=round(time.time() - start, 3))
+        save_manifest(manifest_path, files)
+
+    start = time.time()
+    await asyncio.gather(*[process(rel_path) for rel_path in pending])
+    statuses = [files[rel_path]['status'] for rel_path in pending]
+    return json.dumps({
+        'success': True,
+        'manifest': manifest_path,
+        'total': len(pending) + skipped,
+        'done': statuses.count('done'),
+        'failed': statuses.count('failed'),
+        'skipped': skipped,
+        'seconds': round(time.time() - start, 3),
+    }, ensure_ascii=False)
+
+
+@mcp.tool(description='Read the OCR text of a range of pages. `job_or_path` is a job id returned by `ocr_pdf`, the '
+                      'OCR output PDF, or its sidecar text file. Pages are 1-based and inclusive; omit `page_end` to '
+                      'read a single page.')
+async def read_ocr_text(job_or_path: str, page_start: int = 1, page_end: Optional[int] = None) -> str:
+    sidecar = resolve_sidecar(job_or_path)
+    if sidecar is None:
+        return json.dumps({'success': False, 'error': f'No OCR text found for: {job_or_path}'}, ensure_ascii=False)
+    page_start = max(1, page_start)
+    page_end = page_start if page_end is None else page_end
+    pages = []
+    for page_no, text in enumerate(iter_sidecar_pages(sidecar), start=1):
+        if page_no > page_end:
+            break
+        if page_no >= page_start:
+            pages.append({'page': page_no, 'text': text})
+    return json.dumps({'success': True, 'sidecar': sidecar, 'pages': pages}, ensure_ascii=False)
+
+
+@mcp.tool(description='Search the text of every document OCR\'d by this server and return the `top_k` best '
+                      'matching snippets, with the document path, page number (1-based) and character offset in the '
+                      'page. All query terms must match; Chinese, Japanese and Korean text can be searched without '
+                      'spaces. Use `read_ocr_text` with the document path to read the full page.')
+async def search_ocr_corpus(query: str, top_k: int = 10) -> str:
+    try:
+        results = await asyncio.to_thread(search_index.search, query, max(1, top_k))
+        return json.dumps({'success': True, 'results': results}, ensure_ascii=False)
+    except sqlite3.Error as e:
+        return json.dumps({'success': False, 'error': f'Search failed: {e}'}, ensure_ascii=False)
 
-        print("OCR completed:")
-        print(result.stdout)
-        if result.stderr:
-            print("Error messages:")
-            print(result.stderr)
 
-        return f"OCR completed: {output_pdf}"
+@mcp.tool(description='Report OCR job metrics. Without `job_id`, returns totals over the recent jobs (queue wait, '
+                      'OCR time, pages per second, output size ratio) and the `recent` most recent jobs. With a '
+                      '`job_id`, returns that job, including live page progress and the last output lines while it '
+                      'is running.')
+async def ocr_metrics(job_id: Optional[str] = None, recent: int = 10) -> str:
+    if job_id is not None:
+        if job_id not in metrics:
+            return json.dumps({'success': False, 'error': f'Unknown job: {job_id}'}, ensure_ascii=False)
+        return json.dumps({'success': True, 'job': job_snapshot(job_id)}, ensure_ascii=False)
+    recent_ids = list(metrics)[-recent:] if recent > 0 else []
+    return json.dumps({'success': True, 'summary': summarize_metrics(),
+                       'recent': [job_snapshot(recent_id) for recent_id in recent_ids]}, ensure_ascii=False)
 
-    except subprocess.CalledProcessError as e:
-        print(f"OCR failed: {e}")
-        print(f"Error output: {e.stderr}")
-        return f"OCR failed: {e.stderr}"
 
 if __name__ == "__main__":
+    prune_logs()
     mcp.run(transport="stdio")